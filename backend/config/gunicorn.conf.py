@@ -0,0 +1,27 @@
+"""gunicorn settings for running with metrics from every worker.
+
+    PROMETHEUS_MULTIPROC_DIR=/run/vault-metrics gunicorn -c config/gunicorn.conf.py config.wsgi
+
+prometheus_client keeps each worker's metrics in files in that directory,
+which /metrics adds up; the files of a previous run are removed on start.
+"""
+import glob
+import os
+
+from prometheus_client import multiprocess
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.getenv('GUNICORN_WORKERS', 2 * os.cpu_count() + 1))
+
+
+def on_starting(server):
+    directory = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, '*.db')):
+            os.unlink(path)
+
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(worker.pid)
@@ -38,9 +38,12 @@ INSTALLED_APPS = [
     'rest_framework_simplejwt',
     'vault_app',
     'secured_fields',
+    'rest_framework_simplejwt.token_blacklist',
 ]
 
 MIDDLEWARE = [
+    'vault_app.metrics.MetricsMiddleware',
+    'vault_app.replicas.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -78,6 +81,12 @@ DATABASES = {
     )
 }
 
+# Read replicas, comma separated database URLs in DATABASE_REPLICA_URLS; the
+# reads of GET requests go to them (see READ_REPLICAS below).
+for index, url in enumerate(filter(None, os.getenv('DATABASE_REPLICA_URLS', '').split(',')), start=1):
+    DATABASES[f'replica{index}'] = {**dj_database_url.parse(url.strip()), 'TEST': {'MIRROR': 'default'}}
+DATABASE_ROUTERS = ['vault_app.replicas.ReplicaRouter']
+
 
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
@@ -114,15 +123,169 @@ AUTH_USER_MODEL = 'vault_app.User'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'vault_app.authentication.CachedJWTAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
-    ]
+    ],
+    'DEFAULT_PAGINATION_CLASS': 'vault_app.pagination.VaultCursorPagination',
+    # orjson, with the same output as JSONRenderer (see vault_app/renderers.py)
+    'DEFAULT_RENDERER_CLASSES': [
+        'vault_app.renderers.OrjsonRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
 }
 
-# Use SECURED_FIELDS_KEY for the new library
+# Use SECURED_FIELDS_KEY for the new library. FERNET_KEY encrypts; while keys
+# are rotated (manage.py rotate_keys) the previous ones go in FERNET_OLD_KEYS,
+# comma separated, and only decrypt.
 SECURED_FIELDS_KEY = os.getenv('FERNET_KEY')
+if os.getenv('FERNET_OLD_KEYS'):
+    SECURED_FIELDS_KEY = [SECURED_FIELDS_KEY] + os.getenv('FERNET_OLD_KEYS').split(',')
 
 MEDIA_URL = '/documents/'
-MEDIA_ROOT = os.path.join(BASE_DIR, 'documents')
\ No newline at end of file
+MEDIA_ROOT = os.path.join(BASE_DIR, 'documents')
+
+# Key for the HMAC tokens of the encrypted-name search index.
+# Derived from FERNET_KEY when not set.
+BLIND_INDEX_KEY = os.getenv('BLIND_INDEX_KEY')
+
+# Document files are stored in fixed-size authenticated chunks so they can be
+# streamed and served by range without decrypting the whole file. Set
+# FILE_STORAGE to vault_app.storage.ShardedSegmentedEncryptedFileSystemStorage
+# to spread new files over subdirectories (manage.py shard_files moves the
+# others), or to vault_app.object_storage.SegmentedEncryptedS3Storage to keep
+# them in the bucket of S3_STORAGE.
+SECURED_FIELDS_FILE_STORAGE = os.getenv('FILE_STORAGE', 'vault_app.storage.SegmentedEncryptedFileSystemStorage')
+ENCRYPTED_FILE_CHUNK_SIZE = 64 * 1024
+
+# Size of the chunks clients send to an upload session, rounded down to a
+# multiple of ENCRYPTED_FILE_CHUNK_SIZE.
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_SESSION_EXPIRY_HOURS = 24
+
+# Per-process LRU of decrypted field values. SHARED_CACHE may name an entry of
+# CACHES to share them between workers; values are encrypted before they are
+# written there. MAX_SIZE 0 disables the cache.
+SECURED_FIELDS_DECRYPTION_CACHE = {
+    'MAX_SIZE': int(os.getenv('DECRYPTION_CACHE_SIZE', 10000)),
+    'TTL': int(os.getenv('DECRYPTION_CACHE_TTL', 300)),
+    'SHARED_CACHE': os.getenv('DECRYPTION_CACHE_SHARED') or None,
+}
+
+# Threads the async views (api/async/...) use for decryption and disk I/O.
+# Bounds the CPU work an ASGI worker runs at once, not the number of clients.
+ASYNC_IO_WORKERS = int(os.getenv('ASYNC_IO_WORKERS', 16))
+
+# Processes for background work on documents (previews, text extraction);
+# 0 runs it in the saving process instead.
+BACKGROUND_WORKERS = int(os.getenv('BACKGROUND_WORKERS', 2))
+
+# Longest side of document previews, in pixels.
+PREVIEW_SIZE = 256
+
+# Bytes of documents a user may store, unless User.storage_quota says
+# otherwise; unset for no limit.
+STORAGE_QUOTA = int(os.environ['STORAGE_QUOTA']) if os.getenv('STORAGE_QUOTA') else None
+
+# Serialized folder, tag and document listings, keyed by the owner's vault
+# version (see vault_app/versions.py). Local memory per process by default;
+# set REDIS_URL to share them between workers. VAULT_LIST_CACHE names the
+# entry of CACHES to use, empty to disable the cache.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'vault_lists': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'vault-lists',
+        'TIMEOUT': 600,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+if os.getenv('REDIS_URL'):
+    CACHES['vault_lists'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('REDIS_URL'),
+        'TIMEOUT': 600,
+    }
+VAULT_LIST_CACHE = os.getenv('VAULT_LIST_CACHE', 'vault_lists') or None
+
+# Access tokens carry a hash of the password they were issued under, so
+# changing it signs out every session; logging out blacklists the refresh
+# token.
+SIMPLE_JWT = {
+    'CHECK_REVOKE_TOKEN': True,
+}
+
+# Per-process cache of what authentication needs of a user. Changes made in
+# another process are noticed within TTL seconds; MAX_SIZE 0 disables it.
+AUTH_USER_CACHE = {
+    'MAX_SIZE': int(os.getenv('AUTH_USER_CACHE_SIZE', 10000)),
+    'TTL': int(os.getenv('AUTH_USER_CACHE_TTL', 30)),
+}
+
+# Document files are compressed with zstd before they are encrypted, unless
+# their type or leading bytes show they are compressed already or their first
+# chunk shrinks to no less than MAX_RATIO of its size (see
+# vault_app/compression.py). Files stored before stay as they are until
+# compress_blobs is run.
+STORAGE_COMPRESSION = {
+    'ENABLED': os.getenv('STORAGE_COMPRESSION', '1') != '0',
+    'LEVEL': int(os.getenv('STORAGE_COMPRESSION_LEVEL', 3)),
+}
+
+# Request metrics in the Prometheus format on /metrics (vault_app/metrics.py).
+# Under gunicorn, set PROMETHEUS_MULTIPROC_DIR to an empty directory and pass
+# -c config/gunicorn.conf.py. When METRICS_TOKEN is set, scrapers send it as
+# a bearer token.
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+# Stack samples of requests slower than THRESHOLD seconds, written to
+# DIRECTORY in the folded format of flamegraph.pl and speedscope.
+SLOW_REQUEST_PROFILER = {
+    'ENABLED': os.getenv('SLOW_REQUEST_PROFILER') == '1',
+    'THRESHOLD': float(os.getenv('SLOW_REQUEST_PROFILER_THRESHOLD', 1.0)),
+    'INTERVAL': 0.005,
+    'DIRECTORY': os.getenv('SLOW_REQUEST_PROFILER_DIRECTORY', os.path.join(BASE_DIR, 'profiles')),
+}
+
+# Deleted folders, tags and documents stay in the sync journal this many days
+# (vault_app/journal.py); clients that have not synced for longer reload
+# everything. Run compact_sync_journal periodically, e.g. daily, to drop them.
+SYNC_JOURNAL_RETENTION_DAYS = int(os.getenv('SYNC_JOURNAL_RETENTION_DAYS', 30))
+
+# Stored files that no blob, document, preview or upload session references
+# are deleted by collect_garbage (vault_app/storage_gc.py) once they are this
+# many hours old, as are blobs no document references.
+GC_GRACE_HOURS = int(os.getenv('GC_GRACE_HOURS', 24))
+
+# Bucket of the S3 file storage (vault_app/object_storage.py). ENDPOINT_URL
+# points it at another S3 API, such as a local MinIO. Files go up in parts of
+# PART_SIZE bytes, CONCURRENCY at a time, over a pool of MAX_POOL_CONNECTIONS
+# connections per process; reads fetch at least READ_SIZE bytes at a time.
+S3_STORAGE = {
+    'BUCKET': os.getenv('S3_BUCKET'),
+    'ENDPOINT_URL': os.getenv('S3_ENDPOINT_URL'),
+    'REGION': os.getenv('S3_REGION'),
+    'ACCESS_KEY_ID': os.getenv('S3_ACCESS_KEY_ID'),
+    'SECRET_ACCESS_KEY': os.getenv('S3_SECRET_ACCESS_KEY'),
+    'PREFIX': os.getenv('S3_PREFIX', ''),
+    'PART_SIZE': int(os.getenv('S3_PART_SIZE', 8 * 1024 * 1024)),
+    'CONCURRENCY': int(os.getenv('S3_CONCURRENCY', 4)),
+    'MAX_POOL_CONNECTIONS': int(os.getenv('S3_MAX_POOL_CONNECTIONS', 16)),
+    'READ_SIZE': 1024 * 1024,
+}
+
+# Routing of the reads of GET, HEAD and OPTIONS requests to the replicas of
+# DATABASES (vault_app/replicas.py). After a request that may have written,
+# the client reads from the primary for PIN_SECONDS, and at least for
+# MAX_LAG_SECONDS plus CHECK_INTERVAL, so it never reads from a replica
+# without its writes. Replicas are checked every CHECK_INTERVAL seconds and
+# left out while they fail or lag more than MAX_LAG_SECONDS behind.
+READ_REPLICAS = {
+    'ALIASES': [alias for alias in DATABASES if alias.startswith('replica')],
+    'PIN_SECONDS': int(os.getenv('READ_REPLICA_PIN_SECONDS', 5)),
+    'CHECK_INTERVAL': 5,
+    'MAX_LAG_SECONDS': int(os.getenv('READ_REPLICA_MAX_LAG_SECONDS', 10)),
+}
@@ -0,0 +1,154 @@
+"""Async download and upload-chunk views for ASGI servers.
+
+They serve the same requests as DocumentViewSet.download and
+UploadSessionViewSet.chunk, but hold no thread while a client is slow:
+metadata comes from the async ORM, and decryption and disk I/O run in a
+bounded thread pool one block at a time, so a single worker can stream to
+many clients at once.
+"""
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.http import content_disposition_header
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_http_methods
+from rest_framework.exceptions import AuthenticationFailed
+
+from . import uploads
+from .authentication import CachedJWTAuthentication
+from .models import Document, UploadSession
+from .responses import (
+    BLOCK_SIZE, FileSlice, RangeNotSatisfiable, document_etag, document_filename, range_not_satisfiable,
+    requested_range, set_file_headers,
+)
+from .serializers import UploadSessionSerializer
+
+DEFAULT_IO_WORKERS = 16
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'ASYNC_IO_WORKERS', DEFAULT_IO_WORKERS),
+            thread_name_prefix='vault-io',
+        )
+    return _executor
+
+
+async def run_io(func, *args):
+    """Run blocking file or crypto work in the I/O pool."""
+    loop = asyncio.get_running_loop()
+    # in the request's context, which the metrics are recorded in
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(get_executor(), functools.partial(context.run, func, *args))
+
+
+def _with_connection(func, *args):
+    # pool threads outlive requests, so they manage their connection like a request would
+    close_old_connections()
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+
+async def run_db(func, *args):
+    """Run blocking work that also needs the database in the I/O pool."""
+    return await run_io(_with_connection, func, *args)
+
+
+def error(detail, status, **extra):
+    return JsonResponse({'detail': detail, **extra}, status=status)
+
+
+async def authenticate(request):
+    """The active user of the request's JWT access token, or None."""
+    authentication = CachedJWTAuthentication()
+    header = authentication.get_header(request)
+    raw_token = header and authentication.get_raw_token(header)
+    if not raw_token:
+        return None
+
+    return await authentication.aget_user(authentication.get_validated_token(raw_token))
+
+
+def authenticated(view):
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        try:
+            request.user = await authenticate(request)
+        except AuthenticationFailed as e:
+            return error(e.detail, 401)
+        if request.user is None:
+            return error('Authentication credentials were not provided.', 401)
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+async def stream_slice(file_handle, start, length):
+    body = await run_io(FileSlice, file_handle, start, length)
+    try:
+        while data := await run_io(body.read, BLOCK_SIZE):
+            yield data
+    finally:
+        await run_io(body.close)
+
+
+@require_GET
+@authenticated
+async def download(request, pk):
+    try:
+        document = await Document.objects.aget(pk=pk, user=request.user)
+    except Document.DoesNotExist:
+        return error('No Document matches the given query.', 404)
+
+    file_handle = await run_io(document.file.storage.open, document.file.name)
+    size = file_handle.size
+    etag = document_etag(document)
+    try:
+        byte_range = requested_range(request, size, etag, document.updated_at)
+    except RangeNotSatisfiable:
+        await run_io(file_handle.close)
+        return range_not_satisfiable(size)
+
+    start, end = byte_range or (0, size - 1)
+    response = StreamingHttpResponse(
+        stream_slice(file_handle, start, end - start + 1 if size else 0),
+        content_type=document.file_type or 'application/octet-stream',
+    )
+    response['Content-Disposition'] = content_disposition_header(True, document_filename(document))
+    set_file_headers(response, size, byte_range, etag, document.updated_at)
+    return response
+
+
+def _store_chunk(session_pk, index, stream, length):
+    session = uploads.store_chunk(UploadSession.objects.get(pk=session_pk), index, stream, length)
+    return UploadSessionSerializer(session).data
+
+
+@csrf_exempt
+@require_http_methods(['PUT'])
+@authenticated
+async def upload_chunk(request, session_id, index):
+    if not await UploadSession.objects.filter(pk=session_id, user=request.user).aexists():
+        return error('No UploadSession matches the given query.', 404)
+
+    length = int(request.META.get('CONTENT_LENGTH') or 0)
+    try:
+        data = await run_db(_store_chunk, session_id, index, request, length)
+    except UploadSession.DoesNotExist:
+        return error('No UploadSession matches the given query.', 404)
+    except uploads.ChunkOutOfOrder as e:
+        return error(str(e), 409, next_index=e.next_index)
+    except uploads.UploadError as e:
+        return error(str(e), 400)
+    return JsonResponse(data)
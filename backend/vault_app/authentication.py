@@ -0,0 +1,136 @@
+"""JWT authentication that does not load the user on every request.
+
+Tokens are validated statelessly. What authentication needs of the user
+(whether it is active, and the password marker tokens are revoked by) is
+kept in a short-lived per-process cache, and request.user is a User whose
+other fields are deferred: they are loaded, together, only when a view
+reads one. Saving a user and logging out drop its cache entry in this
+process; other processes notice within AUTH_USER_CACHE['TTL'] seconds.
+A token the cached state rejects is checked again against the state on
+the primary, so a password changed or a user reactivated elsewhere does
+not reject the new tokens meanwhile.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+from .models import User
+
+DEFAULTS = {
+    'MAX_SIZE': 10000,
+    'TTL': 30,
+}
+
+# loaded by authentication, the other fields are deferred
+STATE_FIELDS = ('id', 'username', 'is_active', 'is_staff', 'is_superuser')
+
+_entries = OrderedDict()
+_lock = threading.Lock()
+
+
+def get_options():
+    return {**DEFAULTS, **getattr(settings, 'AUTH_USER_CACHE', {})}
+
+
+def load_state(user_id):
+    """Authentication state of the user, or None if there is none."""
+    # not from a replica, which may still have the old password
+    row = User.objects.using(DEFAULT_DB_ALIAS).filter(pk=user_id).values_list(*STATE_FIELDS, 'password').first()
+    if row is None:
+        return None
+    *values, password = row
+    return dict(zip(STATE_FIELDS, values), revoke=get_md5_hash_password(password))
+
+
+def cached_state(user_id):
+    with _lock:
+        entry = _entries.get(user_id)
+        if entry is not None and entry[1] > time.monotonic():
+            _entries.move_to_end(user_id)
+            return entry[0]
+    return None
+
+
+def store_state(user_id, state):
+    options = get_options()
+    if not options['MAX_SIZE']:
+        return
+    with _lock:
+        _entries[user_id] = (state, time.monotonic() + options['TTL'])
+        _entries.move_to_end(user_id)
+        while len(_entries) > options['MAX_SIZE']:
+            _entries.popitem(last=False)
+
+
+def invalidate(user_id):
+    with _lock:
+        _entries.pop(str(user_id), None)
+
+
+def clear():
+    with _lock:
+        _entries.clear()
+
+
+def lazy_user(state):
+    # from_db takes the loaded values in field order
+    fields = [field.attname for field in User._meta.concrete_fields if field.attname in STATE_FIELDS]
+    return User.from_db(DEFAULT_DB_ALIAS, fields, [state[field] for field in fields])
+
+
+def check(validated_token, state):
+    """The request's user from its token and cached state, or raise AuthenticationFailed."""
+    if state is None:
+        raise AuthenticationFailed('User not found', code='user_not_found')
+    if jwt_settings.CHECK_USER_IS_ACTIVE and not state['is_active']:
+        raise AuthenticationFailed('User is inactive', code='user_inactive')
+    if jwt_settings.CHECK_REVOKE_TOKEN and validated_token.get(jwt_settings.REVOKE_TOKEN_CLAIM) != state['revoke']:
+        raise AuthenticationFailed("The user's password has been changed.", code='password_changed')
+    return lazy_user(state)
+
+
+def token_user_id(validated_token):
+    # claims hold the id as a string, it is the cache key as one
+    try:
+        return str(validated_token[jwt_settings.USER_ID_CLAIM])
+    except KeyError:
+        raise InvalidToken('Token contained no recognizable user identification')
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication resolving the user from the per-process cache."""
+
+    def get_user(self, validated_token):
+        user_id = token_user_id(validated_token)
+        state = cached_state(user_id)
+        if state is not None:
+            try:
+                return check(validated_token, state)
+            except AuthenticationFailed:
+                # the user may have changed in another process since
+                invalidate(user_id)
+        state = load_state(user_id)
+        if state is not None:
+            store_state(user_id, state)
+        return check(validated_token, state)
+
+    async def aget_user(self, validated_token):
+        user_id = token_user_id(validated_token)
+        state = cached_state(user_id)
+        if state is not None:
+            try:
+                return check(validated_token, state)
+            except AuthenticationFailed:
+                invalidate(user_id)
+        state = await sync_to_async(load_state)(user_id)
+        if state is not None:
+            store_state(user_id, state)
+        return check(validated_token, state)
@@ -0,0 +1,382 @@
+"""Synthetic vaults, micro-benchmarks and API load runs for the benchmark commands.
+
+seed() fills the database with users, folders, tags and documents drawn
+from a seeded random generator, so two runs at the same scale benchmark the
+same vault. run_micro() times field and file encryption in this process;
+run_serialization() the CPU time lists of the seeded vault take to
+serialize and render, with the model serializers and JSONRenderer and with
+the fast serializers and OrjsonRenderer; run_http() drives the API of a
+running server with concurrent clients. They return plain dicts the
+benchmark command writes out as JSON.
+"""
+import asyncio
+import io
+import math
+import os
+import random
+import time
+from collections import Counter
+
+from django.contrib.auth.hashers import make_password
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+from rest_framework.renderers import JSONRenderer
+
+from . import blind_index, blobs, counters, folder_tree, signals
+from .fast_serializers import FastDocumentSerializer, FastFolderSerializer, FastTagSerializer
+from .fields import CachedDecryptionMixin
+from .models import Blob, Document, Folder, Tag, User
+from .renderers import OrjsonRenderer
+from .serializers import DocumentSerializer, FolderSerializer, TagSerializer
+from .storage import FLAG_COMPRESSED, SegmentedFile, encrypt_stream, get_chunk_size
+from .views import document_queryset
+
+DocumentTag = Document.tags.through
+
+WORDS = (
+    'invoice', 'receipt', 'passport', 'insurance', 'contract', 'statement', 'warranty', 'medical', 'tax',
+    'return', 'lease', 'payslip', 'mortgage', 'license', 'certificate', 'report', 'letter', 'bank',
+    'school', 'vehicle', 'utility', 'pension', 'travel', 'family', 'property', 'loan', 'claim', 'visa',
+)
+
+SCENARIOS = ('token', 'folders', 'documents', 'search', 'upload', 'download')
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of sorted ``values``."""
+    if not values:
+        return None
+    return values[max(0, math.ceil(len(values) * percent / 100) - 1)]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies) + errors,
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(len(latencies) / elapsed, 2) if elapsed else 0,
+        'latency_ms': {
+            label: None if value is None else round(value * 1000, 2)
+            for label, value in (
+                ('p50', percentile(latencies, 50)),
+                ('p95', percentile(latencies, 95)),
+                ('p99', percentile(latencies, 99)),
+                ('max', latencies[-1] if latencies else None),
+            )
+        },
+    }
+
+
+def synthetic_text(rng, size):
+    """``size`` bytes of CSV-like text, about as compressible as the statements vaults hold."""
+    lines = []
+    length = 0
+    while length < size:
+        line = f'{rng.randrange(10 ** 6)},{rng.choice(WORDS)},{rng.choice(WORDS)},{rng.randrange(10 ** 5) / 100}\n'
+        lines.append(line)
+        length += len(line)
+    return ''.join(lines).encode()[:size]
+
+
+def usernames(prefix, users):
+    return [f'{prefix}-{i}' for i in range(users)]
+
+
+def flush(prefix):
+    """Delete the users of an earlier seed() with ``prefix``, and everything they own."""
+    with transaction.atomic():
+        return User.objects.filter(username__startswith=f'{prefix}-').delete()[1].get(User._meta.label, 0)
+
+
+def seed(prefix='bench', users=5, folders=10, tags=10, documents=1000, file_size=16 * 1024,
+         distinct_files=20, password='benchmark', seed_value=0, batch_size=1000):
+    """Create ``users`` users, each with the given numbers of folders, tags, documents and files.
+
+    Documents share ``distinct_files`` blobs per user, so large vaults do not
+    need as many files on disk. Returns the totals created.
+    """
+    rng = random.Random(seed_value)
+    password_hash = make_password(password)
+    totals = dict.fromkeys(('users', 'folders', 'tags', 'documents', 'files'), 0)
+
+    for username in usernames(prefix, users):
+        with transaction.atomic(), signals.bulk_write():
+            user = User.objects.create(username=username, password=password_hash)
+            folder_rows = Folder.objects.bulk_create(
+                [Folder(name=f'{rng.choice(WORDS).title()} {i}', user=user) for i in range(folders)],
+            )
+            tag_rows = Tag.objects.bulk_create([Tag(name=f'{rng.choice(WORDS)}-{i}', user=user) for i in range(tags)])
+            folder_tree.attach(folder_rows)
+            blind_index.index_instances(folder_rows)
+            blind_index.index_instances(tag_rows)
+
+            stored = [
+                blobs.store(
+                    Document(user=user, file_type='text/csv'),
+                    ContentFile(synthetic_text(rng, file_size), name=f'{username}-{i}.csv'),
+                )
+                for i in range(distinct_files)
+            ]
+            references = Counter()
+            for start in range(0, documents, batch_size):
+                batch = []
+                for i in range(start, min(documents, start + batch_size)):
+                    blob = rng.choice(stored)
+                    references[blob.pk] += 1
+                    batch.append(Document(
+                        name=f'{rng.choice(WORDS).title()} {rng.choice(WORDS)} {i}', file=blob.name, blob=blob,
+                        file_type='text/csv', size=blob.size, user=user,
+                        folder=rng.choice(folder_rows) if folder_rows else None,
+                    ))
+                Document.objects.bulk_create(batch)
+                DocumentTag.objects.bulk_create(
+                    [
+                        DocumentTag(document_id=document.pk, tag_id=tag.pk)
+                        for document in batch for tag in rng.sample(tag_rows, min(2, len(tag_rows)))
+                    ],
+                    batch_size=batch_size,
+                )
+                blind_index.index_instances(batch)
+
+            for blob in stored:
+                Blob.objects.filter(pk=blob.pk).update(ref_count=references[blob.pk])
+            Blob.objects.filter(pk__in=[blob.pk for blob in stored], ref_count=0).delete()
+
+        for key, count in (('users', 1), ('folders', folders), ('tags', tags), ('documents', documents),
+                           ('files', len(references))):
+            totals[key] += count
+
+    counters.reconcile()
+    return totals
+
+
+def timed(function, repeat, clock=time.perf_counter):
+    started = clock()
+    for _ in range(repeat):
+        function()
+    return clock() - started
+
+
+def run_micro(iterations=2000, file_size=4 * 1024 * 1024, seed_value=0):
+    """Time field and file encryption and decryption in this process."""
+    rng = random.Random(seed_value)
+    results = {}
+
+    field = Document._meta.get_field('name')
+    value = f'{rng.choice(WORDS).title()} {rng.choice(WORDS)} statement 2024'
+    encrypted = field.get_db_prep_save(value, connection)
+    for name, function in (
+        ('field_encrypt', lambda: field.get_db_prep_save(value, connection)),
+        # past the decryption cache, which the cached case hits every time
+        ('field_decrypt', lambda: super(CachedDecryptionMixin, field).decrypt(encrypted)),
+        ('field_decrypt_cached', lambda: field.from_db_value(encrypted, None, connection)),
+    ):
+        elapsed = timed(function, iterations)
+        results[name] = {'operations': iterations, 'seconds': round(elapsed, 4),
+                         'operations_per_second': round(iterations / elapsed, 1)}
+
+    chunk_size = get_chunk_size()
+    for kind, data in (('text', synthetic_text(rng, file_size)), ('random', os.urandom(file_size))):
+        for flags, label in ((0, 'plain'), (FLAG_COMPRESSED, 'compressed')):
+            chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+            started = time.perf_counter()
+            stored = b''.join(encrypt_stream(chunks, flags=flags))
+            encrypt_seconds = time.perf_counter() - started
+
+            started = time.perf_counter()
+            with SegmentedFile(io.BytesIO(stored)) as plaintext:
+                while plaintext.read(chunk_size):
+                    pass
+            decrypt_seconds = time.perf_counter() - started
+
+            megabytes = file_size / 1024 / 1024
+            results[f'file_{kind}_{label}'] = {
+                'bytes': file_size,
+                'stored_bytes': len(stored),
+                'encrypt_mb_per_second': round(megabytes / encrypt_seconds, 1),
+                'decrypt_mb_per_second': round(megabytes / decrypt_seconds, 1),
+            }
+    return results
+
+
+def run_serialization(prefix='bench', repeat=5):
+    """CPU time per 1000 rows the lists of the largest seeded vault take, before and after the fast serializers.
+
+    Each list is read, serialized and rendered whole, as the list endpoints
+    do a page at a time, without the HTTP handling around it.
+    """
+    user = User.objects.filter(username__startswith=f'{prefix}-').order_by('-document_count').first()
+    if user is None:
+        return {}
+
+    results = {}
+    for name, queryset, serializer_class, fast_serializer_class in (
+        ('documents', document_queryset(), DocumentSerializer, FastDocumentSerializer),
+        ('folders', Folder.objects.all(), FolderSerializer, FastFolderSerializer),
+        ('tags', Tag.objects.all(), TagSerializer, FastTagSerializer),
+    ):
+        queryset = queryset.filter(user=user).order_by('-created_at', '-id')
+        rows = queryset.count()
+        if not rows:
+            continue
+        runs = {
+            'model_serializer': lambda: JSONRenderer().render(serializer_class(queryset.all(), many=True).data),
+            'fast_serializer': lambda: OrjsonRenderer().render(
+                fast_serializer_class(fast_serializer_class.rows(queryset)).data,
+            ),
+        }
+        results[name] = {'rows': rows}
+        for label, function in runs.items():
+            # fills the decryption cache, which the endpoints keep warm
+            function()
+            seconds = timed(function, repeat, clock=time.process_time)
+            results[name][label] = {'cpu_ms_per_1k_rows': round(seconds / repeat / rows * 1000 * 1000, 3)}
+        before, after = (results[name][label]['cpu_ms_per_1k_rows'] for label in runs)
+        results[name]['speedup'] = round(before / after, 2) if after else None
+    return results
+
+
+def vault_fixtures(prefix, users):
+    """Per seeded user, its id and the ids of its folders and documents, for the load run."""
+    fixtures = []
+    for user_id, username in User.objects.filter(username__in=usernames(prefix, users)).values_list('pk', 'username'):
+        fixtures.append({
+            'username': username,
+            'folders': list(Folder.objects.filter(user_id=user_id).values_list('pk', flat=True)),
+            'documents': list(Document.objects.filter(user_id=user_id).values_list('pk', flat=True)),
+        })
+    return fixtures
+
+
+class LoadRun:
+    """Concurrent clients against a running server, each acting as one of the seeded users."""
+
+    def __init__(self, httpx, url, fixtures, password, clients, requests, file_size, timeout, seed_value=0):
+        self.httpx = httpx
+        self.url = url.rstrip('/')
+        self.fixtures = fixtures
+        self.password = password
+        self.clients = clients
+        self.requests = requests
+        self.file_size = file_size
+        self.timeout = timeout
+        self.rng = random.Random(seed_value)
+        self.tokens = {}
+        self.uploaded = []
+
+    async def run(self, scenarios):
+        limits = self.httpx.Limits(max_connections=self.clients, max_keepalive_connections=self.clients)
+        async with self.httpx.AsyncClient(base_url=self.url, limits=limits, timeout=self.timeout) as client:
+            for fixture in self.fixtures:
+                response = await self.token(client, fixture)
+                response.raise_for_status()
+                self.tokens[fixture['username']] = response.json()['access']
+
+            results = {}
+            for scenario in scenarios:
+                results[scenario] = await self.run_scenario(client, getattr(self, scenario))
+        return results
+
+    async def run_scenario(self, client, request):
+        latencies = []
+        errors = 0
+        remaining = self.requests
+
+        async def worker(index):
+            nonlocal errors, remaining
+            fixture = self.fixtures[index % len(self.fixtures)]
+            while remaining > 0:
+                remaining -= 1
+                started = time.perf_counter()
+                try:
+                    response = await request(client, fixture)
+                except self.httpx.HTTPError:
+                    errors += 1
+                    continue
+                if response.status_code >= 400:
+                    errors += 1
+                else:
+                    latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[worker(index) for index in range(self.clients)])
+        return summarize(latencies, errors, time.perf_counter() - started)
+
+    def headers(self, fixture):
+        return {'Authorization': f'Bearer {self.tokens[fixture["username"]]}'}
+
+    async def token(self, client, fixture):
+        return await client.post('/api/token/', json={'username': fixture['username'], 'password': self.password})
+
+    async def folders(self, client, fixture):
+        return await client.get('/api/folders/', headers=self.headers(fixture))
+
+    async def documents(self, client, fixture):
+        return await client.get('/api/documents/', headers=self.headers(fixture))
+
+    async def search(self, client, fixture):
+        return await client.get('/api/documents/', params={'search': self.rng.choice(WORDS)},
+                                headers=self.headers(fixture))
+
+    async def upload(self, client, fixture):
+        # distinct content, so every upload stores a new blob
+        content = f'{len(self.uploaded)}\n'.encode() + synthetic_text(self.rng, self.file_size)
+        data = {'name': f'Upload {self.rng.choice(WORDS)}'}
+        if fixture['folders']:
+            data['folder'] = str(self.rng.choice(fixture['folders']))
+        response = await client.post(
+            '/api/documents/', data=data, files={'file': ('upload.csv', content, 'text/csv')},
+            headers=self.headers(fixture),
+        )
+        if response.status_code == 201:
+            self.uploaded.append(response.json()['id'])
+        return response
+
+    async def download(self, client, fixture):
+        pk = self.rng.choice(fixture['documents'])
+        async with client.stream('GET', f'/api/documents/{pk}/download/', headers=self.headers(fixture)) as response:
+            async for _ in response.aiter_bytes(64 * 1024):
+                pass
+        return response
+
+
+def run_http(httpx, url, fixtures, scenarios=SCENARIOS, password='benchmark', clients=10, requests=200,
+             file_size=16 * 1024, timeout=60, seed_value=0):
+    """Run each of ``scenarios`` against the server at ``url``; returns their results and the uploaded ids."""
+    load_run = LoadRun(httpx, url, fixtures, password, clients, requests, file_size, timeout, seed_value)
+    results = asyncio.run(load_run.run(scenarios))
+    return results, load_run.uploaded
+
+
+# metrics compared between runs, and whether higher values are better
+COMPARED = {
+    'requests_per_second': True,
+    'p95': False,
+    'p99': False,
+    'operations_per_second': True,
+    'encrypt_mb_per_second': True,
+    'decrypt_mb_per_second': True,
+    'cpu_ms_per_1k_rows': False,
+}
+
+
+def compare(baseline, results, tolerance=0.2):
+    """Messages for the metrics of ``results`` more than ``tolerance`` worse than in ``baseline``."""
+    regressions = []
+
+    def walk(path, old, new):
+        for key, value in new.items():
+            if key not in old:
+                continue
+            if isinstance(value, dict) and isinstance(old[key], dict):
+                walk(f'{path}.{key}', old[key], value)
+            elif key in COMPARED and value is not None and old[key]:
+                change = (value - old[key]) / old[key]
+                worse = -change if COMPARED[key] else change
+                if worse > tolerance:
+                    regressions.append(f'{path}.{key}: {old[key]} -> {value} ({change:+.0%})')
+
+    for section in ('micro', 'serialization', 'http'):
+        walk(section, baseline.get(section) or {}, results.get(section) or {})
+    return regressions
@@ -0,0 +1,151 @@
+import hashlib
+import hmac
+import re
+import threading
+import unicodedata
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+
+from .models import BlindIndexToken
+
+# Terms shorter than a trigram are matched against word prefixes instead.
+PREFIX_LENGTH = 2
+TRIGRAM_LENGTH = 3
+
+_key = None
+_state = threading.local()
+
+
+def get_index_key():
+    """Key used for the HMAC tokens.
+
+    Falls back to a key derived from SECURED_FIELDS_KEY so the index never
+    shares raw key material with the field encryption.
+    """
+    global _key
+
+    if _key is None:
+        key = getattr(settings, 'BLIND_INDEX_KEY', None)
+        if not key:
+            fernet_key = settings.SECURED_FIELDS_KEY
+            if isinstance(fernet_key, (list, tuple)):
+                fernet_key = fernet_key[0]
+            key = hmac.new(fernet_key.encode(), b'vault_app.blind_index', hashlib.sha256).hexdigest()
+        _key = key.encode()
+
+    return _key
+
+
+def normalize(value):
+    value = unicodedata.normalize('NFKC', str(value)).casefold()
+    return ' '.join(value.split())
+
+
+def words(value):
+    return re.findall(r'\w+', normalize(value))
+
+
+def make_token(user_id, model, field, kind, text):
+    message = f'{user_id}:{model}:{field}:{kind}:{text}'.encode()
+    return hmac.new(get_index_key(), message, hashlib.sha256).hexdigest()[:32]
+
+
+def trigrams(word):
+    return {word[i:i + TRIGRAM_LENGTH] for i in range(len(word) - TRIGRAM_LENGTH + 1)}
+
+
+def value_tokens(user_id, model, field, value):
+    """All tokens stored for a plaintext value."""
+    tokens = {make_token(user_id, model, field, 'e', normalize(value))}
+    for word in words(value):
+        for length in range(1, min(len(word), PREFIX_LENGTH) + 1):
+            tokens.add(make_token(user_id, model, field, 'p', word[:length]))
+        for gram in trigrams(word):
+            tokens.add(make_token(user_id, model, field, 't', gram))
+    return tokens
+
+
+def term_tokens(user_id, model, field, term):
+    """Tokens that all have to be present for a row to contain ``term``."""
+    tokens = set()
+    for word in words(term):
+        if len(word) < TRIGRAM_LENGTH:
+            tokens.add(make_token(user_id, model, field, 'p', word))
+        else:
+            tokens.update(make_token(user_id, model, field, 't', gram) for gram in trigrams(word))
+    return tokens
+
+
+def exact_token(user_id, model, field, value):
+    return make_token(user_id, model, field, 'e', normalize(value))
+
+
+def model_key(model):
+    return model._meta.model_name
+
+
+def index_instances(instances):
+    """Rebuild the tokens of the given instances (all of the same model)."""
+    instances = [instance for instance in instances if instance.pk is not None]
+    if not instances:
+        return
+
+    model = type(instances[0])
+    key = model_key(model)
+    rows = []
+    for instance in instances:
+        for field in model.blind_index_fields:
+            value = getattr(instance, field)
+            if not value:
+                continue
+            for token in value_tokens(instance.user_id, key, field, value):
+                rows.append(BlindIndexToken(
+                    user_id=instance.user_id, model=key, object_id=instance.pk, token=token,
+                ))
+
+    with transaction.atomic():
+        BlindIndexToken.objects.filter(model=key, object_id__in=[instance.pk for instance in instances]).delete()
+        BlindIndexToken.objects.bulk_create(rows, batch_size=1000)
+
+
+def index_instance(instance):
+    index_instances([instance])
+
+
+def unindex_instance(instance):
+    unindex_ids(type(instance), [instance.pk])
+
+
+def unindex_ids(model, ids):
+    BlindIndexToken.objects.filter(model=model_key(model), object_id__in=ids).delete()
+
+
+@contextmanager
+def suspended():
+    """Skip indexing instances as they are saved or deleted, for bulk paths that index in batches."""
+    previous = is_suspended()
+    _state.suspended = True
+    try:
+        yield
+    finally:
+        _state.suspended = previous
+
+
+def is_suspended():
+    return getattr(_state, 'suspended', False)
+
+
+def matching_ids(user_id, model, tokens):
+    """Ids of ``model`` rows owning every one of ``tokens``, as a subquery."""
+    tokens = set(tokens)
+    return (
+        BlindIndexToken.objects
+        .filter(user_id=user_id, model=model_key(model), token__in=tokens)
+        .values('object_id')
+        .annotate(matched=Count('token', distinct=True))
+        .filter(matched=len(tokens))
+        .values('object_id')
+    )
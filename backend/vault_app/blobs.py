@@ -0,0 +1,142 @@
+"""Content-addressed, reference-counted storage of document files.
+
+A user's distinct plaintexts are stored once each, as Blobs identified by
+HMAC-SHA256, under a key derived for that user, of the plaintext's SHA-256.
+Documents with equal content point at the same blob, and the blob and its
+file go away with the last reference.
+"""
+import hashlib
+import hmac
+import os
+from collections import Counter
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .blind_index import get_index_key
+from .models import Blob, Document, Preview
+from .storage import SegmentedFile
+
+BLOCK_SIZE = 1024 * 1024
+
+
+def user_key(user_id):
+    return hmac.new(get_index_key(), f'vault_app.blobs:{user_id}'.encode(), hashlib.sha256).digest()
+
+
+def keyed_digest(user_id, sha256):
+    """Digest of the plaintext whose SHA-256 is the hex string ``sha256``."""
+    return hmac.new(user_key(user_id), bytes.fromhex(sha256), hashlib.sha256).hexdigest()
+
+
+def content_sha256(content):
+    sha256 = hashlib.sha256()
+    for data in content.chunks(BLOCK_SIZE):
+        sha256.update(data)
+    return sha256.hexdigest()
+
+
+def encrypted_sha256(path):
+    """SHA-256 of the plaintext of the segmented file at ``path``."""
+    sha256 = hashlib.sha256()
+    with SegmentedFile(open(path, 'rb')) as plaintext:
+        while data := plaintext.read(BLOCK_SIZE):
+            sha256.update(data)
+    return sha256.hexdigest()
+
+
+def content_digest(document):
+    """Digest of the document's content; documents stored before blobs use their file name."""
+    if document.blob_id:
+        return document.blob.digest
+    return hashlib.sha256(document.file.name.encode()).hexdigest()
+
+
+def file_storage():
+    return Document._meta.get_field('file').storage
+
+
+def acquire(user_id, digest, size=None):
+    """Take a reference to the user's blob with ``digest``, or return None if there is none."""
+    blobs = Blob.objects.filter(user_id=user_id, digest=digest)
+    if size is not None:
+        blobs = blobs.filter(size=size)
+    with transaction.atomic():
+        if not blobs.update(ref_count=F('ref_count') + 1):
+            return None
+        return blobs.get()
+
+
+def _create(document, filename, digest, size, save):
+    """Store the file with ``save(name)`` and add its blob, unless another upload just did."""
+    name = save(Document._meta.get_field('file').generate_filename(document, filename))
+    try:
+        with transaction.atomic():
+            return Blob.objects.create(
+                user_id=document.user_id, digest=digest, name=name, size=size,
+                stored_size=file_storage().size(name), ref_count=1,
+            )
+    except IntegrityError:
+        file_storage().delete(name)
+    return acquire(document.user_id, digest)
+
+
+def store(document, content):
+    """Blob holding ``content``, the uncommitted upload of ``document``, with a reference taken."""
+    digest = keyed_digest(document.user_id, content_sha256(content))
+    field = Document._meta.get_field('file')
+    return acquire(document.user_id, digest) or _create(
+        document, content.name, digest, content.size,
+        lambda name: field.storage.save_document(name, content, document.file_type, max_length=field.max_length),
+    )
+
+
+def store_encrypted(document, filename, path, digest, size):
+    """Like store() for an already encrypted segmented file, which is moved into storage."""
+    blob = acquire(document.user_id, digest)
+    if blob is not None:
+        os.unlink(path)
+        return blob
+
+    field = Document._meta.get_field('file')
+    return _create(
+        document, filename, digest, size,
+        lambda name: field.storage.save_encrypted(
+            name, path, max_length=field.max_length, file_type=document.file_type,
+        ),
+    )
+
+
+def release(blob_ids):
+    """Drop one reference per occurrence of an id in ``blob_ids``, deleting unreferenced blobs."""
+    counts = Counter(blob_id for blob_id in blob_ids if blob_id is not None)
+    if not counts:
+        return
+
+    by_count = {}
+    for blob_id, count in counts.items():
+        by_count.setdefault(count, []).append(blob_id)
+
+    with transaction.atomic():
+        for count, ids in by_count.items():
+            Blob.objects.filter(pk__in=ids).update(ref_count=F('ref_count') - count)
+        # files are removed by the post_delete handler once this commits
+        Blob.objects.filter(pk__in=counts, ref_count=0).delete()
+
+
+def delete_file(blob):
+    transaction.on_commit(lambda: file_storage().delete(blob.name))
+
+
+def rename_file(storage, name, new_name):
+    """Point the rows naming the stored file ``name`` at its copy ``new_name``; returns whether any did.
+
+    The old file is deleted once that commits, or the copy if no row names the file anymore.
+    """
+    with transaction.atomic():
+        renamed = Blob.objects.filter(name=name).update(name=new_name)
+        renamed += Document.all_objects.filter(file=name).update(file=new_name)
+        renamed += Preview.objects.filter(file=name).update(file=new_name)
+        unlinked = name if renamed else new_name
+        transaction.on_commit(lambda: storage.delete(unlinked))
+    return bool(renamed)
@@ -0,0 +1,176 @@
+import os
+
+from django.db import transaction
+from django.utils import timezone
+
+from . import blind_index, blobs, content_index, counters, journal, previews, signals
+from .models import Document, DocumentContent, Folder, Tag
+
+DocumentTag = Document.tags.through
+
+
+def _owned(user, ids, *fields):
+    """Lock the documents among ``ids`` owned by ``user``.
+
+    Returns their ids, their ``fields`` by id, and the per-item result of
+    the others. Call it in the transaction that changes them, so they cannot
+    change or go before it commits.
+    """
+    ids = list(dict.fromkeys(ids))
+    documents = Document.objects.select_for_update().filter(user=user, pk__in=ids).order_by('pk')
+    rows = {row[0]: row[1:] for row in documents.values_list('pk', *fields)}
+    missing = [{'id': pk, 'status': 'not_found'} for pk in ids if pk not in rows]
+    return [pk for pk in ids if pk in rows], rows, missing
+
+
+def move(user, ids, folder):
+    with transaction.atomic():
+        found, rows, results = _owned(user, ids, 'folder_id', 'size')
+        moved = [rows[pk] for pk in found]
+        Document.objects.filter(pk__in=found).update(folder=folder, updated_at=timezone.now())
+        counters.update(
+            folders=[(folder_id, -1, -size) for folder_id, size in moved]
+            + [(folder.pk, 1, size) for _, size in moved],
+            users=[(user.pk, 0, 0)],
+        )
+        journal.record(user.pk, changed={Document: found, Folder: [folder_id for folder_id, _ in moved] + [folder.pk]})
+    return [{'id': pk, 'status': 'moved'} for pk in found] + results
+
+
+def retag(user, ids, add=(), remove=()):
+    add = [tag.pk for tag in add]
+    remove = [tag.pk for tag in remove]
+
+    with transaction.atomic():
+        found, rows, results = _owned(user, ids, 'size')
+        removed = []
+        if remove:
+            links = DocumentTag.objects.filter(document_id__in=found, tag_id__in=remove)
+            removed = list(links.values_list('tag_id', 'document__size'))
+            links.delete()
+        added = []
+        if add:
+            # only the links that do not exist yet are counted
+            existing = set(
+                DocumentTag.objects.filter(document_id__in=found, tag_id__in=add).values_list('document_id', 'tag_id')
+            )
+            added = [(pk, tag_id) for pk in found for tag_id in add if (pk, tag_id) not in existing]
+            DocumentTag.objects.bulk_create(
+                [DocumentTag(document_id=pk, tag_id=tag_id) for pk, tag_id in added],
+                ignore_conflicts=True,
+                batch_size=1000,
+            )
+        Document.objects.filter(pk__in=found).update(updated_at=timezone.now())
+        counters.update(
+            tags=[(tag_id, -1, -size) for tag_id, size in removed]
+            + [(tag_id, 1, rows[pk][0]) for pk, tag_id in added],
+        )
+        journal.record(user.pk, changed={Document: found, Tag: remove + add})
+    return [{'id': pk, 'status': 'updated'} for pk in found] + results
+
+
+def remove(ids):
+    """Delete the rows of documents ``ids`` with their index entries and blob references; returns their rows.
+
+    Counters and the journal are left to the caller. Run it in a transaction
+    with signals.bulk_write().
+    """
+    rows = list(Document.all_objects.filter(pk__in=ids).values_list('blob_id', 'folder_id', 'size'))
+    contents = list(DocumentContent.objects.filter(document_id__in=ids).exclude(terms=b''))
+    Document.all_objects.filter(pk__in=ids).delete()
+    blind_index.unindex_ids(Document, ids)
+    blobs.release([blob_id for blob_id, _, _ in rows])
+    content_index.unindex(contents)
+    return rows
+
+
+def delete(user, ids):
+    with transaction.atomic(), signals.bulk_write():
+        found, _, results = _owned(user, ids)
+        tag_pairs = counters.tag_pairs(found)
+        rows = remove(found)
+        counters.update(
+            folders=[(folder_id, -1, -size) for _, folder_id, size in rows],
+            tags=[(tag_id, -1, -size) for tag_id, size in tag_pairs],
+            users=[(user.pk, -len(rows), -sum(size for _, _, size in rows))],
+        )
+        journal.record(
+            user.pk,
+            changed={Folder: [folder_id for _, folder_id, _ in rows], Tag: [tag_id for tag_id, _ in tag_pairs]},
+            deleted={Document: found},
+        )
+    return [{'id': pk, 'status': 'deleted'} for pk in found] + results
+
+
+def hide(user_id, documents, folder_ids=()):
+    """Soft-delete ``documents`` of the user, and the folders ``folder_ids`` they are in; returns the documents' ids.
+
+    They leave the counters and the journal at once, their rows and files
+    stay for the reaper. Folders that are deleted are not counted down.
+    """
+    with transaction.atomic():
+        documents = documents.filter(user_id=user_id).select_for_update(of=('self',))
+        rows = list(documents.values_list('pk', 'folder_id', 'size'))
+        ids = [pk for pk, _, _ in rows]
+        tag_pairs = counters.tag_pairs(ids)
+        now = timezone.now()
+        Folder.objects.filter(pk__in=folder_ids).update(deleted_at=now)
+        for start in range(0, len(ids), 1000):
+            Document.objects.filter(pk__in=ids[start:start + 1000]).update(deleted_at=now)
+        deleted = set(folder_ids)
+        counters.update(
+            folders=[(folder_id, -1, -size) for _, folder_id, size in rows if folder_id not in deleted],
+            tags=[(tag_id, -1, -size) for tag_id, size in tag_pairs],
+            users=[(user_id, -len(rows), -sum(size for _, _, size in rows))],
+        )
+        journal.record(
+            user_id,
+            changed={
+                Folder: {folder_id for _, folder_id, _ in rows} - deleted,
+                Tag: [tag_id for tag_id, _ in tag_pairs],
+            },
+            deleted={Folder: folder_ids, Document: ids},
+        )
+    return ids
+
+
+def upload(user, files, folder, tags=()):
+    """Store ``files`` and create their documents with one insert per table."""
+    documents = []
+    try:
+        for uploaded in files:
+            document = Document(
+                name=os.path.splitext(uploaded.name)[0] or uploaded.name,
+                file_type=uploaded.content_type or '',
+                size=uploaded.size,
+                user=user,
+                folder=folder,
+            )
+            document.blob = blobs.store(document, uploaded)
+            document.file.name = document.blob.name
+            documents.append(document)
+
+        with transaction.atomic():
+            counters.check_quota(user, sum(document.size for document in documents))
+            Document.objects.bulk_create(documents, batch_size=500)
+            DocumentTag.objects.bulk_create(
+                [DocumentTag(document_id=document.pk, tag_id=tag.pk) for document in documents for tag in tags],
+                batch_size=1000,
+            )
+            blind_index.index_instances(documents)
+            previews.enqueue(documents)
+            content_index.enqueue(documents)
+            count, size = len(documents), sum(document.size for document in documents)
+            counters.update(
+                folders=[(folder.pk, count, size)],
+                tags=[(tag.pk, count, size) for tag in tags],
+                users=[(user.pk, count, size)],
+            )
+            journal.record(user.pk, changed={
+                Document: [document.pk for document in documents], Folder: [folder.pk], Tag: [tag.pk for tag in tags],
+            })
+    except Exception:
+        blobs.release([document.blob_id for document in documents])
+        raise
+
+    return [{'id': document.pk, 'name': document.name, 'status': 'created'} for document in documents]
@@ -0,0 +1,78 @@
+"""Which document files are compressed before they are encrypted.
+
+Ciphertext does not compress, so storage.py compresses files chunk by chunk
+with zstd before encrypting them. Files whose type or leading bytes show
+they are compressed already are stored as they are, and so are files whose
+first chunk barely shrinks; chunks that do not shrink are stored raw even in
+compressed files. Blob.stored_size against Blob.size records the ratio.
+"""
+import zstandard
+from django.conf import settings
+
+DEFAULTS = {
+    'ENABLED': True,
+    'LEVEL': 3,
+    # smaller files are not worth the trailer of a compressed file
+    'MIN_SIZE': 1024,
+    # the first chunk has to compress to at most this share of its size
+    'MAX_RATIO': 0.9,
+}
+
+# media types of compressed formats, or their prefixes
+COMPRESSED_TYPES = (
+    'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/avif', 'image/heic', 'image/heif',
+    'video/', 'audio/mpeg', 'audio/mp4', 'audio/aac', 'audio/ogg', 'audio/flac', 'audio/webm',
+    'application/zip', 'application/gzip', 'application/x-gzip', 'application/x-bzip2', 'application/x-xz',
+    'application/zstd', 'application/x-7z-compressed', 'application/vnd.rar', 'application/x-rar-compressed',
+    'application/epub+zip', 'application/java-archive',
+    # OOXML and OpenDocument files are zip archives
+    'application/vnd.openxmlformats-officedocument.', 'application/vnd.oasis.opendocument.',
+)
+
+# leading bytes of compressed formats
+COMPRESSED_MAGIC = (
+    b'\xff\xd8\xff',  # JPEG
+    b'\x89PNG\r\n\x1a\n',
+    b'GIF8',
+    b'PK\x03\x04',  # zip, and the formats built on it
+    b'\x1f\x8b',  # gzip
+    b'BZh',
+    b'\xfd7zXZ\x00',
+    b'\x28\xb5\x2f\xfd',  # zstd
+    b'7z\xbc\xaf\x27\x1c',
+    b'Rar!\x1a\x07',
+    b'OggS',
+    b'fLaC',
+    b'ID3',  # MP3
+    b'\x1a\x45\xdf\xa3',  # Matroska, WebM
+)
+
+
+def get_options():
+    return {**DEFAULTS, **getattr(settings, 'STORAGE_COMPRESSION', {})}
+
+
+def is_compressed_type(file_type):
+    return (file_type or '').lower().startswith(COMPRESSED_TYPES)
+
+
+def is_compressed_data(head):
+    # ISO media (MP4, MOV, HEIC, AVIF) have the box type after a length
+    return head.startswith(COMPRESSED_MAGIC) or head[4:8] == b'ftyp' or (
+        head[:4] == b'RIFF' and head[8:12] == b'WEBP'
+    )
+
+
+def should_compress(file_type, head):
+    """Whether a file of ``file_type`` starting with ``head`` (its first chunk) is worth compressing."""
+    options = get_options()
+    if not options['ENABLED'] or len(head) < options['MIN_SIZE']:
+        return False
+    if is_compressed_type(file_type) or is_compressed_data(head):
+        return False
+    compressed = zstandard.ZstdCompressor(level=options['LEVEL']).compress(head)
+    return len(compressed) <= len(head) * options['MAX_RATIO']
+
+
+def compressor():
+    return zstandard.ZstdCompressor(level=get_options()['LEVEL'])
@@ -0,0 +1,171 @@
+"""Encrypted full-text index over document contents.
+
+Saving a document's content queues a job on the worker pool that decrypts
+the file, extracts its text (plain text and PDF) and returns the keyed-HMAC
+tokens of its words, so plaintext never leaves the worker. The index is
+inverted per user: one ContentTerm row per token and document containing
+it. Each DocumentContent remembers the tokens its document is posted under,
+so a new version only inserts and deletes the postings that changed. Those
+rows belong to the document alone, so indexing costs the same however many
+other documents share its terms, and concurrent uploads do not wait on each
+other.
+
+A search counts, per document, the postings of its terms, in one query; no
+file is decrypted at query time.
+"""
+import functools
+import hashlib
+import hmac
+import logging
+import os
+
+from django.db import transaction
+from django.db.models import Count
+
+from . import versions, workers
+from .blind_index import get_index_key, words
+from .blobs import content_digest
+from .models import ContentTerm, Document, DocumentContent
+
+logger = logging.getLogger(__name__)
+
+TOKEN_SIZE = 16
+MAX_WORD_LENGTH = 64
+# extraction stops after this many characters of text
+MAX_TEXT_LENGTH = 10 * 1024 * 1024
+TEXT_EXTENSIONS = {'.txt', '.md', '.csv', '.tsv', '.json', '.xml', '.html', '.htm', '.log', '.rst'}
+BATCH_SIZE = 500
+
+
+def term_token(user_id, word):
+    message = f'{user_id}:content:{word}'.encode()
+    return hmac.new(get_index_key(), message, hashlib.sha256).digest()[:TOKEN_SIZE]
+
+
+def text_tokens(user_id, text):
+    return {term_token(user_id, word) for word in words(text) if len(word) <= MAX_WORD_LENGTH}
+
+
+def split_tokens(data):
+    data = bytes(data)
+    return {data[i:i + TOKEN_SIZE] for i in range(0, len(data), TOKEN_SIZE)}
+
+
+def content_kind(file_type, name):
+    if file_type == 'application/pdf' or name.lower().endswith('.pdf'):
+        return 'pdf'
+    if file_type.startswith('text/') or os.path.splitext(name)[1].lower() in TEXT_EXTENSIONS:
+        return 'text'
+    return None
+
+
+def extract_text(name, kind):
+    with Document._meta.get_field('file').storage.open(name) as plaintext:
+        if kind == 'text':
+            return plaintext.read(MAX_TEXT_LENGTH).decode('utf-8', errors='replace')
+
+        import pypdfium2
+
+        pdf = pypdfium2.PdfDocument(plaintext)
+        try:
+            parts = []
+            length = 0
+            for page in pdf:
+                text = page.get_textpage().get_text_bounded()
+                parts.append(text)
+                length += len(text)
+                if length >= MAX_TEXT_LENGTH:
+                    break
+            return '\n'.join(parts)
+        finally:
+            pdf.close()
+
+
+def extract_job(user_id, name, kind):
+    try:
+        return DocumentContent.INDEXED, text_tokens(user_id, extract_text(name, kind))
+    except Exception:
+        logger.exception('Extracting the text of %s failed.', name)
+        return DocumentContent.FAILED, set()
+
+
+def update_postings(user_id, document_id, added, removed):
+    """Post the document under the ``added`` tokens, and no longer under the ``removed`` ones."""
+    removed = list(removed)
+    for start in range(0, len(removed), BATCH_SIZE):
+        ContentTerm.objects.filter(document_id=document_id, token__in=removed[start:start + BATCH_SIZE]).delete()
+    ContentTerm.objects.bulk_create(
+        [ContentTerm(user_id=user_id, token=token, document_id=document_id) for token in added],
+        batch_size=BATCH_SIZE, ignore_conflicts=True,
+    )
+
+
+def finish(document_id, digest, result):
+    status, tokens = result
+    with transaction.atomic():
+        content = DocumentContent.objects.select_for_update().filter(document_id=document_id, digest=digest).first()
+        if content is None:
+            # the document was deleted or its content replaced meanwhile
+            return
+
+        previous = split_tokens(content.terms)
+        update_postings(content.user_id, document_id, added=tokens - previous, removed=previous - tokens)
+        content.terms = b''.join(sorted(tokens))
+        content.status = status
+        content.save()
+        # content searches of the user's documents have changed
+        versions.bump([content.user_id])
+
+
+def submit(user_id, document_id, name, kind, digest):
+    workers.submit(extract_job, (user_id, name, kind), functools.partial(finish, document_id, digest))
+
+
+def enqueue(documents):
+    """Queue indexing jobs for ``documents``, whose ``blob`` should be loaded."""
+    contents = []
+    jobs = []
+    cleared = []
+    for document in documents:
+        digest = content_digest(document)
+        kind = content_kind(document.file_type, document.file.name)
+        contents.append(DocumentContent(
+            document_id=document.pk, user_id=document.user_id, digest=digest,
+            status=DocumentContent.PENDING if kind else DocumentContent.UNSUPPORTED,
+        ))
+        if kind:
+            jobs.append((document.user_id, document.pk, document.file.name, kind, digest))
+        else:
+            cleared.append(document.pk)
+
+    # content without text drops the terms an earlier version was posted under
+    stale = list(DocumentContent.objects.filter(document_id__in=cleared).exclude(terms=b'')) if cleared else []
+    unindex(stale)
+    DocumentContent.objects.filter(pk__in=[content.pk for content in stale]).update(terms=b'')
+    DocumentContent.objects.bulk_create(
+        contents, update_conflicts=True, unique_fields=['document'],
+        update_fields=['digest', 'status', 'updated_at'],
+    )
+    for job in jobs:
+        transaction.on_commit(lambda job=job: submit(*job))
+
+
+def unindex(contents):
+    """Remove documents, given their DocumentContent rows, from the postings."""
+    document_ids = [content.document_id for content in contents]
+    for start in range(0, len(document_ids), BATCH_SIZE):
+        ContentTerm.objects.filter(document_id__in=document_ids[start:start + BATCH_SIZE]).delete()
+
+
+def search(user_id, text):
+    """Ids of the user's documents containing every word of ``text``, or None for an empty query."""
+    tokens = text_tokens(user_id, text)
+    if not tokens:
+        return None
+
+    # a posting per term and document, so the documents with all of them have as many
+    matches = (
+        ContentTerm.objects.filter(user_id=user_id, token__in=tokens)
+        .values('document_id').annotate(terms=Count('pk')).filter(terms=len(tokens))
+    )
+    return sorted(matches.values_list('document_id', flat=True))
@@ -0,0 +1,135 @@
+"""Materialized document counters of folders, tags and users.
+
+``document_count``, ``total_bytes`` and ``last_modified`` are updated in the
+transaction that changes the documents: by the signal handlers for single
+documents and by bulk.py for the bulk paths. reconcile() rebuilds them from
+the documents. The storage quota is checked against User.total_bytes, a
+single indexed lookup, under a lock of the user row.
+
+Bytes are the documents' plaintext sizes, whether or not their blobs are
+shared.
+"""
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Max, Q, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from rest_framework.exceptions import APIException
+
+from .models import Document, Folder, Tag, User
+
+DocumentTag = Document.tags.through
+
+# documents that are not soft-deleted, which are the ones counted
+LIVE = Q(documents__deleted_at__isnull=True)
+
+
+class QuotaExceeded(APIException):
+    status_code = 413
+    default_detail = 'Storage quota exceeded.'
+    default_code = 'quota_exceeded'
+
+
+def check_quota(user, size):
+    """Raise QuotaExceeded if ``user`` cannot store ``size`` more bytes.
+
+    Call it in the transaction that adds the bytes: the user row stays locked
+    until it commits, so concurrent uploads of the user are checked in turn.
+    """
+    # read fresh: the authenticated user comes from a cache
+    users = User.objects.select_for_update().filter(pk=user.pk)
+    quota, total_bytes = users.values_list('storage_quota', 'total_bytes').get()
+    if quota is None:
+        quota = getattr(settings, 'STORAGE_QUOTA', None)
+    if quota is not None and total_bytes + size > quota:
+        raise QuotaExceeded(f'Storing {size} more bytes would exceed the quota of {quota} bytes.')
+
+
+def _apply(model, changes, now):
+    totals = defaultdict(lambda: [0, 0])
+    for pk, count, size in changes:
+        if pk is not None:
+            totals[pk][0] += count
+            totals[pk][1] += size
+
+    # one update per distinct change, which is a single one for most operations
+    by_change = defaultdict(list)
+    for pk, (count, size) in totals.items():
+        by_change[count, size].append(pk)
+    for (count, size), pks in by_change.items():
+        model.objects.filter(pk__in=pks).update(
+            document_count=F('document_count') + count,
+            total_bytes=F('total_bytes') + size,
+            last_modified=now,
+        )
+
+
+def update(folders=(), tags=(), users=()):
+    """Add ``(pk, documents, bytes)`` changes to the counters, and touch their last_modified."""
+    folders, tags, users = list(folders), list(tags), list(users)
+    if not (folders or tags or users):
+        return
+
+    now = timezone.now()
+    # callers are usually in a transaction already, which needs no savepoint
+    with transaction.atomic(savepoint=False):
+        # users first, whose row check_quota locks before anything else
+        _apply(User, users, now)
+        _apply(Folder, folders, now)
+        _apply(Tag, tags, now)
+
+
+def tags_added(pairs, sign=1):
+    """Count ``(tag_id, size)`` pairs of new tag links, or of removed ones with ``sign`` -1."""
+    update(tags=[(tag_id, sign, sign * size) for tag_id, size in pairs])
+
+
+def tag_pairs(document_ids):
+    """``(tag_id, size)`` of every tag link of the given documents."""
+    return list(
+        DocumentTag.objects.filter(document_id__in=document_ids).values_list('tag_id', 'document__size')
+    )
+
+
+def _reconcile(model, batch_size):
+    last_pk = 0
+    total = 0
+    while True:
+        batch = list(
+            model.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size]
+        )
+        if not batch:
+            return total
+
+        with transaction.atomic():
+            # locked first, so a concurrent change either is in the sums or applies on top of them
+            list(model.objects.select_for_update().filter(pk__in=batch).values_list('pk'))
+            rows = (
+                model.objects.filter(pk__in=batch)
+                .annotate(
+                    counted=Count('documents', filter=LIVE),
+                    summed=Coalesce(Sum('documents__size', filter=LIVE), 0),
+                    modified=Max('documents__updated_at', filter=LIVE),
+                )
+                .values_list('pk', 'counted', 'summed', 'modified')
+            )
+            model.objects.bulk_update(
+                [
+                    model(pk=pk, document_count=count, total_bytes=size, last_modified=modified)
+                    for pk, count, size, modified in rows
+                ],
+                ['document_count', 'total_bytes', 'last_modified'],
+            )
+        last_pk = batch[-1]
+        total += len(batch)
+
+
+def reconcile(batch_size=500):
+    """Rebuild every counter from the documents, ``batch_size`` rows at a time."""
+    return {
+        'folders': _reconcile(Folder, batch_size),
+        'tags': _reconcile(Tag, batch_size),
+        'users': _reconcile(User, batch_size),
+    }
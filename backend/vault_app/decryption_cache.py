@@ -0,0 +1,145 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from django.conf import settings
+from django.core.cache import caches
+
+from .storage import _derive_key
+
+MISSING = object()
+
+DEFAULTS = {
+    'MAX_SIZE': 10000,
+    'TTL': 300,
+    'SHARED_CACHE': None,
+}
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class DecryptionCache:
+    """Bounded LRU of decrypted field values, keyed by a digest of their ciphertext.
+
+    Plaintext only lives in this process. When ``shared_cache`` names an entry
+    of CACHES, values are also shared through it, encrypted under a key derived
+    from SECURED_FIELDS_KEY.
+    """
+
+    def __init__(self, max_size, ttl, shared_cache=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.shared_cache = caches[shared_cache] if shared_cache else None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+
+        if self.shared_cache is not None:
+            fernet_key = settings.SECURED_FIELDS_KEY
+            if isinstance(fernet_key, (list, tuple)):
+                fernet_key = fernet_key[0]
+            self.cipher = AESGCM(_derive_key(fernet_key, info=b'vault_app.decryption-cache'))
+
+    @staticmethod
+    def digest(ciphertext):
+        return hashlib.sha256(ciphertext.encode()).hexdigest()
+
+    def get(self, ciphertext):
+        if not self.max_size:
+            return MISSING
+
+        key = self.digest(ciphertext)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        if self.shared_cache is not None:
+            value = self.get_shared(key)
+            if value is not MISSING:
+                self.shared_hits += 1
+                self.store(key, value)
+                return value
+
+        return MISSING
+
+    def set(self, ciphertext, value):
+        if not self.max_size:
+            return
+
+        key = self.digest(ciphertext)
+        self.store(key, value)
+        if self.shared_cache is not None:
+            self.set_shared(key, value)
+
+    def store(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def get_shared(self, key):
+        token = self.shared_cache.get(f'vault_app:decrypted:{key}')
+        if token is None:
+            return MISSING
+        try:
+            data = self.cipher.decrypt(token[:12], token[12:], key.encode())
+        except InvalidTag:
+            return MISSING
+        return self.decode(data)
+
+    def set_shared(self, key, value):
+        nonce = os.urandom(12)
+        token = nonce + self.cipher.encrypt(nonce, self.encode(value), key.encode())
+        self.shared_cache.set(f'vault_app:decrypted:{key}', token, self.ttl)
+
+    @staticmethod
+    def encode(value):
+        # values are either str or bytes, the first byte tells which
+        if isinstance(value, bytes):
+            return b'b' + value
+        return b's' + value.encode()
+
+    @staticmethod
+    def decode(data):
+        if data[:1] == b'b':
+            return data[1:]
+        return data[1:].decode()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = self.shared_hits = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'shared_hits': self.shared_hits,
+            }
+
+
+def get_decryption_cache():
+    global _cache
+
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                options = {**DEFAULTS, **getattr(settings, 'SECURED_FIELDS_DECRYPTION_CACHE', {})}
+                _cache = DecryptionCache(options['MAX_SIZE'], options['TTL'], options['SHARED_CACHE'])
+    return _cache
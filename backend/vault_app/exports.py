@@ -0,0 +1,172 @@
+"""ZIP exports of a folder or of the whole vault, built while they are sent.
+
+The archive is written by zipfile into a buffer that is drained after every
+block, so an export holds one block of one file in memory whatever its size:
+files are decrypted block by block as the client reads, and a slow client
+slows the export down. Entries are stored, not deflated, since most of a
+vault is compressed already; sizes and CRCs follow each entry in a data
+descriptor, and ZIP64 records allow archives and files over 4 GB.
+
+Browsers cannot send the access token when they navigate to a download, so
+export links carry a short-lived signature of the user instead (see
+ExportLinkAuthentication).
+"""
+import io
+import posixpath
+import re
+import zipfile
+
+from django.core import signing
+from django.db import DEFAULT_DB_ALIAS
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.http import content_disposition_header
+from rest_framework.authentication import BaseAuthentication
+from rest_framework.exceptions import AuthenticationFailed
+
+from .models import Document, User
+from .responses import BLOCK_SIZE, document_filename
+
+LINK_SALT = 'vault_app.exports'
+LINK_MAX_AGE = 60
+
+# the earliest time a ZIP entry can carry
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
+
+class ZipBuffer(io.RawIOBase):
+    """Unseekable file collecting what zipfile writes until it is drained."""
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts.clear()
+        return data
+
+
+def safe_name(name, default='Untitled'):
+    """``name`` as one path component of an archive."""
+    name = re.sub(r'[\x00-\x1f/\\]+', '_', name or '').strip().strip('.')
+    return name or default
+
+
+def unique_name(name, taken):
+    """``name``, or ``name (2)``, ``name (3)``... whichever ``taken`` does not hold yet; adds it."""
+    stem, ext = posixpath.splitext(name)
+    candidate, number = name, 1
+    while candidate.lower() in taken:
+        number += 1
+        candidate = f'{stem} ({number}){ext}'
+    taken.add(candidate.lower())
+    return candidate
+
+
+def archive_entries(documents, folders=None, root=None):
+    """``(archive name, document)`` of ``documents``, in a stable order.
+
+    With ``folders``, a dict of folder id to ``(name, parent id)``, documents
+    are put in directories nested like their folders below ``root``, whose
+    own documents are at the top; otherwise they are all at the top.
+    """
+    taken = set()
+    directories = {root: ''}
+
+    def directory(folder_id):
+        # folders are named when their first document is, parents first
+        chain = []
+        while folder_id not in directories:
+            chain.append(folder_id)
+            folder_id = folders[folder_id][1]
+        for folder_id in reversed(chain):
+            name, parent_id = folders[folder_id]
+            directories[folder_id] = unique_name(directories[parent_id] + safe_name(name), taken) + '/'
+        return directories[folder_id]
+
+    entries = []
+    for document in sorted(documents, key=lambda document: document.pk):
+        prefix = directory(document.folder_id) if folders is not None else ''
+        entries.append((unique_name(prefix + safe_name(document_filename(document)), taken), document))
+    return entries
+
+
+def zip_info(name, modified):
+    date_time = timezone.localtime(modified).timetuple()[:6] if modified else ZIP_EPOCH
+    info = zipfile.ZipInfo(name, date_time=max(date_time, ZIP_EPOCH))
+    info.compress_type = zipfile.ZIP_STORED
+    info.external_attr = 0o644 << 16
+    return info
+
+
+def zip_stream(entries):
+    """Yield a ZIP archive of ``(name, document)`` entries, decrypting one block at a time."""
+    buffer = ZipBuffer()
+    with zipfile.ZipFile(buffer, 'w', allowZip64=True) as archive:
+        for name, document in entries:
+            storage = document.file.storage
+            with storage.open(document.file.name) as source, \
+                    archive.open(zip_info(name, document.updated_at), 'w', force_zip64=True) as target:
+                while data := source.read(BLOCK_SIZE):
+                    target.write(data)
+                    yield buffer.drain()
+            yield buffer.drain()
+    yield buffer.drain()
+
+
+def export_response(documents, filename, folders=None, root=None):
+    response = StreamingHttpResponse(
+        (data for data in zip_stream(archive_entries(documents, folders, root)) if data),
+        content_type='application/zip',
+    )
+    response['Content-Disposition'] = content_disposition_header(True, filename)
+    response['Cache-Control'] = 'private, no-store'
+    return response
+
+
+def export_documents(user, folder=None):
+    """The documents to export, those of ``folder`` and its subfolders if given, with what zip_stream() reads."""
+    documents = Document.objects.filter(user=user).only('id', 'name', 'file', 'folder_id', 'updated_at')
+    if folder is not None:
+        documents = documents.filter(folder__ancestor_links__ancestor=folder)
+    return list(documents)
+
+
+def sign_link(user, path):
+    """``path`` with a signature authenticating ``user`` for LINK_MAX_AGE seconds."""
+    signature = signing.dumps({'user': user.pk, 'path': path}, salt=LINK_SALT)
+    return f'{path}?signature={signature}'
+
+
+class ExportLinkAuthentication(BaseAuthentication):
+    """Authenticates requests for the path an export link was signed for."""
+
+    def authenticate(self, request):
+        signature = request.query_params.get('signature')
+        if not signature:
+            return None
+        try:
+            payload = signing.loads(signature, salt=LINK_SALT, max_age=LINK_MAX_AGE)
+        except signing.BadSignature:
+            raise AuthenticationFailed('Export link is invalid or expired.')
+        if payload['path'] != request.path:
+            raise AuthenticationFailed('Export link is for another export.')
+        try:
+            # not from a replica, which may not have the deactivation yet
+            user = User.objects.using(DEFAULT_DB_ALIAS).get(pk=payload['user'], is_active=True)
+        except User.DoesNotExist:
+            raise AuthenticationFailed('User not found.')
+        return user, None
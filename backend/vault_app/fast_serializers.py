@@ -0,0 +1,103 @@
+"""Read-only serializers of listed folders, tags and documents, built from rows.
+
+DocumentSerializer, FolderSerializer and TagSerializer go through a field
+object per field and row. Listing 1000 documents that way spends more time
+than the queries take. These build the same dicts from the rows of values()
+instead, and fetch the tag ids of a page of documents with one query. Their
+output is the same as the model serializers' (FastSerializerTests checks
+that), so the two can be swapped freely. Rows are fetched with rows(), whose
+keys are the names the output uses.
+"""
+from collections import defaultdict
+
+from django.utils import timezone
+
+from .models import Document
+
+DocumentTag = Document.tags.through
+
+
+def datetime_representation(value):
+    """``value`` as DRF's DateTimeField with the ISO 8601 format writes it."""
+    if value is None:
+        return None
+    value = value.astimezone(timezone.get_current_timezone()).isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+class FastSerializer:
+    """Serializes ``instance``, rows of rows(), with ``context`` as the model serializer takes it."""
+    # output keys, in order, read from the row by the same name
+    fields = ()
+    datetime_fields = ()
+    # read along, for the cursor of the page
+    extra_fields = ()
+
+    def __init__(self, instance, context=None):
+        self.instance = instance
+        self.context = context or {}
+
+    @classmethod
+    def rows(cls, queryset):
+        return queryset.prefetch_related(None).values(*cls.fields, *cls.extra_fields)
+
+    def to_representation(self, row):
+        data = {field: row[field] for field in self.fields}
+        for field in self.datetime_fields:
+            data[field] = datetime_representation(data[field])
+        return data
+
+    @property
+    def data(self):
+        return [self.to_representation(row) for row in self.instance]
+
+
+class FastTagSerializer(FastSerializer):
+    fields = ('id', 'name', 'document_count', 'total_bytes', 'last_modified')
+    datetime_fields = ('last_modified',)
+    extra_fields = ('created_at',)
+
+
+class FastFolderSerializer(FastSerializer):
+    fields = ('id', 'name', 'parent', 'document_count', 'total_bytes', 'last_modified', 'created_at')
+    datetime_fields = ('last_modified', 'created_at')
+
+
+class FastDocumentSerializer(FastSerializer):
+    fields = ('id', 'name', 'file', 'file_type', 'size', 'folder', 'tags', 'created_at')
+    datetime_fields = ('created_at',)
+
+    @classmethod
+    def rows(cls, queryset):
+        # tags are many to many, a value per tag; they are added by data
+        return queryset.prefetch_related(None).values(*(field for field in cls.fields if field != 'tags'))
+
+    @property
+    def data(self):
+        rows = list(self.instance)
+        tags = defaultdict(list)
+        links = DocumentTag.objects.filter(document_id__in=[row['id'] for row in rows]).order_by('tag_id')
+        for document_id, tag_id in links.values_list('document_id', 'tag_id'):
+            tags[document_id].append(tag_id)
+
+        storage = Document._meta.get_field('file').storage
+        request = self.context.get('request')
+        data = []
+        for row in rows:
+            name = row['file']
+            url = storage.url(name) if name else None
+            if url is not None and request is not None:
+                url = request.build_absolute_uri(url)
+            data.append({
+                'id': row['id'],
+                'name': row['name'],
+                'file': url,
+                'file_type': row['file_type'],
+                'size': row['size'],
+                'folder': row['folder'],
+                'tags': tags[row['id']],
+                'created_at': datetime_representation(row['created_at']),
+            })
+        return data
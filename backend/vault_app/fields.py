@@ -0,0 +1,43 @@
+import time
+
+import secured_fields
+
+from . import metrics
+from .decryption_cache import MISSING, get_decryption_cache
+
+
+class MeasuredEncryptionMixin:
+    """Records the time and bytes spent encrypting and decrypting values in the metrics."""
+
+    def get_db_prep_save(self, value, connection):
+        started = time.perf_counter()
+        encrypted = super().get_db_prep_save(value, connection)
+        if isinstance(encrypted, str) and encrypted is not value:
+            metrics.record_crypto('field_encrypt', time.perf_counter() - started, len(encrypted))
+        return encrypted
+
+    def decrypt(self, value):
+        started = time.perf_counter()
+        decrypted = super().decrypt(value)
+        metrics.record_crypto('field_decrypt', time.perf_counter() - started, len(value))
+        return decrypted
+
+
+class CachedDecryptionMixin:
+    """Looks decrypted values up in the decryption cache before decrypting."""
+
+    def decrypt(self, value):
+        cache = get_decryption_cache()
+        decrypted = cache.get(value)
+        if decrypted is MISSING:
+            decrypted = super().decrypt(value)
+            cache.set(value, decrypted)
+        return decrypted
+
+
+class EncryptedCharField(CachedDecryptionMixin, MeasuredEncryptionMixin, secured_fields.EncryptedCharField):
+    pass
+
+
+class EncryptedDateField(CachedDecryptionMixin, MeasuredEncryptionMixin, secured_fields.EncryptedDateField):
+    pass
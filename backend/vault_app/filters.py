@@ -0,0 +1,54 @@
+from django.db.models import Q
+from rest_framework import filters
+
+from . import blind_index, content_index
+
+
+class BlindIndexSearchFilter(filters.SearchFilter):
+    """SearchFilter that matches encrypted fields through their blind index.
+
+    Fields listed in the model's ``blind_index_fields`` are looked up by token,
+    any other search field keeps the regular ORM lookup. ``=name`` matches the
+    whole normalized value, a plain ``name`` matches word prefixes and substrings.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        search_fields = self.get_search_fields(view, request)
+        search_terms = self.get_search_terms(request)
+
+        if not search_fields or not search_terms:
+            return queryset
+
+        model = queryset.model
+        indexed_fields = getattr(model, 'blind_index_fields', ())
+        user_id = request.user.pk
+
+        for term in search_terms:
+            conditions = Q()
+            for search_field in search_fields:
+                field = search_field.lstrip(''.join(self.lookup_prefixes))
+                if field not in indexed_fields:
+                    conditions |= Q(**{self.construct_search(search_field, queryset): term})
+                    continue
+
+                if search_field.startswith('='):
+                    tokens = {blind_index.exact_token(user_id, blind_index.model_key(model), field, term)}
+                else:
+                    tokens = blind_index.term_tokens(user_id, blind_index.model_key(model), field, term)
+                if tokens:
+                    conditions |= Q(pk__in=blind_index.matching_ids(user_id, model, tokens))
+            queryset = queryset.filter(conditions)
+
+        return queryset
+
+
+class ContentSearchFilter(filters.BaseFilterBackend):
+    """Matches documents containing every word of ``?q=`` through the encrypted content index."""
+    search_param = 'q'
+
+    def filter_queryset(self, request, queryset, view):
+        text = request.query_params.get(self.search_param, '')
+        ids = content_index.search(request.user.pk, text)
+        if ids is None:
+            return queryset
+        return queryset.filter(pk__in=ids)
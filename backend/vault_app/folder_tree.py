@@ -0,0 +1,118 @@
+"""Nested folders, with their hierarchy kept in a closure table.
+
+Folder.parent says where a folder is; FolderLink links every folder to
+itself and to each of its ancestors, with the number of levels between them.
+Descendants, breadcrumbs and the totals of a subtree are then each a single
+indexed query on FolderLink whatever the depth, and moving a subtree only
+rewrites the links between it and its old and new ancestors.
+
+The links are written in the transaction that changes the folders: by the
+signal handlers for single folders and by attach() for folders created with
+bulk_create(). rebuild() recreates them from the parents. Deleted folders
+keep their links until the reaper removes them with their rows.
+"""
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import Coalesce
+
+from . import bulk, reaper
+from .models import Document, Folder, FolderLink
+
+
+def attach(folders):
+    """Link new ``folders``, parents before their children, to themselves and their ancestors."""
+    folders = list(folders)
+    parent_ids = {folder.parent_id for folder in folders if folder.parent_id is not None}
+    ancestors = defaultdict(list)
+    rows = FolderLink.objects.filter(descendant_id__in=parent_ids).values_list('descendant_id', 'ancestor_id', 'depth')
+    for descendant_id, ancestor_id, depth in rows:
+        ancestors[descendant_id].append((ancestor_id, depth))
+
+    links = []
+    for folder in folders:
+        ancestors[folder.pk] = [(folder.pk, 0)] + [
+            (ancestor_id, depth + 1) for ancestor_id, depth in ancestors.get(folder.parent_id, ())
+        ]
+        links.extend(
+            FolderLink(ancestor_id=ancestor_id, descendant_id=folder.pk, depth=depth)
+            for ancestor_id, depth in ancestors[folder.pk]
+        )
+    FolderLink.objects.bulk_create(links, batch_size=1000)
+
+
+def is_within(folder, ancestor):
+    """Whether ``folder`` is ``ancestor`` or below it."""
+    return FolderLink.objects.filter(ancestor=ancestor, descendant=folder).exists()
+
+
+def move(folder):
+    """Relink the subtree of ``folder`` below its new parent."""
+    with transaction.atomic(savepoint=False):
+        subtree = list(FolderLink.objects.filter(ancestor=folder).values_list('descendant_id', 'depth'))
+        if folder.parent_id in {descendant_id for descendant_id, _ in subtree}:
+            raise ValueError('A folder cannot be moved below itself.')
+
+        old_ancestors = list(
+            FolderLink.objects.filter(descendant=folder, depth__gt=0).values_list('ancestor_id', flat=True)
+        )
+        FolderLink.objects.filter(ancestor_id__in=old_ancestors, descendant__ancestor_links__ancestor=folder).delete()
+        if folder.parent_id is None:
+            return
+        new_ancestors = FolderLink.objects.filter(descendant_id=folder.parent_id).values_list('ancestor_id', 'depth')
+        FolderLink.objects.bulk_create(
+            [
+                FolderLink(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=above + below + 1)
+                for ancestor_id, above in new_ancestors
+                for descendant_id, below in subtree
+            ],
+            batch_size=1000,
+        )
+
+
+def descendants(folder):
+    """Folders below ``folder``, at any depth."""
+    return Folder.objects.filter(ancestor_links__ancestor=folder, ancestor_links__depth__gt=0)
+
+
+def breadcrumbs(folder):
+    """``folder`` and its ancestors, from the top level down."""
+    return Folder.objects.filter(descendant_links__descendant=folder).order_by('-descendant_links__depth')
+
+
+def subtree_totals(folder):
+    """Folders, documents and bytes of ``folder`` and everything below it, from the folders' counters."""
+    return Folder.objects.filter(ancestor_links__ancestor=folder).aggregate(
+        folder_count=Count('pk'),
+        document_count=Coalesce(Sum('document_count'), 0),
+        total_bytes=Coalesce(Sum('total_bytes'), 0),
+    )
+
+
+def delete(user, folder):
+    """Soft-delete ``folder`` and everything below it, and have the reaper remove them; returns the folder count.
+
+    Hiding takes two updates whatever the size of the subtree, so the
+    request returns at once; the rows and files go in the background.
+    """
+    with transaction.atomic():
+        folder_ids = list(FolderLink.objects.filter(ancestor=folder).values_list('descendant_id', flat=True))
+        bulk.hide(user.pk, Document.objects.filter(folder__ancestor_links__ancestor=folder), folder_ids)
+        reaper.schedule()
+    return len(folder_ids)
+
+
+def rebuild(batch_size=1000):
+    """Recreate the links of every folder from Folder.parent; returns the number of folders."""
+    parents = dict(Folder.objects.values_list('pk', 'parent_id'))
+    with transaction.atomic():
+        FolderLink.objects.all().delete()
+        links = []
+        for pk in parents:
+            ancestor_id, depth = pk, 0
+            while ancestor_id is not None and depth <= len(parents):
+                links.append(FolderLink(ancestor_id=ancestor_id, descendant_id=pk, depth=depth))
+                ancestor_id, depth = parents.get(ancestor_id), depth + 1
+        FolderLink.objects.bulk_create(links, batch_size=batch_size)
+    return len(parents)
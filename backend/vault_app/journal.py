@@ -0,0 +1,115 @@
+"""Change journal of folders, tags and documents, for delta sync.
+
+Every write to a user's folders, tags or documents records the objects it
+touched in the writing transaction: the signal handlers do it for single
+objects, bulk.py and folder_tree.py for the bulk paths. Folders and tags
+serialize their counters, so those whose counters moved are recorded too.
+Change keeps only the latest change of each object, under the vault version
+that change bumped to. The bump locks the user's row until the transaction
+commits, so a user's changes become visible in the order of their versions
+and a client that has seen version N only needs the rows above N.
+
+Deletions leave tombstones. compact(), run periodically by the
+compact_sync_journal command, drops those older than
+SYNC_JOURNAL_RETENTION_DAYS and raises the user's sync_horizon past them; a
+client that synced before the horizon moved above its cursor may have
+missed deletions and starts over from a full snapshot. A sync reads the
+horizon and the journal in one snapshot(), so a compaction committing in
+between cannot drop tombstones it then fails to report. Deleting a tag
+unlinks its documents without recording them: clients drop the ids of
+deleted tags from their documents.
+"""
+import datetime
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from . import blind_index, versions
+from .models import Change, Document, Folder, Tag, User
+
+# what sync serves, by the names it serves them under
+MODELS = {'folders': Folder, 'tags': Tag, 'documents': Document}
+
+
+def record(user_id, changed=None, deleted=None):
+    """Journal the ``{model: ids}`` of ``changed`` and ``deleted`` under the user's next vault version."""
+    entries = {}
+    for model, ids in (changed or {}).items():
+        entries.update(((blind_index.model_key(model), pk), False) for pk in ids if pk is not None)
+    for model, ids in (deleted or {}).items():
+        entries.update(((blind_index.model_key(model), pk), True) for pk in ids if pk is not None)
+    if not entries:
+        return
+
+    versions.bump([user_id])
+    sequence = User.objects.filter(pk=user_id).values_list('vault_version', flat=True).get()
+    Change.objects.bulk_create(
+        [
+            Change(user_id=user_id, model=model, object_id=pk, sequence=sequence, deleted=is_deleted)
+            for (model, pk), is_deleted in entries.items()
+        ],
+        update_conflicts=True,
+        unique_fields=['user', 'model', 'object_id'],
+        update_fields=['sequence', 'deleted', 'changed_at'],
+        batch_size=1000,
+    )
+
+
+@contextmanager
+def snapshot(using):
+    """Transaction on database ``using`` whose reads all see the same snapshot of it."""
+    connection = connections[using]
+    outermost = not connection.in_atomic_block
+    with transaction.atomic(using=using):
+        # READ COMMITTED, PostgreSQL's default, takes a new snapshot per statement
+        if outermost and connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        yield
+
+
+def read(user_id, since, names=tuple(MODELS), limit=500, tombstones=True, using=None):
+    """Ids changed and deleted after version ``since``, by name, the version they go up to, and whether more follow.
+
+    A page ends with a whole version, so it can hold more than ``limit`` ids.
+    """
+    keys = {blind_index.model_key(MODELS[name]): name for name in names}
+    entries = Change.objects.db_manager(using).filter(user_id=user_id, sequence__gt=since, model__in=keys).order_by('sequence', 'pk')
+    if not tombstones:
+        entries = entries.filter(deleted=False)
+    columns = ('pk', 'model', 'object_id', 'sequence', 'deleted')
+    rows = list(entries.values_list(*columns)[:limit + 1])
+    more = len(rows) > limit
+    if more:
+        rows = rows[:limit]
+        last_pk, _, _, last_sequence, _ = rows[-1]
+        rows += entries.filter(sequence=last_sequence, pk__gt=last_pk).values_list(*columns)
+        more = entries.filter(sequence__gt=last_sequence).exists()
+
+    changed = {name: [] for name in names}
+    deleted = {name: [] for name in names}
+    for _, model, object_id, _, is_deleted in rows:
+        (deleted if is_deleted else changed)[keys[model]].append(object_id)
+    return changed, deleted, rows[-1][3] if rows else since, more
+
+
+def get_retention():
+    return datetime.timedelta(days=getattr(settings, 'SYNC_JOURNAL_RETENTION_DAYS', 30))
+
+
+def compact(user_id=None):
+    """Drop the tombstones past the retention, of ``user_id`` or everyone; returns how many."""
+    tombstones = Change.objects.filter(deleted=True, changed_at__lt=timezone.now() - get_retention())
+    if user_id is not None:
+        tombstones = tombstones.filter(user_id=user_id)
+
+    dropped = 0
+    horizons = tombstones.values('user_id').annotate(horizon=Max('sequence')).values_list('user_id', 'horizon')
+    for owner_id, horizon in horizons:
+        with transaction.atomic():
+            User.objects.filter(pk=owner_id, sync_horizon__lt=horizon).update(sync_horizon=horizon)
+            dropped += Change.objects.filter(user_id=owner_id, deleted=True, sequence__lte=horizon).delete()[0]
+    return dropped
@@ -0,0 +1,207 @@
+"""Re-encryption of the vault under the current key.
+
+SECURED_FIELDS_KEY may list several keys: the first one encrypts, all of
+them decrypt. Once a new key is put first, the rotate_keys command walks
+every encrypted column and every stored file in keyset-ordered batches and
+re-encrypts what is not under the new key yet, on a pool of processes.
+Columns are rewritten from their ciphertext, rows locked for the batch, so
+plaintext never goes through the ORM and concurrent writes are not lost.
+Files are rewritten through their storage's rewrite(): on the file system
+next to themselves and moved into place, so readers that have the old file
+open keep reading it; in object storage as a copy under a new name, which
+the rows are pointed at in one transaction before the old object is deleted.
+"""
+import time
+
+from cryptography.fernet import Fernet, InvalidToken
+from django.apps import apps
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import TextField
+from django.db.models.functions import Cast
+from secured_fields.fernet import get_fernet
+from secured_fields.mixins import EncryptedMixin
+
+from . import blobs
+from .models import Blob, Document, Preview
+from .storage import HEADER, MAGIC, encrypt_stream, get_chunk_size, get_keys
+
+# targets whose rows hold the names of stored files, and the field naming them
+FILE_TARGETS = {
+    'files:blobs': (Blob, 'name'),
+    'files:previews': (Preview, 'file'),
+    # documents stored before blobs existed
+    'files:documents': (Document, 'file'),
+}
+
+
+def encrypted_fields(model):
+    return [field for field in model._meta.concrete_fields if isinstance(field, EncryptedMixin)]
+
+
+def column_targets():
+    models = apps.get_app_config('vault_app').get_models()
+    return [f'columns:{model._meta.label}' for model in models if encrypted_fields(model)]
+
+
+def targets():
+    return column_targets() + list(FILE_TARGETS)
+
+
+def target_queryset(target):
+    kind, name = target.split(':', 1)
+    if kind == 'columns':
+        return apps.get_model(name).objects.all()
+
+    model, field = FILE_TARGETS[target]
+    queryset = model.objects.exclude(**{field: ''})
+    if model is Document:
+        queryset = queryset.filter(blob__isnull=True)
+    return queryset
+
+
+def current_key_id():
+    """Id of the key files are encrypted with, which changes with the first key."""
+    return get_keys()[0][0].hex()
+
+
+def primary_fernet():
+    keys = settings.SECURED_FIELDS_KEY
+    return Fernet(keys if isinstance(keys, (str, bytes)) else keys[0])
+
+
+def plan(target, after, batch_size):
+    """Yield ``(first_pk, last_pk)`` of consecutive batches of the target's rows after ``after``."""
+    queryset = target_queryset(target).order_by('pk')
+    last_pk = after
+    while True:
+        pks = list(queryset.filter(pk__gt=last_pk).values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return
+        yield pks[0], pks[-1]
+        last_pk = pks[-1]
+
+
+class Throttle:
+    """Sleeps so that ``consume`` is not called for more than ``rate`` bytes a second."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.start = time.monotonic()
+        self.consumed = 0
+
+    def consume(self, size):
+        if not self.rate:
+            return
+        self.consumed += size
+        ahead = self.consumed / self.rate - (time.monotonic() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def rotate_value(field, fernet, primary, value):
+    """Stored ``value`` encrypted under the first key, None if it already is, or raise InvalidToken."""
+    token = field.get_encrypted_section(value)
+    # searchable values end with a hash of their plaintext, which stays
+    suffix = value[len(token):]
+    try:
+        primary.decrypt(token.encode())
+        return None
+    except InvalidToken:
+        pass
+    return fernet.rotate(token.encode()).decode() + suffix
+
+
+def rotate_columns(model, first_pk, last_pk):
+    """Re-encrypt the encrypted columns of one batch of rows; returns (rows, unreadable values)."""
+    fields = encrypted_fields(model)
+    fernet, primary = get_fernet(), primary_fernet()
+    table = connection.ops.quote_name(model._meta.db_table)
+    columns = ', '.join(f'{connection.ops.quote_name(field.column)} = %s' for field in fields)
+    pk_column = connection.ops.quote_name(model._meta.pk.column)
+
+    rotated = []
+    unreadable = 0
+    with transaction.atomic():
+        # the ciphertext, cast so the fields do not decrypt it
+        rows = model.objects.select_for_update().filter(pk__gte=first_pk, pk__lte=last_pk).values_list(
+            'pk', *[Cast(field.name, TextField()) for field in fields],
+        )
+        for pk, *values in rows:
+            changed = False
+            new_values = []
+            for field, value in zip(fields, values):
+                new_value = None
+                if value is not None:
+                    try:
+                        new_value = rotate_value(field, fernet, primary, value)
+                    except InvalidToken:
+                        # plaintext, or encrypted with a key that is not configured: left alone
+                        unreadable += 1
+                changed = changed or new_value is not None
+                new_values.append(value if new_value is None else new_value)
+            if changed:
+                rotated.append([*new_values, pk])
+
+        if rotated:
+            with connection.cursor() as cursor:
+                cursor.executemany(f'UPDATE {table} SET {columns} WHERE {pk_column} = %s', rotated)
+    return len(rotated), unreadable
+
+
+def rotate_file(storage, name, throttle):
+    """Re-encrypt one stored file under the first key; returns the bytes written."""
+    try:
+        header = storage.header(name)
+    except FileNotFoundError:
+        return 0
+
+    key_id = get_keys()[0][0]
+    chunk_size, flags = get_chunk_size(), 0
+    if header[:len(MAGIC)] == MAGIC and len(header) == HEADER.size:
+        _, _, flags, chunk_size, file_key_id, _ = HEADER.unpack(header)
+        if file_key_id == key_id:
+            return 0
+
+    written = 0
+
+    def chunks(plaintext):
+        nonlocal written
+        for data in encrypt_stream(plaintext.chunks(chunk_size), chunk_size=chunk_size, flags=flags):
+            throttle.consume(len(data))
+            written += len(data)
+            yield data
+
+    with storage.open(name) as plaintext:
+        new_name = storage.rewrite(name, chunks(plaintext))
+    if new_name is None:
+        # deleted meanwhile
+        return 0
+    if new_name != name and not blobs.rename_file(storage, name, new_name):
+        # no longer named by any row
+        return 0
+    return written
+
+
+def rotate_files(target, first_pk, last_pk, bytes_per_second=0):
+    """Re-encrypt the files of one batch of rows; returns (files, bytes)."""
+    _, field = FILE_TARGETS[target]
+    storage = Document._meta.get_field('file').storage
+    throttle = Throttle(bytes_per_second)
+    files = written = 0
+    names = target_queryset(target).filter(pk__gte=first_pk, pk__lte=last_pk).values_list(field, flat=True)
+    for name in names:
+        size = rotate_file(storage, name, throttle)
+        if size:
+            files += 1
+            written += size
+    return files, written
+
+
+def run_batch(target, first_pk, last_pk, bytes_per_second=0):
+    """Rotate one batch of ``target``; returns ``(items, bytes, unreadable)``."""
+    if target.startswith('columns:'):
+        rows, unreadable = rotate_columns(apps.get_model(target.split(':', 1)[1]), first_pk, last_pk)
+        return rows, 0, unreadable
+    files, written = rotate_files(target, first_pk, last_pk, bytes_per_second)
+    return files, written, 0
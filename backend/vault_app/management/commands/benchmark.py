@@ -0,0 +1,105 @@
+import json
+import os
+import platform
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from vault_app import benchmarks
+from vault_app.models import Document
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark field and file encryption and the serialization of the seeded lists in this process and, '
+        'with --url, the API of a running server seeded by seed_benchmark_data, driven by concurrent clients. Writes the results as JSON; with '
+        '--baseline, fails if any throughput or latency is more than --tolerance worse than there.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='Server to load, for example http://127.0.0.1:8000.')
+        parser.add_argument('--prefix', default='bench', help='Prefix of the seeded users.')
+        parser.add_argument('--users', type=int, default=5, help='Seeded users the clients act as.')
+        parser.add_argument('--password', default='benchmark')
+        parser.add_argument('--scenarios', default=','.join(benchmarks.SCENARIOS),
+                            help='Comma-separated, out of ' + ', '.join(benchmarks.SCENARIOS) + '.')
+        parser.add_argument('--clients', type=int, default=10)
+        parser.add_argument('--requests', type=int, default=200, help='Requests per scenario.')
+        parser.add_argument('--file-size', type=int, default=16 * 1024, help='Bytes per uploaded file.')
+        parser.add_argument('--timeout', type=float, default=60)
+        parser.add_argument('--iterations', type=int, default=2000, help='Field operations per micro-benchmark.')
+        parser.add_argument('--micro-file-size', type=int, default=4 * 1024 * 1024)
+        parser.add_argument('--skip-micro', action='store_true')
+        parser.add_argument('--skip-serialization', action='store_true')
+        parser.add_argument('--serialization-repeat', type=int, default=5, help='Runs per list serialization.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='File to write the JSON results to, instead of stdout.')
+        parser.add_argument('--baseline', help='Results of an earlier run to compare with.')
+        parser.add_argument('--tolerance', type=float, default=0.2)
+
+    def handle(self, *args, **options):
+        scenarios = [scenario for scenario in options['scenarios'].split(',') if scenario]
+        unknown = set(scenarios) - set(benchmarks.SCENARIOS)
+        if unknown:
+            raise CommandError(f'Unknown scenarios: {", ".join(sorted(unknown))}.')
+
+        results = {
+            'started_at': timezone.now().isoformat(),
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+            },
+            'options': {key: options[key] for key in (
+                'clients', 'requests', 'file_size', 'iterations', 'micro_file_size', 'seed', 'users',
+            )},
+        }
+        if not options['skip_micro']:
+            results['micro'] = benchmarks.run_micro(
+                iterations=options['iterations'], file_size=options['micro_file_size'], seed_value=options['seed'],
+            )
+        if not options['skip_serialization']:
+            results['serialization'] = benchmarks.run_serialization(
+                options['prefix'], repeat=options['serialization_repeat'],
+            )
+        if options['url']:
+            results['http'] = self.run_http(options, scenarios)
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                output_file.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+        if options['baseline']:
+            with open(options['baseline']) as baseline_file:
+                regressions = benchmarks.compare(json.load(baseline_file), results, options['tolerance'])
+            if regressions:
+                raise CommandError('Regressions against the baseline:\n' + '\n'.join(regressions))
+            self.stderr.write('No regressions against the baseline.')
+
+    def run_http(self, options, scenarios):
+        try:
+            import httpx
+        except ImportError:
+            raise CommandError('The load run needs httpx (pip install httpx).')
+
+        fixtures = benchmarks.vault_fixtures(options['prefix'], options['users'])
+        if not fixtures or not all(fixture['documents'] for fixture in fixtures):
+            raise CommandError('Seed the vault first: python manage.py seed_benchmark_data.')
+
+        results, uploaded = benchmarks.run_http(
+            httpx, options['url'], fixtures, scenarios=scenarios, password=options['password'],
+            clients=options['clients'], requests=options['requests'], file_size=options['file_size'],
+            timeout=options['timeout'], seed_value=options['seed'],
+        )
+        # uploads would make later runs list larger vaults
+        for document in Document.objects.filter(pk__in=uploaded):
+            document.delete()
+        self.stderr.write(f'Benchmarked {", ".join(scenarios)} against {options["url"]}.')
+        return results
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from vault_app import storage_gc
+
+
+class Command(BaseCommand):
+    help = 'Delete the blobs no document references and the stored files nothing references.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only count what would be deleted.')
+
+    def handle(self, *args, **options):
+        blob_count, file_count, freed = storage_gc.collect(dry_run=options['dry_run'])
+        verb = 'Would delete' if options['dry_run'] else 'Deleted'
+        self.stdout.write(f'{verb} {blob_count} blobs and {file_count} files of {freed} bytes.')
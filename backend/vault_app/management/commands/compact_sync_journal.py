@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from vault_app import journal
+
+
+class Command(BaseCommand):
+    help = 'Drop the tombstones of the sync journal older than SYNC_JOURNAL_RETENTION_DAYS.'
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'Dropped {journal.compact()} tombstones.')
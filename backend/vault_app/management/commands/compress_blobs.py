@@ -0,0 +1,55 @@
+from django.core.files.storage import FileSystemStorage
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Sum
+
+from vault_app import blobs
+from vault_app.models import Blob, Document
+from vault_app.storage import SegmentError, compress_file
+
+
+class Command(BaseCommand):
+    help = (
+        'Compress the files of blobs stored before compression, where their type and content allow it, '
+        'record the stored size of every blob and report the compression ratio.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--report', action='store_true', help='Only record stored sizes and report.')
+
+    def handle(self, *args, **options):
+        storage = blobs.file_storage()
+        if not isinstance(storage, FileSystemStorage):
+            raise CommandError('compress_blobs rewrites local files, and works on file system storage only.')
+        compressed = missing = unreadable = 0
+
+        last_pk = 0
+        while True:
+            batch = list(
+                Blob.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'name')[:options['batch_size']]
+            )
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+            file_types = dict(
+                Document.objects.filter(blob_id__in=[pk for pk, _ in batch]).values_list('blob_id', 'file_type')
+            )
+
+            for pk, name in batch:
+                if not storage.exists(name):
+                    missing += 1
+                    continue
+                if not options['report'] and storage.is_segmented(name):
+                    try:
+                        compressed += compress_file(storage.path(name), file_types.get(pk, ''))
+                    except SegmentError:
+                        unreadable += 1
+                Blob.objects.filter(pk=pk).update(stored_size=storage.size(name))
+
+        totals = Blob.objects.filter(stored_size__isnull=False).aggregate(size=Sum('size'), stored=Sum('stored_size'))
+        size, stored = totals['size'] or 0, totals['stored'] or 0
+        self.stdout.write(
+            f'Compressed {compressed} files, {missing} missing, {unreadable} unreadable. '
+            f'{size / 1024 / 1024:.1f} MB of content stored in {stored / 1024 / 1024:.1f} MB '
+            f'(ratio {stored / size if size else 1:.2f}).'
+        )
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+
+from vault_app.blobs import rename_file
+from vault_app.models import Document
+from vault_app.storage import encrypt_stream, get_chunk_size
+
+
+class Command(BaseCommand):
+    help = 'Convert document files from whole-file Fernet encryption to the segmented format.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        storage = Document._meta.get_field('file').storage
+        converted = skipped = missing = 0
+
+        last_pk = 0
+        while True:
+            batch = list(
+                Document.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'file')[:options['batch_size']]
+            )
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+
+            for pk, name in batch:
+                if not name or not storage.exists(name):
+                    missing += 1
+                    continue
+                if storage.is_segmented(name):
+                    skipped += 1
+                    continue
+                if not options['dry_run']:
+                    self.convert(storage, name)
+                converted += 1
+
+        self.stdout.write(f'Converted {converted} files, {skipped} already segmented, {missing} missing.')
+
+    def convert(self, storage, name):
+        with storage.open(name) as source:
+            new_name = storage.rewrite(name, encrypt_stream(source.chunks(get_chunk_size())))
+        if new_name not in (None, name):
+            rename_file(storage, name, new_name)
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from vault_app import blobs
+from vault_app.models import Blob, Document
+
+
+class Command(BaseCommand):
+    help = 'Move documents stored before blobs existed onto blobs, deleting the files of duplicates.'
+
+    def handle(self, *args, **options):
+        storage = blobs.file_storage()
+        linked = deduplicated = 0
+
+        for document in Document.objects.filter(blob__isnull=True).only('pk', 'user_id', 'file').iterator():
+            with storage.open(document.file.name) as plaintext:
+                digest = blobs.keyed_digest(document.user_id, blobs.content_sha256(plaintext))
+                size = plaintext.size
+
+            with transaction.atomic():
+                blob = blobs.acquire(document.user_id, digest)
+                if blob is None:
+                    blob = Blob.objects.create(
+                        user_id=document.user_id, digest=digest, name=document.file.name, size=size,
+                        stored_size=storage.size(document.file.name), ref_count=1,
+                    )
+                    linked += 1
+                else:
+                    # every legacy document has a file of its own
+                    transaction.on_commit(lambda name=document.file.name: storage.delete(name))
+                    deduplicated += 1
+                Document.objects.filter(pk=document.pk).update(blob=blob, file=blob.name)
+
+        self.stdout.write(f'Linked {linked} documents to new blobs, {deduplicated} to existing ones.')
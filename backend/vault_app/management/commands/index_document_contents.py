@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from vault_app import content_index, workers
+from vault_app.models import Document, DocumentContent
+
+
+class Command(BaseCommand):
+    help = 'Queue the text of documents for the content index and wait until it is indexed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--all', action='store_true', help='Reindex documents that are already indexed.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        documents = Document.objects.select_related('blob').order_by('pk')
+        if not options['all']:
+            documents = documents.exclude(content__status=DocumentContent.INDEXED)
+
+        last_pk = 0
+        total = 0
+        while True:
+            batch = list(documents.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            content_index.enqueue(batch)
+            last_pk = batch[-1].pk
+            total += len(batch)
+
+        workers.shutdown()
+        self.stdout.write(f'Indexed {total} documents.')
@@ -0,0 +1,95 @@
+import asyncio
+import os
+import statistics
+import time
+
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework_simplejwt.tokens import AccessToken
+
+from vault_app.models import Document, Folder, User
+
+PATHS = {
+    'sync': '/api/documents/{pk}/download/',
+    'async': '/api/async/documents/{pk}/download/',
+}
+
+
+class Command(BaseCommand):
+    help = ('Download one document from a running server with many concurrent, slow clients, '
+            'through the sync and/or async view.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000')
+        parser.add_argument('--view', choices=['sync', 'async', 'both'], default='both')
+        parser.add_argument('--clients', type=int, default=200)
+        parser.add_argument('--size', type=int, default=1024 * 1024, help='Document size in bytes.')
+        parser.add_argument('--rate', type=int, default=256 * 1024, help='Bytes per second each client reads.')
+        parser.add_argument('--timeout', type=float, default=120)
+
+    def handle(self, *args, **options):
+        try:
+            import httpx
+        except ImportError:
+            raise CommandError('The load test needs httpx (pip install httpx).')
+
+        user, _ = User.objects.get_or_create(username='loadtest')
+        folder = Folder.objects.filter(user=user).first() or Folder.objects.create(name='Load test', user=user)
+        document = Document.objects.filter(user=user, size=options['size']).first()
+        if document is None:
+            document = Document.objects.create(
+                name='Load test', file=ContentFile(os.urandom(options['size']), name='load-test.bin'),
+                user=user, folder=folder,
+            )
+        token = str(AccessToken.for_user(user))
+
+        views = ['sync', 'async'] if options['view'] == 'both' else [options['view']]
+        for view in views:
+            url = options['url'].rstrip('/') + PATHS[view].format(pk=document.pk)
+            results = asyncio.run(self.run_clients(httpx, url, token, options))
+            self.report(view, results, options)
+
+    async def run_clients(self, httpx, url, token, options):
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+        async with httpx.AsyncClient(limits=limits, timeout=options['timeout']) as client:
+            started = time.perf_counter()
+            results = await asyncio.gather(
+                *[self.download(client, url, token, options['rate']) for _ in range(options['clients'])],
+                return_exceptions=True,
+            )
+        return results, time.perf_counter() - started
+
+    async def download(self, client, url, token, rate):
+        started = time.perf_counter()
+        first_byte = None
+        received = 0
+        async with client.stream('GET', url, headers={'Authorization': f'Bearer {token}'}) as response:
+            response.raise_for_status()
+            async for data in response.aiter_bytes(16 * 1024):
+                if first_byte is None:
+                    first_byte = time.perf_counter() - started
+                received += len(data)
+                # a slow client: do not read faster than ``rate``
+                delay = received / rate - (time.perf_counter() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        return first_byte, time.perf_counter() - started
+
+    def report(self, view, results, options):
+        results, elapsed = results
+        timings = [result for result in results if not isinstance(result, BaseException)]
+        errors = [result for result in results if isinstance(result, BaseException)]
+        self.stdout.write(f'{view}: {len(timings)} downloads, {len(errors)} errors in {elapsed:.1f}s')
+        if errors:
+            self.stdout.write(f'  first error: {errors[0]!r}')
+        if not timings:
+            return
+
+        for label, values in (('first byte', [t[0] for t in timings]), ('total', [t[1] for t in timings])):
+            values.sort()
+            p95 = values[int(len(values) * 0.95) - 1] if len(values) > 1 else values[0]
+            self.stdout.write(
+                f'  {label}: median {statistics.median(values):.2f}s, p95 {p95:.2f}s, max {values[-1]:.2f}s'
+            )
+        throughput = len(timings) * options['size'] / elapsed / 1024 / 1024
+        self.stdout.write(f'  throughput {throughput:.1f} MiB/s')
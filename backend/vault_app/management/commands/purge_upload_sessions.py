@@ -0,0 +1,23 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from vault_app import uploads
+from vault_app.models import UploadSession
+
+
+class Command(BaseCommand):
+    help = 'Delete upload sessions, and their partial files, that were not touched recently.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=getattr(settings, 'UPLOAD_SESSION_EXPIRY_HOURS', 24))
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options['hours'])
+        count = 0
+        for session in UploadSession.objects.filter(updated_at__lt=cutoff).iterator():
+            uploads.abort(session)
+            count += 1
+        self.stdout.write(f'Purged {count} upload sessions.')
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from vault_app import reaper
+
+
+class Command(BaseCommand):
+    help = 'Delete the soft-deleted folders and documents, and give up their blobs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=reaper.DEFAULT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        documents, folders = reaper.reap(options['batch_size'])
+        self.stdout.write(f'Deleted {documents} documents and {folders} folders.')
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from vault_app import blind_index
+from vault_app.models import BlindIndexToken, Document, Folder, Tag
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the blind index tokens of Folder, Tag and Document names.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        for model in (Folder, Tag, Document):
+            BlindIndexToken.objects.filter(model=blind_index.model_key(model)).delete()
+
+            last_pk = 0
+            total = 0
+            while True:
+                batch = list(model.objects.filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+                if not batch:
+                    break
+                blind_index.index_instances(batch)
+                last_pk = batch[-1].pk
+                total += len(batch)
+
+            self.stdout.write(f'Indexed {total} {model._meta.verbose_name_plural}.')
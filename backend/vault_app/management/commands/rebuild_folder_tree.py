@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from vault_app import folder_tree
+
+
+class Command(BaseCommand):
+    help = 'Recreate the folder hierarchy links from the parents of the folders.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        count = folder_tree.rebuild(batch_size=options['batch_size'])
+        self.stdout.write(f'Linked {count} folders.')
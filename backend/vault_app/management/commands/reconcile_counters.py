@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from vault_app import counters
+
+
+class Command(BaseCommand):
+    help = 'Recompute the document counters of folders, tags and users from their documents.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        totals = counters.reconcile(batch_size=options['batch_size'])
+        self.stdout.write(
+            'Reconciled {folders} folders, {tags} tags and {users} users.'.format(**totals)
+        )
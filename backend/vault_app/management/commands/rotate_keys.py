@@ -0,0 +1,134 @@
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from vault_app import key_rotation
+
+REPORT_INTERVAL = 10
+
+
+class Command(BaseCommand):
+    help = (
+        'Re-encrypt every encrypted column and stored file with the first key of SECURED_FIELDS_KEY. '
+        'Deploy the new key as FERNET_KEY and the previous ones as FERNET_OLD_KEYS first; the old keys '
+        'can be dropped once this has finished. Interrupted runs resume from the checkpoint.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                            help='Processes re-encrypting batches, 0 to run them in this one.')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows per batch of columns.')
+        parser.add_argument('--file-batch-size', type=int, default=20, help='Files per batch.')
+        parser.add_argument('--max-mb-per-second', type=float, default=0,
+                            help='Limit on the total rate files are written at, 0 for none.')
+        parser.add_argument('--checkpoint', default='key-rotation.json')
+        parser.add_argument('--restart', action='store_true', help='Start over, ignoring the checkpoint.')
+
+    def handle(self, *args, **options):
+        if not getattr(settings, 'BLIND_INDEX_KEY', None):
+            # the index key would be derived from the new key, losing every search token
+            raise CommandError(
+                'Set BLIND_INDEX_KEY to the key derived from the previous FERNET_KEY before rotating: '
+                'python manage.py shell -c "from vault_app.blind_index import get_index_key; '
+                'print(get_index_key().decode())", run with the previous key.'
+            )
+
+        self.options = options
+        self.checkpoint = self.load_checkpoint()
+        processes = options['processes']
+        self.rate = options['max_mb_per_second'] * 1024 * 1024 / max(processes, 1)
+        self.totals = {'items': 0, 'bytes': 0, 'unreadable': 0}
+        self.started = self.reported = time.monotonic()
+
+        pool = None
+        if processes:
+            pool = ProcessPoolExecutor(
+                max_workers=processes, mp_context=multiprocessing.get_context('spawn'), initializer=django.setup,
+            )
+        try:
+            for target in key_rotation.targets():
+                self.rotate(pool, target, window=max(processes, 1) * 2)
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
+        self.report('all', self.totals['items'])
+        if self.totals['unreadable']:
+            self.stderr.write(
+                f'{self.totals["unreadable"]} values could not be decrypted with any configured key '
+                'and were left as they are.'
+            )
+
+    def load_checkpoint(self):
+        key_id = key_rotation.current_key_id()
+        path = self.options['checkpoint']
+        if not self.options['restart'] and os.path.exists(path):
+            with open(path) as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+            # a checkpoint of an earlier rotation says nothing about this one
+            if checkpoint.get('key_id') == key_id:
+                return checkpoint
+        return {'key_id': key_id, 'done': {}}
+
+    def save_checkpoint(self):
+        path = self.options['checkpoint']
+        with open(f'{path}.tmp', 'w') as checkpoint_file:
+            json.dump(self.checkpoint, checkpoint_file)
+        os.replace(f'{path}.tmp', path)
+
+    def rotate(self, pool, target, window):
+        """Rotate the batches of ``target``, checkpointing the last one all earlier ones finished with."""
+        batch_size = self.options['file_batch_size'] if target.startswith('files:') else self.options['batch_size']
+        after = self.checkpoint['done'].get(target, 0)
+        pending = {}
+        in_order = []
+        finished = set()
+        rotated = 0
+
+        def collect(return_when):
+            nonlocal rotated
+            done, _ = wait(pending, return_when=return_when)
+            for future in done:
+                items, written, unreadable = future.result()
+                rotated += items
+                self.totals['items'] += items
+                self.totals['bytes'] += written
+                self.totals['unreadable'] += unreadable
+                finished.add(pending.pop(future))
+
+            while in_order and in_order[0] in finished:
+                self.checkpoint['done'][target] = in_order.pop(0)
+            self.save_checkpoint()
+            if time.monotonic() - self.reported >= REPORT_INTERVAL:
+                self.report(target, rotated)
+
+        for first_pk, last_pk in key_rotation.plan(target, after, batch_size):
+            if pool is None:
+                future = Future()
+                future.set_result(key_rotation.run_batch(target, first_pk, last_pk, self.rate))
+            else:
+                future = pool.submit(key_rotation.run_batch, target, first_pk, last_pk, self.rate)
+            pending[future] = last_pk
+            in_order.append(last_pk)
+            if len(pending) >= window:
+                collect(FIRST_COMPLETED)
+
+        if pending:
+            collect(ALL_COMPLETED)
+        self.report(target, rotated)
+
+    def report(self, target, rotated):
+        self.reported = time.monotonic()
+        elapsed = max(self.reported - self.started, 1e-6)
+        megabytes = self.totals['bytes'] / 1024 / 1024
+        self.stdout.write(
+            f'{target}: {rotated} re-encrypted. In total {self.totals["items"]} rows and files, '
+            f'{megabytes:.1f} MB written in {elapsed:.0f}s ({self.totals["items"] / elapsed:.1f}/s, '
+            f'{megabytes / elapsed:.1f} MB/s).'
+        )
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from vault_app import benchmarks
+
+
+class Command(BaseCommand):
+    help = (
+        'Create a synthetic vault for the benchmark command: users named <prefix>-<n> with folders, tags '
+        'and documents drawn from a seeded generator, so the same options give the same vault.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prefix', default='bench')
+        parser.add_argument('--users', type=int, default=5)
+        parser.add_argument('--folders', type=int, default=10, help='Folders per user.')
+        parser.add_argument('--tags', type=int, default=10, help='Tags per user.')
+        parser.add_argument('--documents', type=int, default=1000, help='Documents per user.')
+        parser.add_argument('--file-size', type=int, default=16 * 1024, help='Bytes per document file.')
+        parser.add_argument('--distinct-files', type=int, default=20,
+                            help='Files per user, which its documents share.')
+        parser.add_argument('--password', default='benchmark')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--flush', action='store_true', help='Delete an earlier vault with this prefix first.')
+
+    def handle(self, *args, **options):
+        if options['flush']:
+            self.stdout.write(f'Deleted {benchmarks.flush(options["prefix"])} users.')
+        elif benchmarks.vault_fixtures(options['prefix'], options['users']):
+            raise CommandError(f'Users with the prefix {options["prefix"]!r} exist already, pass --flush.')
+        if options['distinct_files'] < 1:
+            raise CommandError('--distinct-files must be at least 1.')
+
+        totals = benchmarks.seed(
+            prefix=options['prefix'], users=options['users'], folders=options['folders'], tags=options['tags'],
+            documents=options['documents'], file_size=options['file_size'],
+            distinct_files=options['distinct_files'], password=options['password'], seed_value=options['seed'],
+        )
+        self.stdout.write(
+            'Created {users} users, {folders} folders, {tags} tags and {documents} documents '
+            'sharing {files} files.'.format(**totals)
+        )
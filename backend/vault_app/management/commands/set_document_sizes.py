@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand
+
+from vault_app import counters
+from vault_app.models import Document
+from vault_app.storage import FLAG_COMPRESSED, HEADER, MAGIC, plaintext_length
+
+
+class Command(BaseCommand):
+    help = (
+        'Fill in the plaintext size of documents stored before Document.size existed. Segmented files are '
+        'measured from their stored length and header; compressed ones read their chunk index, and files '
+        'in the whole-file Fernet format are decrypted, so run convert_encrypted_files first.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--all', action='store_true', help='Measure every document, not only those of size 0.')
+
+    def handle(self, *args, **options):
+        storage = Document._meta.get_field('file').storage
+        documents = Document.objects.exclude(file='')
+        if not options['all']:
+            documents = documents.filter(size=0)
+        updated = missing = 0
+
+        last_pk = 0
+        while True:
+            batch = list(documents.filter(pk__gt=last_pk).order_by('pk').only('pk', 'file', 'size')[:options['batch_size']])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+
+            changed = []
+            for document in batch:
+                try:
+                    size = self.size(storage, document.file.name)
+                except FileNotFoundError:
+                    missing += 1
+                    continue
+                if size != document.size:
+                    document.size = size
+                    changed.append(document)
+            Document.objects.bulk_update(changed, ['size'])
+            updated += len(changed)
+
+        # sizes were written without the signals, the totals are recomputed from them
+        if updated:
+            counters.reconcile(batch_size=options['batch_size'])
+        self.stdout.write(f'Updated {updated} documents, {missing} missing.')
+
+    def size(self, storage, name):
+        header = storage.header(name)
+        if len(header) == HEADER.size and header.startswith(MAGIC):
+            _, _, flags, chunk_size, _, _ = HEADER.unpack(header)
+            if not flags & FLAG_COMPRESSED:
+                return plaintext_length(storage.size(name), chunk_size)
+        with storage.open(name) as file_handle:
+            return file_handle.size
@@ -0,0 +1,18 @@
+from django.core.files.storage import FileSystemStorage
+from django.core.management.base import BaseCommand, CommandError
+
+from vault_app import blobs, sharding
+
+
+class Command(BaseCommand):
+    help = 'Move the files stored flat into the subdirectories of the sharded layout.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--workers', type=int, default=8, help='Files linked in parallel.')
+
+    def handle(self, *args, **options):
+        if not isinstance(blobs.file_storage(), FileSystemStorage):
+            raise CommandError('shard_files hard-links local files, and works on file system storage only.')
+        moved, missing = sharding.shard(options['batch_size'], options['workers'])
+        self.stdout.write(f'Moved {moved} files, {missing} missing.')
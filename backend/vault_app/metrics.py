@@ -0,0 +1,222 @@
+"""Prometheus metrics of requests and of the encryption they do.
+
+MetricsMiddleware times every request per endpoint (its URL name), the
+streaming of its response included, and records the database queries it
+ran, the bytes it received and sent, and the time and bytes the encrypted
+fields and storage spent encrypting and decrypting for it. Work done outside
+requests, such as previews and key rotation, is recorded under the endpoint
+``background``. Queries are also counted and timed per database alias,
+replicas included, whether or not a request ran them. The metrics are
+served on /metrics.
+
+Under gunicorn, set PROMETHEUS_MULTIPROC_DIR to an empty directory and use
+config/gunicorn.conf.py, so /metrics adds up the metrics of all workers.
+"""
+import contextvars
+import hmac
+import os
+import time
+from collections import defaultdict
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DatabaseError
+from django.http import HttpResponse
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+from . import profiler
+
+BYTE_BUCKETS = tuple(4 ** power * 1024 for power in range(11)) + (float('inf'),)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144, float('inf'))
+
+REQUEST_SECONDS = Histogram(
+    'vault_request_duration_seconds', 'Time to serve a request, streaming its response included.',
+    ['method', 'endpoint', 'status'],
+)
+DB_QUERIES = Histogram('vault_request_db_queries', 'Database queries per request.', ['endpoint'],
+                       buckets=QUERY_BUCKETS)
+DB_SECONDS = Histogram('vault_request_db_seconds', 'Time per request spent in database queries.', ['endpoint'])
+CRYPTO_SECONDS = Counter('vault_crypto_seconds', 'Time spent encrypting and decrypting.', ['endpoint', 'operation'])
+CRYPTO_BYTES = Counter('vault_crypto_bytes', 'Bytes encrypted and decrypted.', ['endpoint', 'operation'])
+DB_ALIAS_QUERIES = Counter('vault_db_queries', 'Database queries, per connection alias.', ['alias'])
+DB_ALIAS_SECONDS = Counter('vault_db_query_seconds', 'Time spent in database queries, per connection alias.',
+                           ['alias'])
+DB_ALIAS_ERRORS = Counter('vault_db_query_errors', 'Database queries that failed, per connection alias.', ['alias'])
+REPLICA_EJECTIONS = Counter('vault_db_replica_ejections', 'Failed checks and queries that left a read replica out.',
+                            ['alias'])
+TRANSFER_BYTES = Histogram('vault_transfer_bytes', 'Sizes of request and response bodies.',
+                           ['endpoint', 'direction'], buckets=BYTE_BUCKETS)
+
+BACKGROUND = 'background'
+
+_current = contextvars.ContextVar('vault_request_stats', default=None)
+
+
+class RequestStats:
+    """What a request did, added up while it runs and recorded once it is done."""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.crypto = defaultdict(lambda: [0.0, 0])
+
+
+def record_crypto(operation, seconds, size):
+    """Add ``seconds`` spent on ``size`` bytes of ``operation`` to the current request."""
+    stats = _current.get()
+    if stats is None:
+        CRYPTO_SECONDS.labels(BACKGROUND, operation).inc(seconds)
+        CRYPTO_BYTES.labels(BACKGROUND, operation).inc(size)
+        return
+    totals = stats.crypto[operation]
+    totals[0] += seconds
+    totals[1] += size
+
+
+def record_query(execute, sql, params, many, context):
+    """Execute wrapper counting the queries of each connection alias and of the current request."""
+    alias = context['connection'].alias
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    except DatabaseError:
+        DB_ALIAS_ERRORS.labels(alias).inc()
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        DB_ALIAS_QUERIES.labels(alias).inc()
+        DB_ALIAS_SECONDS.labels(alias).inc(seconds)
+        stats = _current.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_seconds += seconds
+
+
+def instrument_connection(sender, connection, **kwargs):
+    # connection_created fires again on reconnects of the same wrapper
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def endpoint_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else 'unmatched'
+
+
+def request_size(request):
+    try:
+        return int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return 0
+
+
+class MetricsMiddleware:
+    """Records the metrics of each request, after its response has been streamed."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        stats = RequestStats()
+        profile = profiler.start()
+        started = time.perf_counter()
+        token = _current.set(stats)
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            profiler.finish(profile, time.perf_counter() - started, endpoint_name(request))
+            raise
+        finally:
+            _current.reset(token)
+        return self.observe(request, response, stats, started, profile)
+
+    async def __acall__(self, request):
+        # the event loop thread serves other requests too, so async ones are not profiled
+        stats = RequestStats()
+        started = time.perf_counter()
+        token = _current.set(stats)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.observe(request, response, stats, started, None)
+
+    def observe(self, request, response, stats, started, profile):
+        def finish(sent):
+            duration = time.perf_counter() - started
+            endpoint = endpoint_name(request)
+            REQUEST_SECONDS.labels(request.method, endpoint, response.status_code).observe(duration)
+            DB_QUERIES.labels(endpoint).observe(stats.queries)
+            DB_SECONDS.labels(endpoint).observe(stats.db_seconds)
+            for operation, (seconds, size) in stats.crypto.items():
+                CRYPTO_SECONDS.labels(endpoint, operation).inc(seconds)
+                CRYPTO_BYTES.labels(endpoint, operation).inc(size)
+            received = request_size(request)
+            if received:
+                TRANSFER_BYTES.labels(endpoint, 'request').observe(received)
+            TRANSFER_BYTES.labels(endpoint, 'response').observe(sent)
+            profiler.finish(profile, duration, endpoint)
+
+        if not response.streaming:
+            finish(len(response.content))
+        elif response.is_async:
+            response.streaming_content = self.astream(response.streaming_content, stats, finish)
+        else:
+            response.streaming_content = self.stream(response.streaming_content, stats, finish)
+        return response
+
+    def stream(self, content, stats, finish):
+        sent = 0
+        iterator = iter(content)
+        try:
+            while True:
+                # set for each step, since the server resumes this generator in its own context
+                token = _current.set(stats)
+                try:
+                    data = next(iterator, None)
+                finally:
+                    _current.reset(token)
+                if data is None:
+                    break
+                sent += len(data)
+                yield data
+        finally:
+            finish(sent)
+
+    async def astream(self, content, stats, finish):
+        sent = 0
+        iterator = aiter(content)
+        try:
+            while True:
+                token = _current.set(stats)
+                try:
+                    data = await anext(iterator, None)
+                finally:
+                    _current.reset(token)
+                if data is None:
+                    break
+                sent += len(data)
+                yield data
+        finally:
+            finish(sent)
+
+
+def metrics_view(request):
+    """The metrics in the Prometheus text format, of every worker when running multiprocess."""
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if token and not hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {token}'):
+        return HttpResponse(status=401)
+
+    registry = REGISTRY
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:40
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def build_blind_index(apps, schema_editor):
+    from vault_app import blind_index
+
+    BlindIndexToken = apps.get_model('vault_app', 'BlindIndexToken')
+    for model_name in ('folder', 'tag', 'document'):
+        model = apps.get_model('vault_app', model_name)
+        rows = []
+        for instance in model.objects.iterator(chunk_size=BATCH_SIZE):
+            for token in blind_index.value_tokens(instance.user_id, model_name, 'name', instance.name):
+                rows.append(BlindIndexToken(
+                    user_id=instance.user_id, model=model_name, object_id=instance.pk, token=token,
+                ))
+            if len(rows) >= BATCH_SIZE:
+                BlindIndexToken.objects.bulk_create(rows)
+                rows = []
+        BlindIndexToken.objects.bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vault_app', '0002_alter_document_file_alter_document_name_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BlindIndexToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=20)),
+                ('object_id', models.BigIntegerField()),
+                ('token', models.CharField(max_length=32)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'model', 'token'], name='vault_app_b_user_id_829ec5_idx'), models.Index(fields=['model', 'object_id'], name='vault_app_b_model_edd873_idx')],
+            },
+        ),
+        migrations.RunPython(build_blind_index, migrations.RunPython.noop),
+    ]
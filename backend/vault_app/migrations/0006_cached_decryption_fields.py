@@ -0,0 +1,64 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:48
+
+import vault_app.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vault_app', '0005_document_size_tag_created_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='document',
+            name='name',
+            field=vault_app.fields.EncryptedCharField(max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='folder',
+            name='name',
+            field=vault_app.fields.EncryptedCharField(max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='tag',
+            name='name',
+            field=vault_app.fields.EncryptedCharField(max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='uploadsession',
+            name='filename',
+            field=vault_app.fields.EncryptedCharField(max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='uploadsession',
+            name='name',
+            field=vault_app.fields.EncryptedCharField(max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='dob',
+            field=vault_app.fields.EncryptedDateField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='email',
+            field=vault_app.fields.EncryptedCharField(blank=True, max_length=254, verbose_name='email address'),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='first_name',
+            field=vault_app.fields.EncryptedCharField(blank=True, max_length=150, verbose_name='first name'),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='last_name',
+            field=vault_app.fields.EncryptedCharField(blank=True, max_length=150, verbose_name='last name'),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='phone_number',
+            field=vault_app.fields.EncryptedCharField(max_length=15),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:01
+
+import django.db.models.deletion
+import secured_fields.fields.files
+import vault_app.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vault_app', '0007_blob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Preview',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('ready', 'Ready'), ('unsupported', 'Unsupported'), ('failed', 'Failed')], default='pending', max_length=12)),
+                ('file', secured_fields.fields.files.EncryptedFileField(blank=True, storage=vault_app.storage.SegmentedEncryptedFileSystemStorage(), upload_to='previews/')),
+                ('content_type', models.CharField(blank=True, max_length=50)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('document', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='preview', to='vault_app.document')),
+            ],
+        ),
+    ]
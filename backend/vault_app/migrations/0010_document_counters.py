@@ -0,0 +1,82 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:06
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Sum
+from django.db.models.functions import Coalesce
+
+
+def count_documents(apps, schema_editor):
+    for model_name in ('Folder', 'Tag', 'User'):
+        model = apps.get_model('vault_app', model_name)
+        rows = model.objects.annotate(
+            counted=Count('documents'),
+            summed=Coalesce(Sum('documents__size'), 0),
+            modified=Max('documents__updated_at'),
+        ).values_list('pk', 'counted', 'summed', 'modified')
+        model.objects.bulk_update(
+            [model(pk=pk, document_count=count, total_bytes=size, last_modified=modified)
+             for pk, count, size, modified in rows],
+            ['document_count', 'total_bytes', 'last_modified'],
+            batch_size=500,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vault_app', '0009_content_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='folder',
+            name='document_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='folder',
+            name='last_modified',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='folder',
+            name='total_bytes',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='tag',
+            name='document_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='tag',
+            name='last_modified',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='tag',
+            name='total_bytes',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='document_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='last_modified',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='storage_quota',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='total_bytes',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(count_documents, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vault_app', '0010_document_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='vault_version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def link_folders(apps, schema_editor):
+    # every existing folder is at the top level, linked only to itself
+    Folder = apps.get_model('vault_app', 'Folder')
+    FolderLink = apps.get_model('vault_app', 'FolderLink')
+    FolderLink.objects.bulk_create(
+        [FolderLink(ancestor_id=pk, descendant_id=pk, depth=0) for pk in Folder.objects.values_list('pk', flat=True)],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vault_app', '0012_blob_stored_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='folder',
+            name='parent',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='children', to='vault_app.folder'),
+        ),
+        migrations.CreateModel(
+            name='FolderLink',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='vault_app.folder')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='vault_app.folder')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['descendant', 'depth'], name='vault_app_f_descend_484072_idx')],
+                'unique_together': {('ancestor', 'descendant')},
+            },
+        ),
+        migrations.RunPython(link_folders, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:56
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F
+
+
+def journal_existing(apps, schema_editor):
+    # everything there is counts as changed at a new version, above 0 which cursors start from
+    User = apps.get_model('vault_app', 'User')
+    Change = apps.get_model('vault_app', 'Change')
+    User.objects.update(vault_version=F('vault_version') + 1)
+    versions = dict(User.objects.values_list('pk', 'vault_version'))
+    for model_name in ('Folder', 'Tag', 'Document'):
+        model = apps.get_model('vault_app', model_name)
+        Change.objects.bulk_create(
+            [Change(user_id=user_id, model=model_name.lower(), object_id=pk, sequence=versions[user_id])
+             for pk, user_id in model.objects.values_list('pk', 'user_id').iterator()],
+            batch_size=1000,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vault_app', '0013_folder_tree'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='sync_horizon',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='Change',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=20)),
+                ('object_id', models.BigIntegerField()),
+                ('sequence', models.PositiveBigIntegerField()),
+                ('deleted', models.BooleanField(default=False)),
+                ('changed_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'sequence'], name='vault_app_c_user_id_f0808e_idx')],
+                'unique_together': {('user', 'model', 'object_id')},
+            },
+        ),
+        migrations.RunPython(journal_existing, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,50 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+TOKEN_SIZE = 16
+
+
+def post_terms(apps, schema_editor):
+    # the tokens each document is posted under are kept with its content
+    DocumentContent = apps.get_model('vault_app', 'DocumentContent')
+    ContentTerm = apps.get_model('vault_app', 'ContentTerm')
+    contents = DocumentContent.objects.exclude(terms=b'').values_list('user_id', 'document_id', 'terms')
+    rows = []
+    for user_id, document_id, terms in contents.iterator(chunk_size=500):
+        terms = bytes(terms)
+        rows.extend(
+            ContentTerm(user_id=user_id, document_id=document_id, token=terms[i:i + TOKEN_SIZE])
+            for i in range(0, len(terms), TOKEN_SIZE)
+        )
+        if len(rows) >= 5000:
+            ContentTerm.objects.bulk_create(rows, batch_size=1000)
+            rows = []
+    ContentTerm.objects.bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vault_app', '0015_soft_delete'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='ContentTerm',
+        ),
+        migrations.CreateModel(
+            name='ContentTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.BinaryField(max_length=16)),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='vault_app.document')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'token', 'document')},
+            },
+        ),
+        migrations.RunPython(post_terms, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:44
+
+import secured_fields.fields.files
+import vault_app.storage
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vault_app', '0016_content_postings'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='document',
+            name='file',
+            field=secured_fields.fields.files.EncryptedFileField(storage=vault_app.storage.SegmentedEncryptedFileSystemStorage(), upload_to=''),
+        ),
+    ]
@@ -1,33 +1,90 @@
-from django.db import models
+import uuid
+
+from django.db import models, transaction
 from django.contrib.auth.models import AbstractUser
 import secured_fields
 
+from . import fields
+
+
+class DocumentCounters(models.Model):
+    """Counters of the documents in a folder, under a tag or of a user, maintained by counters.py."""
+    document_count = models.PositiveIntegerField(default=0)
+    total_bytes = models.PositiveBigIntegerField(default=0)
+    last_modified = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        abstract = True
+
+class LiveManager(models.Manager):
+    """Rows that are not soft-deleted; ``all_objects`` has them all (see reaper.py)."""
 
-class User(AbstractUser):
-    first_name = secured_fields.EncryptedCharField(blank=True, max_length=150, verbose_name='first name')
-    last_name = secured_fields.EncryptedCharField(blank=True, max_length=150, verbose_name='last name')
-    email = secured_fields.EncryptedCharField(blank=True, max_length=254, verbose_name='email address')
-    dob = secured_fields.EncryptedDateField(null=True, blank=True)
-    phone_number = secured_fields.EncryptedCharField(max_length=15)
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
+class User(AbstractUser, DocumentCounters):
+    first_name = fields.EncryptedCharField(blank=True, max_length=150, verbose_name='first name')
+    last_name = fields.EncryptedCharField(blank=True, max_length=150, verbose_name='last name')
+    email = fields.EncryptedCharField(blank=True, max_length=254, verbose_name='email address')
+    dob = fields.EncryptedDateField(null=True, blank=True)
+    phone_number = fields.EncryptedCharField(max_length=15)
 
     gender_choices = (('male', 'Male'), ('female', 'Female'))
     gender = models.CharField(choices=gender_choices, max_length=10)
+    # bytes of documents the user may store, None for STORAGE_QUOTA
+    storage_quota = models.PositiveBigIntegerField(null=True, blank=True)
+    # bumped by versions.py on every change to the user's folders, tags and documents
+    vault_version = models.PositiveBigIntegerField(default=0)
+    # vault version of the latest tombstone compacted away; older sync cursors have to start over
+    sync_horizon = models.PositiveBigIntegerField(default=0)
 
     def __str__(self):
         return self.username
 
-class Folder(models.Model):
-    name = secured_fields.EncryptedCharField(max_length=255)
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        # users from authentication.py have most fields deferred; reading one loads them all
+        deferred = self.get_deferred_fields()
+        if fields is not None and deferred and set(fields) <= deferred:
+            fields = deferred
+        super().refresh_from_db(using, fields, **kwargs)
+
+class Folder(DocumentCounters):
+    blind_index_fields = ('name',)
+
+    name = fields.EncryptedCharField(max_length=255)
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='folders')
+    # None for top level folders; FolderLink holds the whole hierarchy (see folder_tree.py)
+    parent = models.ForeignKey('self', null=True, blank=True, on_delete=models.CASCADE, related_name='children')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # set when the folder was deleted, until the reaper removes the row
+    deleted_at = models.DateTimeField(null=True, blank=True)
+
+    objects = LiveManager()
+    all_objects = models.Manager()
 
     def __str__(self):
         return self.name
 
-class Tag(models.Model):
-    name = secured_fields.EncryptedCharField(max_length=100)
+class FolderLink(models.Model):
+    """Closure of the folder hierarchy: ``ancestor`` is ``depth`` levels above ``descendant``.
+
+    Every folder is also linked to itself at depth 0.
+    """
+    ancestor = models.ForeignKey(Folder, on_delete=models.CASCADE, related_name='descendant_links')
+    descendant = models.ForeignKey(Folder, on_delete=models.CASCADE, related_name='ancestor_links')
+    depth = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = ('ancestor', 'descendant')
+        indexes = [models.Index(fields=['descendant', 'depth'])]
+
+class Tag(DocumentCounters):
+    blind_index_fields = ('name',)
+
+    name = fields.EncryptedCharField(max_length=100)
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='tags')
+    created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         unique_together = ('name', 'user')
@@ -35,15 +92,138 @@ class Tag(models.Model):
     def __str__(self):
         return self.name
 
+class Blob(models.Model):
+    """One stored copy of a plaintext, shared by the documents of a user with that content.
+
+    ``digest`` is keyed per user (see blobs.py), so equal files of different
+    users neither share a blob nor reveal that they are equal.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    digest = models.CharField(max_length=64)
+    name = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    # bytes of the encrypted, possibly compressed file; null for blobs stored before it was recorded
+    stored_size = models.PositiveBigIntegerField(null=True, blank=True)
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('user', 'digest')
+
 class Document(models.Model):
-    name = secured_fields.EncryptedCharField(max_length=255)
+    blind_index_fields = ('name',)
+
+    name = fields.EncryptedCharField(max_length=255)
+    # names the file of ``blob``; documents stored before blobs have none
     file = secured_fields.EncryptedFileField(upload_to='')
+    blob = models.ForeignKey(Blob, null=True, blank=True, on_delete=models.RESTRICT, related_name='documents')
     file_type = models.CharField(max_length=50, blank=True)
+    size = models.PositiveBigIntegerField(default=0)
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='documents')
     folder = models.ForeignKey(Folder, on_delete=models.CASCADE, related_name='documents')
     tags = models.ManyToManyField(Tag, blank=True, related_name='documents')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # set when the document was deleted with its folder, until the reaper removes the row
+    deleted_at = models.DateTimeField(null=True, blank=True)
+
+    objects = LiveManager()
+    all_objects = models.Manager()
+
+    def save(self, *args, **kwargs):
+        # plaintext size, the stored file is larger once encrypted
+        if self.file and not self.file._committed:
+            self.size = self.file.size
+        # the signal handlers lock the row to move its counts, until the save commits
+        with transaction.atomic():
+            super().save(*args, **kwargs)
 
     def __str__(self):
-        return self.name
\ No newline at end of file
+        return self.name
+
+class Preview(models.Model):
+    """Encrypted thumbnail of a document, rendered in the background (see previews.py)."""
+    PENDING = 'pending'
+    READY = 'ready'
+    UNSUPPORTED = 'unsupported'
+    FAILED = 'failed'
+    status_choices = ((PENDING, 'Pending'), (READY, 'Ready'), (UNSUPPORTED, 'Unsupported'), (FAILED, 'Failed'))
+
+    document = models.OneToOneField(Document, on_delete=models.CASCADE, related_name='preview')
+    # content the preview was rendered from, a different one makes it stale
+    digest = models.CharField(max_length=64)
+    status = models.CharField(choices=status_choices, max_length=12, default=PENDING)
+    file = secured_fields.EncryptedFileField(upload_to='previews/', blank=True)
+    content_type = models.CharField(max_length=50, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+class DocumentContent(models.Model):
+    """Index state of a document's text (see content_index.py)."""
+    PENDING = 'pending'
+    INDEXED = 'indexed'
+    UNSUPPORTED = 'unsupported'
+    FAILED = 'failed'
+    status_choices = ((PENDING, 'Pending'), (INDEXED, 'Indexed'), (UNSUPPORTED, 'Unsupported'), (FAILED, 'Failed'))
+
+    document = models.OneToOneField(Document, on_delete=models.CASCADE, related_name='content')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    digest = models.CharField(max_length=64)
+    status = models.CharField(choices=status_choices, max_length=12, default=PENDING)
+    # terms the document is posted under, concatenated 16 byte tokens
+    terms = models.BinaryField(default=b'')
+    updated_at = models.DateTimeField(auto_now=True)
+
+class ContentTerm(models.Model):
+    """Posting of one keyed-HMAC term: a document of the user containing it."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    token = models.BinaryField(max_length=16)
+    document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name='+')
+
+    class Meta:
+        unique_together = ('user', 'token', 'document')
+
+class UploadSession(models.Model):
+    """A resumable upload, encrypted to a partial file as its chunks arrive."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='upload_sessions')
+    folder = models.ForeignKey(Folder, on_delete=models.CASCADE, related_name='upload_sessions')
+    name = fields.EncryptedCharField(max_length=255)
+    filename = fields.EncryptedCharField(max_length=255)
+    file_type = models.CharField(max_length=50, blank=True)
+    tags = models.ManyToManyField(Tag, blank=True, related_name='+')
+    size = models.PositiveBigIntegerField()
+    chunk_size = models.PositiveIntegerField()
+    received = models.PositiveBigIntegerField(default=0)
+    # keyed digest of the sha256 the client announced, empty when it did not
+    digest = models.CharField(max_length=64, blank=True)
+    next_index = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class BlindIndexToken(models.Model):
+    """Keyed HMAC token of an encrypted name, used to search without decrypting."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    model = models.CharField(max_length=20)
+    object_id = models.BigIntegerField()
+    token = models.CharField(max_length=32)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'model', 'token']),
+            models.Index(fields=['model', 'object_id']),
+        ]
+
+
+class Change(models.Model):
+    """Latest change of a folder, tag or document, at the vault version it was made (see journal.py)."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    model = models.CharField(max_length=20)
+    object_id = models.BigIntegerField()
+    sequence = models.PositiveBigIntegerField()
+    deleted = models.BooleanField(default=False)
+    changed_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('user', 'model', 'object_id')
+        indexes = [models.Index(fields=['user', 'sequence'])]
@@ -0,0 +1,291 @@
+"""S3-compatible storage of document files, in the segmented format.
+
+Files are encrypted while they are uploaded. The encrypted stream is cut
+into parts of PART_SIZE bytes and sent as one multipart upload. A thread
+pool sends up to CONCURRENCY parts at a time, so an upload holds no more
+than that many parts in memory. Files no larger than one part go up in a
+single PUT.
+
+Reads fetch byte ranges of at least READ_SIZE bytes. SegmentedFile then
+decrypts chunks straight from the object, and a range request only reads
+the chunks it covers.
+
+Each process has one boto3 client. The client is thread-safe and keeps a
+pool of MAX_POOL_CONNECTIONS connections. Any S3 API works, a local MinIO
+included, through ENDPOINT_URL (see S3_STORAGE in the settings).
+"""
+import functools
+import io
+import itertools
+import os
+import posixpath
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urljoin
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.core.files.storage import Storage
+from django.utils import timezone
+from django.utils.deconstruct import deconstructible
+from django.utils.encoding import filepath_to_uri
+from secured_fields.mixins import EncryptedStorageMixin
+
+from .storage import (
+    HEADER, MAGIC, compress_file, compression_flags, encrypt_stream, get_chunk_size, open_decrypted,
+)
+
+DEFAULT_OPTIONS = {
+    'BUCKET': None,
+    'ENDPOINT_URL': None,
+    'REGION': None,
+    'ACCESS_KEY_ID': None,
+    'SECRET_ACCESS_KEY': None,
+    # prepended to every name, to share a bucket
+    'PREFIX': '',
+    'PART_SIZE': 8 * 1024 * 1024,
+    'CONCURRENCY': 4,
+    'MAX_POOL_CONNECTIONS': 16,
+    'READ_SIZE': 1024 * 1024,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_client(endpoint_url, region, access_key_id, secret_access_key, max_pool_connections):
+    return boto3.session.Session().client(
+        's3',
+        endpoint_url=endpoint_url,
+        region_name=region,
+        aws_access_key_id=access_key_id,
+        aws_secret_access_key=secret_access_key,
+        config=Config(max_pool_connections=max_pool_connections, retries={'mode': 'standard'}),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_executor(concurrency):
+    return ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='s3-parts')
+
+
+def split_parts(chunks, part_size):
+    """Pieces of ``part_size`` bytes of the byte strings of ``chunks``, the last one shorter."""
+    pending = bytearray()
+    for data in chunks:
+        pending += data
+        while len(pending) >= part_size:
+            yield bytes(pending[:part_size])
+            del pending[:part_size]
+    if pending:
+        yield bytes(pending)
+
+
+def is_missing(error):
+    return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+
+class ObjectReader(io.RawIOBase):
+    """Read-only, seekable view of an object, fetched by ranges of at least ``read_size`` bytes."""
+
+    def __init__(self, storage, name, size, read_size):
+        super().__init__()
+        self.storage = storage
+        self.name = name
+        self.size = size
+        self.read_size = read_size
+        self.position = 0
+        self.buffer_start = 0
+        self.buffer = b''
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+        end = min(self.position + size, self.size)
+        if end <= self.position:
+            return b''
+
+        buffer_end = self.buffer_start + len(self.buffer)
+        if not self.buffer_start <= self.position or end > buffer_end:
+            self.buffer_start = self.position
+            self.buffer = self.storage.read_range(
+                self.name, self.position, min(max(end, self.position + self.read_size), self.size),
+            )
+        data = self.buffer[self.position - self.buffer_start:end - self.buffer_start]
+        self.position += len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+@deconstructible
+class SegmentedEncryptedS3Storage(EncryptedStorageMixin, Storage):
+    """Stores files in the segmented format in an S3 bucket.
+
+    Files in the whole-file Fernet format are read too, for buckets filled
+    with copies of older file system storage.
+    """
+
+    def __init__(self, **options):
+        self.options = {**DEFAULT_OPTIONS, **getattr(settings, 'S3_STORAGE', {}), **options}
+
+    @property
+    def client(self):
+        options = self.options
+        return get_client(
+            options['ENDPOINT_URL'], options['REGION'], options['ACCESS_KEY_ID'], options['SECRET_ACCESS_KEY'],
+            options['MAX_POOL_CONNECTIONS'],
+        )
+
+    def key(self, name):
+        return self.options['PREFIX'] + name
+
+    def head(self, name):
+        return self.client.head_object(Bucket=self.options['BUCKET'], Key=self.key(name))
+
+    def read_range(self, name, start, end):
+        """Bytes ``start`` up to ``end`` of the object ``name``."""
+        response = self.client.get_object(
+            Bucket=self.options['BUCKET'], Key=self.key(name), Range=f'bytes={start}-{end - 1}',
+        )
+        with response['Body'] as body:
+            return body.read()
+
+    def upload(self, name, chunks):
+        """Store the byte strings of ``chunks`` as ``name``, in parts sent in parallel if there are several."""
+        bucket, key = self.options['BUCKET'], self.key(name)
+        concurrency = self.options['CONCURRENCY']
+        parts = split_parts(chunks, self.options['PART_SIZE'])
+        first = next(parts, b'')
+        second = next(parts, None)
+        if second is None:
+            self.client.put_object(Bucket=bucket, Key=key, Body=first)
+            return
+
+        upload_id = self.client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+        pending, completed = set(), []
+        try:
+            for number, data in enumerate(itertools.chain((first, second), parts), start=1):
+                if len(pending) >= concurrency:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    completed.extend(future.result() for future in done)
+                pending.add(get_executor(concurrency).submit(self._upload_part, key, upload_id, number, data))
+            completed.extend(future.result() for future in wait(pending).done)
+            self.client.complete_multipart_upload(
+                Bucket=bucket, Key=key, UploadId=upload_id,
+                MultipartUpload={'Parts': sorted(completed, key=lambda part: part['PartNumber'])},
+            )
+        except BaseException:
+            wait(pending)
+            self.client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+            raise
+
+    def _upload_part(self, key, upload_id, number, data):
+        response = self.client.upload_part(
+            Bucket=self.options['BUCKET'], Key=key, UploadId=upload_id, PartNumber=number, Body=data,
+        )
+        return {'PartNumber': number, 'ETag': response['ETag']}
+
+    def _open(self, name, mode='rb'):
+        raw = ObjectReader(self, name, self.size(name), self.options['READ_SIZE'])
+        return open_decrypted(raw, name)
+
+    def _save(self, name, content):
+        flags = compression_flags(content, getattr(content, 'content_type', ''))
+        self.upload(name, encrypt_stream(content.chunks(get_chunk_size()), flags=flags))
+        return name
+
+    def save_document(self, name, content, file_type='', max_length=None):
+        """save() for document content, whose ``file_type`` decides along with its bytes on compression."""
+        name = self.get_available_name(name, max_length=max_length)
+        flags = compression_flags(content, file_type)
+        self.upload(name, encrypt_stream(content.chunks(get_chunk_size()), flags=flags))
+        return name
+
+    def save_encrypted(self, name, path, max_length=None, file_type=''):
+        """Upload the segmented file at ``path`` under an available ``name``, then remove it.
+
+        It is compressed first unless ``file_type`` or its content say it is not worth it.
+        """
+        compress_file(path, file_type)
+        name = self.get_available_name(name, max_length=max_length)
+        with open(path, 'rb') as source:
+            self.upload(name, iter(lambda: source.read(self.options['PART_SIZE']), b''))
+        os.unlink(path)
+        return name
+
+    def is_segmented(self, name):
+        return self.read_range(name, 0, len(MAGIC)) == MAGIC
+
+    def header(self, name):
+        """The first HEADER.size stored bytes of ``name``, or raise FileNotFoundError."""
+        try:
+            return self.read_range(name, 0, HEADER.size)
+        except ClientError as error:
+            if is_missing(error):
+                raise FileNotFoundError(name) from error
+            raise
+
+    def rewrite(self, name, chunks):
+        """Store ``chunks`` as a copy of ``name``; returns the copy's name, or None if ``name`` was deleted before.
+
+        Objects are not replaced in place, since downloads read them by
+        ranges and would get a mix of both. The caller points the rows at the
+        copy and deletes the old object once that commits (blobs.rename_file).
+        """
+        if not self.exists(name):
+            return None
+        new_name = self.get_available_name(name)
+        self.upload(new_name, chunks)
+        return new_name
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.options['BUCKET'], Key=self.key(name))
+
+    def exists(self, name):
+        try:
+            self.head(name)
+        except ClientError as error:
+            if is_missing(error):
+                return False
+            raise
+        return True
+
+    def size(self, name):
+        return self.head(name)['ContentLength']
+
+    def url(self, name):
+        # served decrypted by the app, like the file system storage's files
+        return urljoin(settings.MEDIA_URL, filepath_to_uri(name))
+
+    def get_modified_time(self, name):
+        modified = self.head(name)['LastModified']
+        return modified if settings.USE_TZ else timezone.make_naive(modified)
+
+    def listdir(self, path):
+        prefix = self.key(posixpath.join(path, '') if path else '')
+        directories, files = [], []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.options['BUCKET'], Prefix=prefix, Delimiter='/'):
+            directories.extend(entry['Prefix'][len(prefix):].rstrip('/') for entry in page.get('CommonPrefixes', ()))
+            files.extend(entry['Key'][len(prefix):] for entry in page.get('Contents', ()))
+        return directories, files
@@ -0,0 +1,9 @@
+from rest_framework.pagination import CursorPagination
+
+
+class VaultCursorPagination(CursorPagination):
+    """Keyset pagination on ``created_at, id``, newest first."""
+    ordering = ('-created_at', '-id')
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
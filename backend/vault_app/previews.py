@@ -0,0 +1,115 @@
+"""Background rendering of document previews.
+
+Saving a document's content queues a job on the worker pool. The
+worker decrypts the file, renders a small JPEG of the image or of the first
+page of the PDF, and hands it back to be stored, encrypted, as the
+document's Preview. Only the workers need Pillow and pypdfium2.
+"""
+import functools
+import io
+import logging
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.utils import timezone
+
+from . import workers
+from .blobs import content_digest
+from .models import Document, Preview
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZE = 256
+# a job still pending after this long was lost with its worker and is queued again
+PENDING_TIMEOUT = timedelta(minutes=5)
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.webp'}
+
+
+def preview_kind(file_type, name):
+    if file_type == 'application/pdf' or name.lower().endswith('.pdf'):
+        return 'pdf'
+    if file_type.startswith('image/') or os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+        return 'image'
+    return None
+
+
+def render(name, kind, size):
+    """JPEG of at most ``size`` pixels a side of the stored file ``name``."""
+    from PIL import Image
+
+    with Document._meta.get_field('file').storage.open(name) as plaintext:
+        if kind == 'pdf':
+            import pypdfium2
+
+            # pdfium reads through the file object, so only the first page is decrypted
+            pdf = pypdfium2.PdfDocument(plaintext)
+            try:
+                page = pdf[0]
+                image = page.render(scale=size / max(page.get_size())).to_pil()
+            finally:
+                pdf.close()
+        else:
+            image = Image.open(plaintext)
+            image.draft('RGB', (size, size))
+            image.thumbnail((size, size))
+
+    output = io.BytesIO()
+    image.convert('RGB').save(output, 'JPEG', quality=75, optimize=True)
+    return output.getvalue()
+
+
+def render_job(name, kind, size):
+    try:
+        return Preview.READY, render(name, kind, size)
+    except Exception:
+        logger.exception('Rendering the preview of %s failed.', name)
+        return Preview.FAILED, None
+
+
+def finish(document_id, digest, result):
+    status, data = result
+    preview = Preview.objects.filter(document_id=document_id, digest=digest).first()
+    if preview is None:
+        # the document was deleted or its content replaced meanwhile
+        return
+
+    previous = preview.file.name
+    if data is not None:
+        preview.file.save(f'{document_id}-{digest[:16]}.jpg', ContentFile(data), save=False)
+        preview.content_type = 'image/jpeg'
+    preview.status = status
+    preview.save()
+    if previous and previous != preview.file.name:
+        preview.file.storage.delete(previous)
+
+
+def submit(document_id, name, kind, digest):
+    size = getattr(settings, 'PREVIEW_SIZE', DEFAULT_SIZE)
+    workers.submit(render_job, (name, kind, size), functools.partial(finish, document_id, digest))
+
+
+def enqueue(documents):
+    """Queue preview jobs for ``documents``, whose ``blob`` should be loaded."""
+    previews = []
+    jobs = []
+    for document in documents:
+        digest = content_digest(document)
+        kind = preview_kind(document.file_type, document.file.name)
+        previews.append(Preview(
+            document_id=document.pk, digest=digest, status=Preview.PENDING if kind else Preview.UNSUPPORTED,
+        ))
+        if kind:
+            jobs.append((document.pk, document.file.name, kind, digest))
+
+    Preview.objects.bulk_create(
+        previews, update_conflicts=True, unique_fields=['document'], update_fields=['digest', 'status', 'updated_at'],
+    )
+    for job in jobs:
+        transaction.on_commit(lambda job=job: submit(*job))
+
+
+def is_lost(preview):
+    return preview.status == Preview.PENDING and preview.updated_at < timezone.now() - PENDING_TIMEOUT
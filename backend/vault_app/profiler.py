@@ -0,0 +1,115 @@
+"""Sampling profiler for slow requests.
+
+When SLOW_REQUEST_PROFILER['ENABLED'] is set, a daemon thread samples the
+stack of every thread serving a request each INTERVAL seconds. The samples
+of requests that took longer than THRESHOLD seconds are written to
+DIRECTORY in the folded format flamegraph.pl and speedscope read: one
+``frame;frame;...;frame count`` line per distinct stack. Requests that
+finish in time only cost adding and removing their thread.
+"""
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+
+DEFAULTS = {
+    'ENABLED': False,
+    'THRESHOLD': 1.0,
+    'INTERVAL': 0.005,
+    'DIRECTORY': 'profiles',
+}
+
+_sampler = None
+_sampler_lock = threading.Lock()
+
+
+def get_options():
+    return {**DEFAULTS, **getattr(settings, 'SLOW_REQUEST_PROFILER', {})}
+
+
+def frame_name(frame):
+    code = frame.f_code
+    name = getattr(code, 'co_qualname', code.co_name)
+    return f'{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+def folded_stack(frame):
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Sampler:
+    """Samples the stacks of the registered threads from a daemon thread."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.samples = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name='vault-profiler', daemon=True)
+        self.thread.start()
+
+    def add(self, thread_id):
+        with self.lock:
+            self.samples[thread_id] = Counter()
+
+    def remove(self, thread_id):
+        with self.lock:
+            return self.samples.pop(thread_id, Counter())
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.samples:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, samples in self.samples.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        samples[folded_stack(frame)] += 1
+
+
+def get_sampler(interval):
+    global _sampler
+
+    with _sampler_lock:
+        if _sampler is None:
+            _sampler = Sampler(interval)
+    return _sampler
+
+
+def start():
+    """Start sampling the current thread; returns what finish() needs, None when disabled."""
+    options = get_options()
+    if not options['ENABLED']:
+        return None
+    thread_id = threading.get_ident()
+    get_sampler(options['INTERVAL']).add(thread_id)
+    return thread_id, options
+
+
+def finish(profile, duration, label):
+    """Stop sampling, and write the samples if the request was slow; returns the file written."""
+    if profile is None:
+        return None
+    thread_id, options = profile
+    samples = get_sampler(options['INTERVAL']).remove(thread_id)
+    if duration < options['THRESHOLD'] or not samples:
+        return None
+
+    os.makedirs(options['DIRECTORY'], exist_ok=True)
+    name = '{}-{}-{}-{}ms.folded'.format(
+        time.strftime('%Y%m%d-%H%M%S'), os.getpid(), re.sub(r'[^\w.-]+', '_', label), int(duration * 1000),
+    )
+    path = os.path.join(options['DIRECTORY'], name)
+    with open(path, 'w') as profile_file:
+        for stack, count in samples.most_common():
+            profile_file.write(f'{stack} {count}\n')
+    return path
@@ -0,0 +1,95 @@
+"""Removal of soft-deleted folders and documents.
+
+Deleting a folder only marks it, its subfolders and their documents with
+deleted_at (see folder_tree.delete()); the managers' ``objects`` leave them
+out from then on. reap() deletes the marked rows in batches, each in its own
+transaction, documents first through bulk.remove(), which gives up their
+blobs, then folders from the deepest up, so no statement cascades through
+more than one batch.
+
+schedule() runs it on a thread of this process once the deleting
+transaction commits, one thread at a time; BACKGROUND_WORKERS = 0 runs it
+inline instead. What a process did not get to, because it stopped, is reaped
+on the next deletion or by the reap_deleted command.
+"""
+import logging
+import threading
+
+from django.db import close_old_connections, transaction
+from django.db.models import Max
+
+from . import blind_index, bulk, signals, workers
+from .models import Document, Folder
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 500
+
+_lock = threading.Lock()
+_thread = None
+_pending = False
+
+
+def reap(batch_size=DEFAULT_BATCH_SIZE):
+    """Delete the soft-deleted rows, ``batch_size`` at a time; returns the documents and folders deleted."""
+    # documents added to a folder while it was being deleted
+    stragglers = Document.objects.filter(folder__deleted_at__isnull=False)
+    for user_id in set(stragglers.values_list('user_id', flat=True)):
+        bulk.hide(user_id, stragglers)
+
+    documents = 0
+    hidden = Document.all_objects.filter(deleted_at__isnull=False).order_by('pk').values_list('pk', flat=True)
+    while ids := list(hidden[:batch_size]):
+        with transaction.atomic(), signals.bulk_write():
+            bulk.remove(ids)
+        documents += len(ids)
+
+    folder_ids = list(
+        Folder.all_objects.filter(deleted_at__isnull=False)
+        .annotate(level=Max('ancestor_links__depth'))
+        .order_by('-level', 'pk')
+        .values_list('pk', flat=True)
+    )
+    for start in range(0, len(folder_ids), batch_size):
+        batch = folder_ids[start:start + batch_size]
+        with transaction.atomic(), signals.bulk_write():
+            Folder.all_objects.filter(pk__in=batch).delete()
+            blind_index.unindex_ids(Folder, batch)
+    return documents, len(folder_ids)
+
+
+def _run():
+    global _thread, _pending
+
+    while True:
+        with _lock:
+            if not _pending:
+                _thread = None
+                return
+            _pending = False
+        close_old_connections()
+        try:
+            reap()
+        except Exception:
+            logger.exception('Reaping deleted folders and documents failed.')
+        finally:
+            close_old_connections()
+
+
+def start():
+    """Reap on the reaper thread, starting it unless it runs already."""
+    global _thread, _pending
+
+    if not workers.get_workers():
+        reap()
+        return
+    with _lock:
+        _pending = True
+        if _thread is None:
+            _thread = threading.Thread(target=_run, name='vault-reaper', daemon=True)
+            _thread.start()
+
+
+def schedule():
+    """Reap once the current transaction commits."""
+    transaction.on_commit(start)
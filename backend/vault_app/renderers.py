@@ -0,0 +1,35 @@
+"""JSON rendering with orjson, byte for byte as DRF's JSONRenderer.
+
+orjson writes the compact, non-ASCII-escaping JSON the default settings of
+JSONRenderer ask for, several times faster than json.dumps. Values orjson
+does not know (lazy strings, sets, Decimals, ...) and datetimes go through
+DRF's encoder, whose datetime format differs from orjson's. What orjson
+refuses, like dicts with keys other than strings or integers past 64 bits,
+falls back to JSONRenderer, as do indented responses and settings asking
+for escaped or spaced-out JSON.
+
+Two cases differ: floats Python writes with an exponent (below 1e-4 or
+from 1e16 on) are written as orjson does, 1e16 for 1e+16, which reads back
+as the same number, and NaN and infinities, which JSONRenderer refuses, are
+written as null. The API returns neither.
+"""
+import orjson
+from rest_framework.renderers import JSONRenderer
+
+OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+
+
+class OrjsonRenderer(JSONRenderer):
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if self.ensure_ascii or not self.compact or self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+
+        try:
+            rendered = orjson.dumps(data, default=self.encoder_class().default, option=OPTIONS)
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        # as JSONRenderer, so the output is also valid JavaScript
+        return rendered.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
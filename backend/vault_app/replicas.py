@@ -0,0 +1,194 @@
+"""Routing of request reads to read replicas, with read-your-writes.
+
+ReplicaMiddleware picks one healthy replica for each GET, HEAD or OPTIONS
+request, and ReplicaRouter sends that request's vault_app reads there.
+Writes, reads inside a transaction and everything outside requests use the
+primary. Each request reads from a single replica, so it never sees the
+data go back in time partway through.
+
+A request that may have written sets the PIN_COOKIE cookie. For
+pin_seconds() after that, the client's reads go to the primary, so a user
+sees their own changes before the replicas catch up. That is at least as
+long as a replica can be behind and still be used, MAX_LAG_SECONDS plus the
+CHECK_INTERVAL it may fall further behind in before its next check.
+Authentication state is always read from the primary.
+
+A replica is checked at most every CHECK_INTERVAL seconds per process. It
+is left out while it does not answer, or while it is more than
+MAX_LAG_SECONDS behind (PostgreSQL only). A query that fails on a replica
+also leaves it out until its next check.
+"""
+import contextvars
+import random
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, InterfaceError, OperationalError, connections
+
+from . import metrics
+
+DEFAULTS = {
+    'ALIASES': [],
+    'PIN_SECONDS': 5,
+    'CHECK_INTERVAL': 5,
+    'MAX_LAG_SECONDS': 10,
+}
+PIN_COOKIE = 'vault_primary_until'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# replica of the current request, None for the primary
+_replica = contextvars.ContextVar('vault_replica', default=None)
+
+# alias: (monotonic time of the last check, whether it passed)
+_health = {}
+_lock = threading.Lock()
+
+# seconds the replica is behind, zero when it has replayed all it received
+POSTGRES_LAG = (
+    'SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+    'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END'
+)
+
+
+def get_options():
+    return {**DEFAULTS, **getattr(settings, 'READ_REPLICAS', {})}
+
+
+def pin_seconds(options):
+    # a replica passing its check may read this far behind until the next one
+    return max(options['PIN_SECONDS'], options['MAX_LAG_SECONDS'] + options['CHECK_INTERVAL'])
+
+
+def check(alias):
+    """Whether the replica ``alias`` answers and is not too far behind."""
+    connection = connections[alias]
+    try:
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute(POSTGRES_LAG)
+                lag = cursor.fetchone()[0]
+            else:
+                cursor.execute('SELECT 1')
+                lag = 0
+    except DatabaseError:
+        connection.close()
+        return False
+    return lag is None or lag <= get_options()['MAX_LAG_SECONDS']
+
+
+def eject(alias):
+    """Leave the replica ``alias`` out until its next check."""
+    with _lock:
+        _health[alias] = (time.monotonic(), False)
+    metrics.REPLICA_EJECTIONS.labels(alias).inc()
+
+
+def healthy_replicas():
+    options = get_options()
+    now = time.monotonic()
+    healthy = []
+    for alias in options['ALIASES']:
+        with _lock:
+            checked_at, passed = _health.get(alias, (None, False))
+        if checked_at is None or now - checked_at >= options['CHECK_INTERVAL']:
+            passed = check(alias)
+            with _lock:
+                _health[alias] = (now, passed)
+            if not passed:
+                metrics.REPLICA_EJECTIONS.labels(alias).inc()
+        if passed:
+            healthy.append(alias)
+    return healthy
+
+
+def watch_failures(execute, sql, params, many, context):
+    """Execute wrapper ejecting a replica whose connection fails."""
+    try:
+        return execute(sql, params, many, context)
+    except (OperationalError, InterfaceError):
+        eject(context['connection'].alias)
+        raise
+
+
+def instrument_connection(sender, connection, **kwargs):
+    if connection.alias in get_options()['ALIASES'] and watch_failures not in connection.execute_wrappers:
+        connection.execute_wrappers.append(watch_failures)
+
+
+def is_pinned(request):
+    try:
+        return float(request.COOKIES.get(PIN_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+class ReplicaRouter:
+    """Sends the vault_app reads of requests to the replica ReplicaMiddleware picked."""
+
+    def db_for_read(self, model, **hints):
+        alias = _replica.get()
+        if alias is None or model._meta.app_label != 'vault_app':
+            return None
+        # reads in a transaction see its writes
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return alias
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in get_options()['ALIASES']:
+            return False
+        return None
+
+
+class ReplicaMiddleware:
+    """Picks the replica of safe requests, and pins clients that may have written to the primary."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def replica(self, request):
+        if request.method not in SAFE_METHODS or not get_options()['ALIASES'] or is_pinned(request):
+            return None
+        healthy = healthy_replicas()
+        return random.choice(healthy) if healthy else None
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = _replica.set(self.replica(request))
+        try:
+            response = self.get_response(request)
+        finally:
+            _replica.reset(token)
+        return self.pin(request, response)
+
+    async def __acall__(self, request):
+        # health checks query the replicas
+        replica = await sync_to_async(self.replica)(request) if get_options()['ALIASES'] else None
+        token = _replica.set(replica)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _replica.reset(token)
+        return self.pin(request, response)
+
+    def pin(self, request, response):
+        options = get_options()
+        if request.method not in SAFE_METHODS and options['ALIASES']:
+            seconds = pin_seconds(options)
+            response.set_cookie(PIN_COOKIE, f'{time.time() + seconds:.3f}', max_age=seconds, httponly=True,
+                                samesite='Lax')
+        return response
@@ -0,0 +1,135 @@
+import hashlib
+import os
+import re
+
+from django.http import FileResponse, HttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+BLOCK_SIZE = 64 * 1024
+
+
+def document_filename(document):
+    """Download name of a document, with the extension of its stored file."""
+    filename = document.name
+    _, ext = os.path.splitext(document.file.name)
+    if ext and not filename.endswith(ext):
+        filename += ext
+    return filename
+
+
+def document_etag(document):
+    # stored names are unique per upload, so they identify the content
+    return '"%s"' % hashlib.sha256(document.file.name.encode()).hexdigest()[:32]
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+class FileSlice:
+    """File-like limiting reads of ``file_handle`` to ``length`` bytes from ``start``."""
+
+    def __init__(self, file_handle, start, length):
+        self.file_handle = file_handle
+        self.file_handle.seek(start)
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file_handle.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file_handle.close()
+
+
+def parse_range(header, size):
+    """Return the inclusive ``(start, end)`` of a single byte range, or None to serve the whole file.
+
+    Ranges in other units are ignored. Byte ranges that are malformed, several
+    or past the end of the file raise RangeNotSatisfiable; only single ranges
+    are served.
+    """
+    header = header.strip()
+    if not header.startswith('bytes='):
+        return None
+    match = RANGE_RE.match(header)
+    if not match:
+        raise RangeNotSatisfiable
+
+    start, end = match.groups()
+    if not start:
+        if not end or int(end) == 0 or size == 0:
+            raise RangeNotSatisfiable
+        return max(0, size - int(end)), size - 1
+
+    start = int(start)
+    if (end and int(end) < start) or start >= size:
+        raise RangeNotSatisfiable
+    end = int(end) if end else size - 1
+    return start, min(end, size - 1)
+
+
+def if_range_matches(header, etag, last_modified):
+    if header.startswith('"') or header.startswith('W/'):
+        return etag is not None and header == etag
+    return last_modified is not None and parse_http_date_safe(header) == int(last_modified.timestamp())
+
+
+def requested_range(request, size, etag=None, last_modified=None):
+    """The inclusive byte range to serve, or None for the whole file.
+
+    Raises RangeNotSatisfiable when the range lies past the end of the file.
+    """
+    range_header = request.headers.get('Range')
+    if_range = request.headers.get('If-Range')
+    if range_header and (not if_range or if_range_matches(if_range, etag, last_modified)):
+        return parse_range(range_header, size)
+    return None
+
+
+def range_not_satisfiable(size):
+    response = HttpResponse(status=416)
+    response['Content-Range'] = f'bytes */{size}'
+    return response
+
+
+def set_file_headers(response, size, byte_range, etag=None, last_modified=None):
+    start, end = byte_range or (0, size - 1)
+    response['Content-Length'] = end - start + 1 if size else 0
+    response['Accept-Ranges'] = 'bytes'
+    if byte_range:
+        response.status_code = 206
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    if etag:
+        response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+
+
+def ranged_file_response(request, file_handle, content_type, filename, etag=None, last_modified=None):
+    """Stream ``file_handle``, answering ``Range``/``If-Range`` requests with 206 responses.
+
+    ``file_handle`` only has to be seekable and expose its (plaintext) ``size``;
+    only the requested bytes are read from it.
+    """
+    size = file_handle.size
+    try:
+        byte_range = requested_range(request, size, etag, last_modified)
+    except RangeNotSatisfiable:
+        file_handle.close()
+        return range_not_satisfiable(size)
+
+    start, end = byte_range or (0, size - 1)
+    response = FileResponse(
+        FileSlice(file_handle, start, end - start + 1 if size else 0),
+        content_type=content_type,
+        as_attachment=True,
+        filename=filename,
+    )
+    response.block_size = BLOCK_SIZE
+    set_file_headers(response, size, byte_range, etag, last_modified)
+    return response
@@ -1,5 +1,6 @@
 from rest_framework import serializers
-from .models import  User,Folder, Document, Tag
+from . import folder_tree
+from .models import  User,Folder, Document, Tag, UploadSession, Blob
 
 
 class RegisterSerializer(serializers.ModelSerializer):
@@ -30,8 +31,9 @@ class RegisterSerializer(serializers.ModelSerializer):
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
-        fields = ('id', 'username', 'email', 'first_name', 'last_name')
-        read_only_fields = ('username',)
+        fields = ('id', 'username', 'email', 'first_name', 'last_name', 'document_count', 'total_bytes',
+                  'last_modified', 'storage_quota')
+        read_only_fields = ('username', 'document_count', 'total_bytes', 'last_modified', 'storage_quota')
 
 class ChangePasswordSerializer(serializers.Serializer):
     old_password = serializers.CharField(required=True)
@@ -44,16 +46,89 @@ class ChangePasswordSerializer(serializers.Serializer):
 class TagSerializer(serializers.ModelSerializer):
     class Meta:
         model = Tag
-        fields = ['id', 'name']
+        fields = ['id', 'name', 'document_count', 'total_bytes', 'last_modified']
+        read_only_fields = ['document_count', 'total_bytes', 'last_modified']
 
 class DocumentSerializer(serializers.ModelSerializer):
     file = serializers.FileField(use_url=True) 
     class Meta:
         model = Document
-        fields = ['id', 'name', 'file', 'file_type', 'folder', 'tags', 'created_at']
+        fields = ['id', 'name', 'file', 'file_type', 'size', 'folder', 'tags', 'created_at']
+        read_only_fields = ['size']
 
-class FolderSerializer(serializers.ModelSerializer):
-    documents = DocumentSerializer(many=True, read_only=True)
+class OwnedRelationsMixin:
+    """Rejects folders and tags of other users."""
+
+    def validate_folder(self, value):
+        if value.user_id != self.context['request'].user.pk:
+            raise serializers.ValidationError('Folder not found.')
+        return value
+
+    def validate_parent(self, value):
+        if value is not None and value.user_id != self.context['request'].user.pk:
+            raise serializers.ValidationError('Folder not found.')
+        return value
+
+    def validate_tags(self, value):
+        if any(tag.user_id != self.context['request'].user.pk for tag in value):
+            raise serializers.ValidationError('Tag not found.')
+        return value
+
+class FolderSerializer(OwnedRelationsMixin, serializers.ModelSerializer):
     class Meta:
         model = Folder
-        fields = ['id', 'name', 'documents', 'created_at']
\ No newline at end of file
+        fields = ['id', 'name', 'parent', 'document_count', 'total_bytes', 'last_modified', 'created_at']
+        read_only_fields = ['document_count', 'total_bytes', 'last_modified']
+
+    def validate(self, attrs):
+        parent = attrs.get('parent')
+        if self.instance is not None and parent is not None and folder_tree.is_within(parent, self.instance):
+            raise serializers.ValidationError({'parent': 'A folder cannot be moved into itself or a folder below it.'})
+        return attrs
+
+class FolderDetailSerializer(FolderSerializer):
+    documents = DocumentSerializer(many=True, read_only=True)
+
+    class Meta(FolderSerializer.Meta):
+        fields = FolderSerializer.Meta.fields + ['documents']
+
+class UploadSessionSerializer(OwnedRelationsMixin, serializers.ModelSerializer):
+    offset = serializers.IntegerField(source='received', read_only=True)
+    sha256 = serializers.RegexField(r'^[0-9a-fA-F]{64}$', write_only=True, required=False)
+    # the user already stored this content, the session can be finalized without chunks
+    content_exists = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UploadSession
+        fields = ['id', 'name', 'filename', 'file_type', 'folder', 'tags', 'size', 'sha256', 'chunk_size', 'offset',
+                  'next_index', 'content_exists', 'created_at']
+        read_only_fields = ['chunk_size', 'next_index']
+
+    def get_content_exists(self, obj):
+        return bool(obj.digest) and Blob.objects.filter(user_id=obj.user_id, digest=obj.digest, size=obj.size).exists()
+
+class OwnedTagsField(serializers.ListField):
+    """Tag ids of the requesting user, resolved with a single query."""
+    child = serializers.IntegerField()
+
+    def to_internal_value(self, data):
+        ids = set(super().to_internal_value(data))
+        tags = list(Tag.objects.filter(user=self.context['request'].user, pk__in=ids).only('id', 'user_id'))
+        if len(tags) != len(ids):
+            raise serializers.ValidationError('Tag not found.')
+        return tags
+
+class BulkDocumentsSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False, max_length=1000)
+
+class BulkMoveSerializer(OwnedRelationsMixin, BulkDocumentsSerializer):
+    folder = serializers.PrimaryKeyRelatedField(queryset=Folder.objects.all())
+
+class BulkTagSerializer(BulkDocumentsSerializer):
+    add = OwnedTagsField(required=False, default=list)
+    remove = OwnedTagsField(required=False, default=list)
+
+class BulkUploadSerializer(OwnedRelationsMixin, serializers.Serializer):
+    files = serializers.ListField(child=serializers.FileField(), allow_empty=False, max_length=100)
+    folder = serializers.PrimaryKeyRelatedField(queryset=Folder.objects.all())
+    tags = OwnedTagsField(required=False, default=list)
@@ -0,0 +1,87 @@
+"""Moving files stored flat into the sharded layout.
+
+shard() gives every flat file of a blob, a document stored before blobs or
+a preview the name storage.shard_name() picks for it, a hard link to the
+same file, in parallel threads. It then points the rows at the new names,
+one transaction per batch, and unlinks the old names once that commits.
+Readers find the file under either name throughout, and an interrupted run
+is resumed by running it again, since the new names do not change between
+runs.
+
+Works on file system storage only.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import transaction
+from django.db.models import F
+
+from . import blobs
+from .models import Blob, Document, Preview
+from .storage import is_sharded, shard_name
+
+
+def targets():
+    """``(model, field, queryset)`` of the rows naming stored files."""
+    return [
+        (Blob, 'name', Blob.objects.all()),
+        (Document, 'file', Document.all_objects.filter(blob__isnull=True)),
+        (Preview, 'file', Preview.objects.exclude(file='')),
+    ]
+
+
+def link(storage, name, target):
+    """Give the file ``name`` the second name ``target``; returns whether the file exists."""
+    destination = storage.path(target)
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    try:
+        os.link(storage.path(name), destination)
+    except FileExistsError:
+        # linked by an interrupted run
+        pass
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def shard_rows(storage, model, field, rows):
+    """Point the ``(pk, name, target)`` rows at their linked targets; returns how many were."""
+    moved = 0
+    unlinked = []
+    with transaction.atomic():
+        for pk, name, target in rows:
+            if model.objects.filter(pk=pk, **{field: name}).update(**{field: target}):
+                if model is Blob:
+                    Document.all_objects.filter(blob_id=pk).update(file=target)
+                moved += 1
+                unlinked.append(name)
+            else:
+                # changed or deleted meanwhile
+                unlinked.append(target)
+        transaction.on_commit(lambda: [storage.delete(name) for name in unlinked])
+    return moved
+
+
+def shard(batch_size=500, workers=8):
+    """Move every flat file into its shard; returns the files moved and those missing."""
+    storage = blobs.file_storage()
+    moved = missing = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for model, field, queryset in targets():
+            last_pk = 0
+            while True:
+                batch = list(queryset.filter(pk__gt=last_pk).order_by('pk').values_list('pk', field)[:batch_size])
+                if not batch:
+                    break
+                last_pk = batch[-1][0]
+
+                rows = [(pk, name, shard_name(name)) for pk, name in batch if name and not is_sharded(name)]
+                linked = list(executor.map(lambda row: link(storage, row[1], row[2]), rows))
+                missing += linked.count(False)
+                moved += shard_rows(storage, model, field, [row for row, found in zip(rows, linked) if found])
+
+    # documents that took a reference to a blob while it was moved
+    stale = Document.all_objects.filter(blob__isnull=False).exclude(file=F('blob__name'))
+    for pk, name in stale.values_list('pk', 'blob__name'):
+        Document.all_objects.filter(pk=pk).update(file=name)
+    return moved, missing
@@ -0,0 +1,247 @@
+import threading
+from contextlib import contextmanager
+
+import secured_fields.fernet
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from . import authentication, blind_index, blobs, content_index, counters, folder_tree, journal, metrics, previews, \
+    replicas, storage, versions
+from .models import Blob, Document, DocumentContent, Folder, Preview, Tag, User
+
+_state = threading.local()
+
+
+@contextmanager
+def bulk_write():
+    """Skip the per-instance handlers, for bulk paths that do their work in batches.
+
+    Blob references, counters, the search and content indexes and the
+    journal are then the caller's to keep.
+    """
+    previous = is_bulk_write()
+    _state.bulk_write = True
+    try:
+        with blind_index.suspended():
+            yield
+    finally:
+        _state.bulk_write = previous
+
+
+def is_bulk_write():
+    return getattr(_state, 'bulk_write', False)
+
+
+@receiver(post_save, sender=Folder)
+@receiver(post_save, sender=Tag)
+@receiver(post_save, sender=Document)
+def update_blind_index(sender, instance, update_fields=None, **kwargs):
+    if blind_index.is_suspended():
+        return
+    if update_fields is not None and not set(update_fields) & set(sender.blind_index_fields):
+        return
+    blind_index.index_instance(instance)
+
+
+@receiver(post_delete, sender=Folder)
+@receiver(post_delete, sender=Tag)
+@receiver(post_delete, sender=Document)
+def remove_blind_index(sender, instance, **kwargs):
+    if blind_index.is_suspended():
+        return
+    blind_index.unindex_instance(instance)
+
+
+@receiver(pre_save, sender=Document)
+def store_blob(sender, instance, **kwargs):
+    if not instance.file or instance.file._committed:
+        return
+    # a replaced file gives up its reference once the new one is saved
+    instance._released_blob_id = instance.blob_id
+    instance.blob = blobs.store(instance, instance.file)
+    instance.file.name = instance.blob.name
+    instance.file._committed = True
+
+
+@receiver(post_save, sender=Document)
+def content_saved(sender, instance, created, **kwargs):
+    if not created and '_released_blob_id' not in instance.__dict__:
+        return
+    released = instance.__dict__.pop('_released_blob_id', None)
+    if released is not None and released != instance.blob_id:
+        blobs.release([released])
+    previews.enqueue([instance])
+    content_index.enqueue([instance])
+
+
+@receiver(post_delete, sender=Document)
+def release_blob(sender, instance, **kwargs):
+    if is_bulk_write():
+        return
+    blobs.release([instance.blob_id])
+
+
+@receiver(post_delete, sender=Blob)
+def delete_blob_file(sender, instance, **kwargs):
+    blobs.delete_file(instance)
+
+
+@receiver(post_delete, sender=Preview)
+def delete_preview_file(sender, instance, **kwargs):
+    if instance.file:
+        transaction.on_commit(lambda: instance.file.storage.delete(instance.file.name))
+
+
+@receiver(post_delete, sender=DocumentContent)
+def remove_content_terms(sender, instance, **kwargs):
+    if is_bulk_write():
+        return
+    content_index.unindex([instance])
+
+
+def deleting_user(origin):
+    # the journal of a deleted user goes with it
+    return isinstance(origin, User) or getattr(origin, 'model', None) is User
+
+
+@receiver(pre_save, sender=Folder)
+def remember_parent(sender, instance, update_fields=None, **kwargs):
+    if instance._state.adding or (update_fields is not None and 'parent' not in update_fields):
+        return
+    instance._linked_parent = Folder.objects.filter(pk=instance.pk).values_list('parent_id', flat=True).first()
+
+
+@receiver(post_save, sender=Folder)
+def update_folder_links(sender, instance, created, **kwargs):
+    if created:
+        folder_tree.attach([instance])
+    elif '_linked_parent' in instance.__dict__ and instance.__dict__.pop('_linked_parent') != instance.parent_id:
+        folder_tree.move(instance)
+
+
+@receiver(pre_save, sender=Document)
+def remember_counted_state(sender, instance, **kwargs):
+    if is_bulk_write() or instance._state.adding:
+        return
+    # locked, so concurrent saves each move the counts from where the one before left them
+    counted = Document.objects.select_for_update().filter(pk=instance.pk)
+    instance._counted = counted.values_list('folder_id', 'size').first()
+
+
+@receiver(post_save, sender=Document)
+def update_counters(sender, instance, created, **kwargs):
+    if is_bulk_write():
+        return
+    if created:
+        counters.update(
+            folders=[(instance.folder_id, 1, instance.size)],
+            users=[(instance.user_id, 1, instance.size)],
+        )
+        journal.record(instance.user_id, changed={Folder: [instance.folder_id]})
+        return
+
+    folder_id, size = instance.__dict__.pop('_counted', None) or (instance.folder_id, instance.size)
+    change = instance.size - size
+    tag_ids = [tag_id for tag_id, _ in counters.tag_pairs([instance.pk])]
+    counters.update(
+        folders=[(folder_id, -1, -size), (instance.folder_id, 1, instance.size)],
+        tags=[(tag_id, 0, change) for tag_id in tag_ids],
+        users=[(instance.user_id, 0, change)],
+    )
+    journal.record(instance.user_id, changed={Folder: [folder_id, instance.folder_id], Tag: tag_ids})
+
+
+@receiver(pre_delete, sender=Document)
+def remember_counted_tags(sender, instance, **kwargs):
+    if is_bulk_write():
+        return
+    # the instance may predate a move or a new version saved since
+    counted = Document.all_objects.select_for_update().filter(pk=instance.pk)
+    instance._counted = counted.values_list('folder_id', 'size').first()
+    instance._counted_tags = counters.tag_pairs([instance.pk])
+
+
+@receiver(post_delete, sender=Document)
+def remove_from_counters(sender, instance, origin=None, **kwargs):
+    if is_bulk_write():
+        return
+    folder_id, size = instance.__dict__.pop('_counted', None) or (instance.folder_id, instance.size)
+    tag_pairs = instance.__dict__.pop('_counted_tags', [])
+    counters.update(
+        folders=[(folder_id, -1, -size)],
+        tags=[(tag_id, -1, -size) for tag_id, size in tag_pairs],
+        users=[(instance.user_id, -1, -size)],
+    )
+    if not deleting_user(origin):
+        journal.record(instance.user_id, changed={
+            Folder: [folder_id], Tag: [tag_id for tag_id, _ in tag_pairs],
+        })
+
+
+@receiver(m2m_changed, sender=Document.tags.through)
+def update_tag_counters(sender, instance, action, reverse, pk_set, **kwargs):
+    """Count tag links, from either side; removed ones are looked up before they go."""
+    if is_bulk_write():
+        return
+
+    if action in ('pre_remove', 'pre_clear'):
+        links = sender.objects.filter(**{'tag_id' if reverse else 'document_id': instance.pk})
+        if action == 'pre_remove':
+            links = links.filter(**{'document_id__in' if reverse else 'tag_id__in': pk_set})
+        instance._removed_links = list(links.values_list('tag_id', 'document_id', 'document__size'))
+    elif action in ('post_remove', 'post_clear'):
+        links = instance.__dict__.pop('_removed_links', [])
+        counters.tags_added([(tag_id, size) for tag_id, _, size in links], sign=-1)
+        journal.record(instance.user_id, changed={
+            Tag: [tag_id for tag_id, _, _ in links], Document: [document_id for _, document_id, _ in links],
+        })
+    elif action == 'post_add' and pk_set:
+        if reverse:
+            sizes = Document.objects.filter(pk__in=pk_set).values_list('size', flat=True)
+            counters.tags_added([(instance.pk, size) for size in sizes])
+            journal.record(instance.user_id, changed={Tag: [instance.pk], Document: pk_set})
+        else:
+            counters.tags_added([(tag_id, instance.size) for tag_id in pk_set])
+            journal.record(instance.user_id, changed={Tag: pk_set, Document: [instance.pk]})
+
+
+@receiver(post_save, sender=Folder)
+@receiver(post_save, sender=Tag)
+@receiver(post_save, sender=Document)
+@receiver(post_delete, sender=Folder)
+@receiver(post_delete, sender=Tag)
+@receiver(post_delete, sender=Document)
+def record_change(sender, instance, signal, origin=None, **kwargs):
+    if is_bulk_write() or deleting_user(origin):
+        return
+    if signal is post_delete:
+        journal.record(instance.user_id, deleted={sender: [instance.pk]})
+    else:
+        journal.record(instance.user_id, changed={sender: [instance.pk]})
+
+
+@receiver(setting_changed)
+def reset_keys(setting, **kwargs):
+    # keys derived from SECURED_FIELDS_KEY are cached per process
+    if setting == 'SECURED_FIELDS_KEY':
+        secured_fields.fernet.fernet_client = None
+        storage._keys = None
+        versions.get_cipher.cache_clear()
+    if setting in ('SECURED_FIELDS_KEY', 'BLIND_INDEX_KEY'):
+        blind_index._key = None
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def forget_authentication_state(sender, instance, **kwargs):
+    # password changes, deactivations and deletions take effect at once in this process
+    authentication.invalidate(instance.pk)
+
+
+@receiver(connection_created)
+def count_queries(sender, connection, **kwargs):
+    metrics.instrument_connection(sender, connection)
+    replicas.instrument_connection(sender, connection)
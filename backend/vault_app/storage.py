@@ -0,0 +1,461 @@
+import base64
+import hashlib
+import io
+import os
+import posixpath
+import re
+import struct
+import tempfile
+import time
+from itertools import accumulate
+
+import zstandard
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from secured_fields.fernet import get_fernet
+from secured_fields.mixins import EncryptedStorageMixin
+
+from . import compression, metrics
+
+# Segmented format: a fixed header followed by AES-GCM encrypted chunks of
+# ``chunk_size`` plaintext bytes (the last one may be shorter). Chunk ``i`` is
+# encrypted with the nonce ``nonce_prefix || i`` and the header plus a
+# final-chunk flag as associated data, so chunks cannot be reordered, swapped
+# between files or truncated without failing authentication. Since every chunk
+# but the last has the same size, the offset of any chunk is computed directly
+# from its index.
+#
+# With FLAG_COMPRESSED, each chunk is compressed before it is encrypted (see
+# compression.py) and starts with a byte saying whether it was. Chunks then
+# vary in size, so they are followed by an encrypted index of their lengths
+# and the plaintext size, the only chunk flagged final, and by INDEX_TRAILER,
+# which locates it. Files without the flag are read as before.
+MAGIC = b'DGSE'
+VERSION = 1
+HEADER = struct.Struct('>4sBBI8s8s')  # magic, version, flags, chunk size, key id, nonce prefix
+TAG_SIZE = 16
+FLAG_COMPRESSED = 0x01
+CHUNK_RAW = b'\x00'
+CHUNK_ZSTD = b'\x01'
+INDEX = struct.Struct('>QI')  # plaintext size, chunk count; the chunk lengths follow
+INDEX_TRAILER = struct.Struct('>II')  # chunk count, length of the encrypted index
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+_keys = None
+
+
+class SegmentError(Exception):
+    pass
+
+
+def _derive_key(fernet_key, info=b'vault_app.segmented-storage'):
+    if isinstance(fernet_key, str):
+        fernet_key = fernet_key.encode()
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=info)
+    return hkdf.derive(base64.urlsafe_b64decode(fernet_key))
+
+
+def get_keys():
+    """``(key_id, key)`` pairs derived from SECURED_FIELDS_KEY, the first one encrypts."""
+    global _keys
+
+    if _keys is None:
+        fernet_keys = settings.SECURED_FIELDS_KEY
+        if isinstance(fernet_keys, (str, bytes)):
+            fernet_keys = [fernet_keys]
+
+        _keys = []
+        for fernet_key in fernet_keys:
+            key = _derive_key(fernet_key)
+            _keys.append((hashlib.sha256(key).digest()[:8], key))
+
+    return _keys
+
+
+def get_chunk_size():
+    return getattr(settings, 'ENCRYPTED_FILE_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+
+
+def make_header(chunk_size=None, flags=0):
+    key_id, _ = get_keys()[0]
+    return HEADER.pack(MAGIC, VERSION, flags, chunk_size or get_chunk_size(), key_id, os.urandom(8))
+
+
+def encrypt_chunk(header, index, data, final):
+    _, _, _, _, key_id, nonce_prefix = HEADER.unpack(header)
+    key = dict(get_keys())[key_id]
+    nonce = nonce_prefix + struct.pack('>I', index)
+    started = time.perf_counter()
+    encrypted = AESGCM(key).encrypt(nonce, data, header + (b'\x01' if final else b'\x00'))
+    metrics.record_crypto('file_encrypt', time.perf_counter() - started, len(data))
+    return encrypted
+
+
+def fixed_chunks(chunks, chunk_size):
+    """Split an iterable of byte strings into ``(data, final)`` pieces of ``chunk_size`` bytes.
+
+    Only the final piece may be shorter, or empty.
+    """
+    pending = b''
+    for data in chunks:
+        pending += data
+        # keep at least one full chunk back, the last one is only known at the end
+        while len(pending) > chunk_size:
+            yield pending[:chunk_size], False
+            pending = pending[chunk_size:]
+
+    yield pending, True
+
+
+def compress_chunk(compressor, data):
+    compressed = compressor.compress(data)
+    if len(compressed) < len(data):
+        return CHUNK_ZSTD + compressed
+    return CHUNK_RAW + data
+
+
+def encrypt_stream(chunks, chunk_size=None, flags=0):
+    """Yield the segmented encryption of an iterable of plaintext byte strings."""
+    header = make_header(chunk_size, flags)
+    chunk_size = HEADER.unpack(header)[3]
+    yield header
+
+    if not flags & FLAG_COMPRESSED:
+        for index, (data, final) in enumerate(fixed_chunks(chunks, chunk_size)):
+            yield encrypt_chunk(header, index, data, final)
+        return
+
+    compressor = compression.compressor()
+    lengths = []
+    size = 0
+    for data, _ in fixed_chunks(chunks, chunk_size):
+        if data:
+            segment = encrypt_chunk(header, len(lengths), compress_chunk(compressor, data), final=False)
+            lengths.append(len(segment))
+            size += len(data)
+            yield segment
+
+    index = INDEX.pack(size, len(lengths)) + struct.pack(f'>{len(lengths)}I', *lengths)
+    segment = encrypt_chunk(header, len(lengths), index, final=True)
+    yield segment
+    yield INDEX_TRAILER.pack(len(lengths), len(segment))
+
+
+def encrypted_length(size, chunk_size):
+    """On-disk length of ``size`` plaintext bytes in the segmented format."""
+    return HEADER.size + size + max(1, -(-size // chunk_size)) * TAG_SIZE
+
+
+def plaintext_length(length, chunk_size):
+    """Plaintext size of a segmented file without compression stored in ``length`` bytes.
+
+    The inverse of encrypted_length.
+    """
+    payload = length - HEADER.size
+    chunks = max(1, -(-payload // (chunk_size + TAG_SIZE)))
+    return payload - chunks * TAG_SIZE
+
+
+def is_segmented(fileobj):
+    position = fileobj.tell()
+    magic = fileobj.read(len(MAGIC))
+    fileobj.seek(position)
+    return magic == MAGIC
+
+
+class SegmentedFile(io.RawIOBase):
+    """Read-only, seekable view of the plaintext of a segmented file.
+
+    Only the chunk covering the current position is decrypted and held in
+    memory, so reading a slice costs the chunks it spans.
+    """
+
+    def __init__(self, raw):
+        super().__init__()
+        self.raw = raw
+        self.raw.seek(0)
+        self.header = self.raw.read(HEADER.size)
+        try:
+            magic, version, self.flags, self.chunk_size, key_id, self.nonce_prefix = HEADER.unpack(self.header)
+        except struct.error:
+            raise SegmentError('Truncated header.')
+        if magic != MAGIC or version != VERSION:
+            raise SegmentError('Not a segmented file.')
+
+        try:
+            self.cipher = AESGCM(dict(get_keys())[key_id])
+        except KeyError:
+            raise SegmentError('File was encrypted with an unknown key.')
+
+        self.offsets = self.lengths = None
+        self._decompressor = None
+        if self.flags & FLAG_COMPRESSED:
+            self.read_index()
+        else:
+            self.raw.seek(0, io.SEEK_END)
+            body = self.raw.tell() - HEADER.size
+            segment = self.chunk_size + TAG_SIZE
+            self.chunk_count = max(1, -(-body // segment))
+            self.size = body - self.chunk_count * TAG_SIZE
+            if self.size < 0:
+                raise SegmentError('Truncated file.')
+
+        self.position = 0
+        self._chunk_index = None
+        self._chunk = b''
+
+    def decrypt(self, index, data, final):
+        nonce = self.nonce_prefix + struct.pack('>I', index)
+        started = time.perf_counter()
+        try:
+            decrypted = self.cipher.decrypt(nonce, data, self.header + (b'\x01' if final else b'\x00'))
+        except InvalidTag:
+            raise SegmentError(f'Chunk {index} failed authentication.')
+        metrics.record_crypto('file_decrypt', time.perf_counter() - started, len(decrypted))
+        return decrypted
+
+    def read_index(self):
+        """Read the chunk index of a compressed file."""
+        end = self.raw.seek(0, io.SEEK_END)
+        if end < HEADER.size + INDEX_TRAILER.size:
+            raise SegmentError('Truncated file.')
+        self.raw.seek(end - INDEX_TRAILER.size)
+        self.chunk_count, length = INDEX_TRAILER.unpack(self.raw.read(INDEX_TRAILER.size))
+        start = end - INDEX_TRAILER.size - length
+        if start < HEADER.size:
+            raise SegmentError('Truncated file.')
+
+        self.raw.seek(start)
+        index = self.decrypt(self.chunk_count, self.raw.read(length), final=True)
+        self.size, count = INDEX.unpack_from(index)
+        self.lengths = struct.unpack_from(f'>{count}I', index, INDEX.size)
+        if count != self.chunk_count or sum(self.lengths) != start - HEADER.size:
+            raise SegmentError('Corrupt chunk index.')
+        self.offsets = list(accumulate(self.lengths, initial=HEADER.size))
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def read_chunk(self, index):
+        if index != self._chunk_index:
+            if self.offsets is None:
+                segment = self.chunk_size + TAG_SIZE
+                self.raw.seek(HEADER.size + index * segment)
+                self._chunk = self.decrypt(index, self.raw.read(segment), final=index == self.chunk_count - 1)
+            else:
+                self.raw.seek(self.offsets[index])
+                self._chunk = self.decompress(index, self.decrypt(index, self.raw.read(self.lengths[index]), False))
+            self._chunk_index = index
+        return self._chunk
+
+    def decompress(self, index, data):
+        expected = min(self.chunk_size, self.size - index * self.chunk_size)
+        if data[:1] == CHUNK_ZSTD:
+            try:
+                data = self._decompressor.decompress(data[1:], max_output_size=self.chunk_size)
+            except zstandard.ZstdError:
+                raise SegmentError(f'Chunk {index} failed to decompress.')
+        else:
+            data = data[1:]
+        if len(data) != expected:
+            raise SegmentError(f'Chunk {index} has the wrong size.')
+        return data
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+        size = min(size, self.size - self.position)
+
+        parts = []
+        while size > 0:
+            index, offset = divmod(self.position, self.chunk_size)
+            data = self.read_chunk(index)[offset:offset + size]
+            parts.append(data)
+            self.position += len(data)
+            size -= len(data)
+        return b''.join(parts)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.raw.close()
+        super().close()
+
+
+class _EncryptedContent:
+    """Adapter handing FileSystemStorage the encrypted stream of ``content``."""
+
+    def __init__(self, content, flags=0):
+        self.content = content
+        self.flags = flags
+
+    def chunks(self):
+        return encrypt_stream(self.content.chunks(get_chunk_size()), flags=self.flags)
+
+
+def compression_flags(content, file_type=''):
+    """FLAG_COMPRESSED if ``content`` is worth compressing, else 0."""
+    content.seek(0)
+    head = content.read(get_chunk_size())
+    content.seek(0)
+    return FLAG_COMPRESSED if compression.should_compress(file_type, head) else 0
+
+
+def compress_file(path, file_type=''):
+    """Rewrite the segmented file at ``path`` compressed, if it is worth it; returns whether it was."""
+    with SegmentedFile(open(path, 'rb')) as plaintext:
+        if plaintext.flags & FLAG_COMPRESSED or not compression.should_compress(
+            file_type, plaintext.read(plaintext.chunk_size),
+        ):
+            return False
+        plaintext.seek(0)
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.compress-')
+        try:
+            with os.fdopen(fd, 'wb') as target:
+                chunks = iter(lambda: plaintext.read(plaintext.chunk_size), b'')
+                for data in encrypt_stream(chunks, chunk_size=plaintext.chunk_size, flags=FLAG_COMPRESSED):
+                    target.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    return True
+
+
+def open_decrypted(raw, name):
+    """File of the plaintext of the stored file open as ``raw``, segmented or in the whole-file Fernet format."""
+    if is_segmented(raw):
+        return File(SegmentedFile(raw), name)
+
+    started = time.perf_counter()
+    try:
+        content = get_fernet().decrypt(raw.read())
+    finally:
+        raw.close()
+    metrics.record_crypto('file_decrypt', time.perf_counter() - started, len(content))
+    return File(io.BytesIO(content), name)
+
+
+class _EncryptedTemporaryFile:
+    """Already encrypted local file, moved into place instead of being copied."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def temporary_file_path(self):
+        return self.path
+
+
+class SegmentedEncryptedFileSystemStorage(EncryptedStorageMixin, FileSystemStorage):
+    """Stores files in the segmented format.
+
+    Files in the whole-file Fernet format written by secured_fields are still
+    read transparently.
+    """
+
+    def _open(self, name, mode='rb'):
+        return open_decrypted(FileSystemStorage._open(self, name, 'rb'), name)
+
+    def _save(self, name, content):
+        flags = compression_flags(content, getattr(content, 'content_type', ''))
+        return FileSystemStorage._save(self, name, _EncryptedContent(content, flags))
+
+    def save_document(self, name, content, file_type='', max_length=None):
+        """save() for document content, whose ``file_type`` decides along with its bytes on compression."""
+        name = self.get_available_name(name, max_length=max_length)
+        flags = compression_flags(content, file_type)
+        return FileSystemStorage._save(self, name, _EncryptedContent(content, flags))
+
+    def is_segmented(self, name):
+        with FileSystemStorage._open(self, name, 'rb') as raw:
+            return is_segmented(raw)
+
+    def header(self, name):
+        """The first HEADER.size stored bytes of ``name``, or raise FileNotFoundError."""
+        with FileSystemStorage._open(self, name, 'rb') as raw:
+            return raw.read(HEADER.size)
+
+    def rewrite(self, name, chunks):
+        """Replace the stored bytes of ``name`` by ``chunks``; returns ``name``, or None if it was deleted meanwhile.
+
+        The new file is written next to the old one and moved into place, so
+        readers that have the old one open keep reading it.
+        """
+        path = self.path(name)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.rewrite-')
+        try:
+            with os.fdopen(fd, 'wb') as target:
+                for data in chunks:
+                    target.write(data)
+                target.flush()
+                os.fsync(target.fileno())
+            if not os.path.exists(path):
+                os.unlink(tmp_path)
+                return None
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return name
+
+    def save_encrypted(self, name, path, max_length=None, file_type=''):
+        """Store the segmented file at ``path`` under an available ``name``, moving it.
+
+        It is compressed on the way unless ``file_type`` or its content say it is not worth it.
+        """
+        compress_file(path, file_type)
+        name = self.get_available_name(name, max_length=max_length)
+        return FileSystemStorage._save(self, name, _EncryptedTemporaryFile(path))
+
+
+SHARDED_NAME = re.compile(r'(?:^|/)[0-9a-f]{2}/[0-9a-f]{2}/[^/]+$')
+
+
+def shard_name(name, salt=b''):
+    """``name`` moved down two levels of subdirectories named by the first hex digits of its hash."""
+    directory, filename = posixpath.split(name)
+    digest = hashlib.sha256(salt + name.encode()).hexdigest()
+    return posixpath.join(directory, digest[:2], digest[2:4], filename)
+
+
+def is_sharded(name):
+    return bool(SHARDED_NAME.search(name))
+
+
+class ShardedSegmentedEncryptedFileSystemStorage(SegmentedEncryptedFileSystemStorage):
+    """Spreads new files over 65536 subdirectories of their directory, ``ab/cd/name``.
+
+    The subdirectories of new files are picked at random, so files with the
+    same name spread too. Files stored flat are still read where they are
+    until the shard_files command moves them.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        if not is_sharded(name):
+            name = shard_name(name, os.urandom(16))
+        return super().get_available_name(name, max_length=max_length)
@@ -0,0 +1,64 @@
+"""Mark-and-sweep collection of stored files nothing references.
+
+Files can outlive what referenced them: their removal runs after the commit
+and is lost if the process stops first, and uploads that failed half way
+leave their files behind. collect() first deletes the blobs no document
+points at, then marks the files of every blob, document, preview and
+upload session and deletes the other files of the storage. Only blobs and
+files older than GC_GRACE_HOURS are collected, so those of uploads in
+progress are left alone.
+"""
+import datetime
+import posixpath
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import blobs
+from .models import Blob, Document, Preview, UploadSession
+
+
+def get_grace():
+    return datetime.timedelta(hours=getattr(settings, 'GC_GRACE_HOURS', 24))
+
+
+def walk(storage, path=''):
+    """Names of every file of ``storage`` below ``path``."""
+    directories, files = storage.listdir(path)
+    for name in files:
+        yield posixpath.join(path, name)
+    for directory in directories:
+        yield from walk(storage, posixpath.join(path, directory))
+
+
+def referenced():
+    """Names of the files that blobs, documents, previews and upload sessions use."""
+    names = set(Blob.objects.values_list('name', flat=True))
+    names.update(Document.all_objects.values_list('file', flat=True))
+    names.update(Preview.objects.exclude(file='').values_list('file', flat=True))
+    names.update(f'partial/{pk}.part' for pk in UploadSession.objects.values_list('pk', flat=True))
+    return names
+
+
+def collect(dry_run=False):
+    """Delete unreferenced blobs and files past the grace period; returns their counts and the bytes freed."""
+    cutoff = timezone.now() - get_grace()
+    orphans = Blob.objects.filter(documents__isnull=True, created_at__lt=cutoff)
+    blob_count = orphans.count()
+    if not dry_run:
+        with transaction.atomic():
+            # their files are removed by the post_delete handler once this commits
+            orphans.delete()
+
+    storage = blobs.file_storage()
+    marked = referenced()
+    file_count = freed = 0
+    for name in walk(storage):
+        if name in marked or storage.get_modified_time(name) >= cutoff:
+            continue
+        file_count += 1
+        freed += storage.size(name)
+        if not dry_run:
+            storage.delete(name)
+    return blob_count, file_count, freed
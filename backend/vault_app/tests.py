@@ -1,3 +1,2018 @@
-from django.test import TestCase
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from botocore.exceptions import ClientError
+from cryptography.fernet import Fernet
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Permission
+from django.core.cache import caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection, router
+from django.db.models import QuerySet
+from django.http import HttpResponse
+from django.test import LiveServerTestCase, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from prometheus_client import REGISTRY
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+from secured_fields.fernet import get_fernet
+
+from . import (
+    authentication, benchmarks, blind_index, blobs, bulk, content_index, counters, exports, folder_tree, key_rotation,
+    journal, object_storage, reaper, replicas, signals, storage, uploads, views,
+)
+from .decryption_cache import MISSING, DecryptionCache, get_decryption_cache
+from .fast_serializers import FastDocumentSerializer, FastFolderSerializer, FastTagSerializer
+from .models import (
+    User, Folder, FolderLink, Document, Tag, BlindIndexToken, Blob, Preview, ContentTerm, Change, UploadSession,
+)
+from .renderers import OrjsonRenderer
+from .serializers import DocumentSerializer, FolderSerializer, TagSerializer
+from .storage import FLAG_COMPRESSED, SegmentedFile
+
+class TemporaryMediaRootMixin:
+    """Stores the files of each test in its own temporary MEDIA_ROOT, removed afterwards."""
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = self.settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+
+class QueryBudgetMixin:
+    """Seeds a vault of ``document_count`` documents and checks per-endpoint query budgets.
+
+    The budgets do not depend on the vault size, so a serializer or queryset
+    change that reintroduces a query per row fails here.
+    """
+    document_count = 10
+    folder_count = 10
+    tag_count = 20
+    tags_per_document = 2
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='secret')
+        other = User.objects.create_user('other', password='secret')
+
+        cls.folders = Folder.objects.bulk_create(
+            [Folder(name=f'Folder {i}', user=cls.user) for i in range(cls.folder_count)]
+        )
+        cls.tags = Tag.objects.bulk_create(
+            [Tag(name=f'Tag {i}', user=cls.user) for i in range(cls.tag_count)]
+        )
+        documents = Document.objects.bulk_create(
+            [
+                Document(
+                    name=f'Document {i}',
+                    file=f'{i}.pdf',
+                    file_type='application/pdf',
+                    size=1024,
+                    user=cls.user,
+                    folder=cls.folders[i % cls.folder_count],
+                )
+                for i in range(cls.document_count)
+            ],
+            batch_size=1000,
+        )
+        blind_index.index_instances(documents)
+        Document.tags.through.objects.bulk_create(
+            [
+                Document.tags.through(document_id=document.pk, tag_id=cls.tags[(i + j) % cls.tag_count].pk)
+                for i, document in enumerate(documents)
+                for j in range(cls.tags_per_document)
+            ],
+            batch_size=1000,
+        )
+
+        # another user's data must not change the budgets either
+        other_folder = Folder.objects.create(name='Other', user=other)
+        Document.objects.create(name='Other', file='other.pdf', user=other, folder=other_folder)
+        counters.reconcile()
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def assertBudget(self, budget, url, params=None):
+        with self.assertNumQueries(budget):
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def test_document_list(self):
+        # lists read the vault version first
+        data = self.assertBudget(3, '/api/documents/')
+        self.assertEqual(len(data['results']), min(self.document_count, 50))
+        self.assertEqual(len(data['results'][0]['tags']), self.tags_per_document)
+
+    def test_document_list_large_page(self):
+        self.assertBudget(3, '/api/documents/', {'page_size': 500})
+
+    def test_document_list_filtered(self):
+        # one more query for each filter validating its ids
+        self.assertBudget(4, '/api/documents/', {'folder': self.folders[0].pk})
+        self.assertBudget(4, '/api/documents/', {'tags': self.tags[0].pk})
+
+    def test_document_search(self):
+        data = self.assertBudget(3, '/api/documents/', {'search': 'docu'})
+        self.assertEqual(len(data['results']), min(self.document_count, 50))
+
+    def test_document_detail(self):
+        document = Document.objects.filter(user=self.user).first()
+        self.assertBudget(2, f'/api/documents/{document.pk}/')
+
+    def test_folder_list(self):
+        data = self.assertBudget(2, '/api/folders/')
+        self.assertEqual(sum(folder['document_count'] for folder in data['results']), self.document_count)
+
+    def test_folder_list_expanded(self):
+        data = self.assertBudget(4, '/api/folders/', {'expand': 'documents'})
+        self.assertEqual(sum(len(folder['documents']) for folder in data['results']), self.document_count)
+
+    def test_folder_detail_expanded(self):
+        self.assertBudget(3, f'/api/folders/{self.folders[0].pk}/', {'expand': 'documents'})
+
+    def test_tag_list(self):
+        self.assertBudget(2, '/api/tags/')
+
+
+class SmallVaultQueryBudgetTests(QueryBudgetMixin, TestCase):
+    document_count = 10
+
+
+class MediumVaultQueryBudgetTests(QueryBudgetMixin, TestCase):
+    document_count = 1000
+
+
+class LargeVaultQueryBudgetTests(QueryBudgetMixin, TestCase):
+    document_count = 10000
+
+
+class DecryptionCacheTests(TestCase):
+
+    def test_lru_eviction(self):
+        cache = DecryptionCache(max_size=2, ttl=60)
+        cache.set('a', 'one')
+        cache.set('b', 'two')
+        cache.get('a')
+        cache.set('c', 'three')
+
+        self.assertEqual(cache.get('a'), 'one')
+        self.assertIs(cache.get('b'), MISSING)
+        self.assertEqual(cache.stats()['size'], 2)
+
+    def test_expired_entries_miss(self):
+        cache = DecryptionCache(max_size=10, ttl=-1)
+        cache.set('a', 'one')
+        self.assertIs(cache.get('a'), MISSING)
+
+    @override_settings(CACHES={'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_shared_cache_never_holds_plaintext(self):
+        cache = DecryptionCache(max_size=10, ttl=60, shared_cache='shared')
+        cache.set('ciphertext', 'secret name')
+
+        stored = caches['shared'].get(f'vault_app:decrypted:{cache.digest("ciphertext")}')
+        self.assertNotIn(b'secret name', stored)
+
+        other_process = DecryptionCache(max_size=10, ttl=60, shared_cache='shared')
+        self.assertEqual(other_process.get('ciphertext'), 'secret name')
+        self.assertEqual(other_process.stats()['shared_hits'], 1)
+
+    @override_settings(VAULT_LIST_CACHE=None)
+    def test_repeated_listing_hits_cache(self):
+        user = User.objects.create_user('owner', password='secret')
+        Folder.objects.create(name='Taxes', user=user)
+        client = APIClient()
+        client.force_authenticate(user)
+
+        cache = get_decryption_cache()
+        cache.clear()
+        client.get('/api/folders/')
+        misses = cache.stats()['misses']
+        response = client.get('/api/folders/')
+
+        self.assertEqual(response.json()['results'][0]['name'], 'Taxes')
+        self.assertEqual(cache.stats()['misses'], misses)
+        self.assertGreater(cache.stats()['hits'], 0)
+
+
+@override_settings(VAULT_LIST_CACHE=None)
+class BlindIndexSearchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='secret')
+        cls.other = User.objects.create_user('other', password='secret')
+        cls.folder = Folder.objects.create(name='Letters', user=cls.user)
+        cls.invoice = Document.objects.create(name='Invoice März 2024', file='a.pdf', user=cls.user, folder=cls.folder)
+        cls.lease = Document.objects.create(name='Lease agreement', file='b.pdf', user=cls.user, folder=cls.folder)
+        other_folder = Folder.objects.create(name='Letters', user=cls.other)
+        Document.objects.create(name='Invoice', file='c.pdf', user=cls.other, folder=other_folder)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def search(self, term):
+        response = self.client.get('/api/documents/', {'search': term})
+        self.assertEqual(response.status_code, 200)
+        return sorted(document['id'] for document in response.json()['results'])
+
+    def test_partial_words(self):
+        self.assertEqual(self.search('inv'), [self.invoice.pk])
+        self.assertEqual(self.search('voic'), [self.invoice.pk])
+        # shorter than a trigram, a word prefix
+        self.assertEqual(self.search('le'), [self.lease.pk])
+        self.assertEqual(self.search('ea'), [])
+        self.assertEqual(self.search('invoices'), [])
+
+    def test_every_term_has_to_match(self):
+        self.assertEqual(self.search('invoice 2024'), [self.invoice.pk])
+        self.assertEqual(self.search('invoice agreement'), [])
+
+    def test_case_and_normalization(self):
+        self.assertEqual(self.search('INVOICE'), [self.invoice.pk])
+        self.assertEqual(self.search('märz'), [self.invoice.pk])
+        self.assertEqual(self.search('MÄRZ'), [self.invoice.pk])
+
+    def test_tokens_are_keyed_per_user(self):
+        self.assertEqual(self.search('invoice'), [self.invoice.pk])
+        own = blind_index.exact_token(self.user.pk, 'document', 'name', 'Lease agreement')
+        other = blind_index.exact_token(self.other.pk, 'document', 'name', 'Lease agreement')
+        self.assertNotEqual(own, other)
+        self.assertFalse(BlindIndexToken.objects.filter(user=self.other, token=own).exists())
+
+    def test_renames_are_indexed(self):
+        self.lease.name = 'Rental contract'
+        self.lease.save()
+        self.assertEqual(self.search('lease'), [])
+        self.assertEqual(self.search('contr'), [self.lease.pk])
+
+    def test_names_are_not_an_ordering(self):
+        response = self.client.get('/api/documents/', {'ordering': 'name'})
+        self.assertEqual([document['id'] for document in response.json()['results']], [self.lease.pk, self.invoice.pk])
+
+
+@override_settings(VAULT_LIST_CACHE=None)
+class PaginationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='secret')
+        cls.folder = Folder.objects.create(name='Inbox', user=cls.user)
+        cls.documents = Document.objects.bulk_create([
+            Document(name=f'Scan {i}', file=f'{i}.pdf', size=10, user=cls.user, folder=cls.folder) for i in range(7)
+        ])
+        # rows created at the same moment are told apart by id
+        Document.objects.filter(pk__in=[document.pk for document in cls.documents[2:5]]).update(
+            created_at=cls.documents[2].created_at,
+        )
+        counters.reconcile()
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def pages(self, url):
+        while url:
+            data = self.client.get(url).json()
+            yield [item['id'] for item in data['results']]
+            url = data['next']
+
+    def expected_order(self):
+        return list(Document.objects.order_by('-created_at', '-id').values_list('pk', flat=True))
+
+    def test_cursor_pages_are_stable(self):
+        pages = list(self.pages('/api/documents/?page_size=2'))
+        self.assertEqual([len(page) for page in pages], [2, 2, 2, 1])
+        self.assertEqual(sum(pages, []), self.expected_order())
+
+    def test_new_rows_do_not_shift_later_pages(self):
+        data = self.client.get('/api/documents/', {'page_size': 3}).json()
+        Document.objects.create(name='New', file='new.pdf', user=self.user, folder=self.folder)
+
+        rest = sum(self.pages(data['next']), [])
+        self.assertEqual([item['id'] for item in data['results']] + rest, self.expected_order()[1:])
+
+        previous = self.client.get(self.client.get(data['next']).json()['previous']).json()
+        self.assertEqual([item['id'] for item in previous['results']], [item['id'] for item in data['results']])
+
+    def test_page_size_bounds(self):
+        Document.objects.bulk_create([
+            Document(name='Bulk', file=f'bulk-{i}.pdf', user=self.user, folder=self.folder) for i in range(500)
+        ])
+        for page_size, expected in ((None, 50), ('5', 5), ('10000', 500), ('0', 50), ('-1', 50), ('x', 50)):
+            params = {} if page_size is None else {'page_size': page_size}
+            self.assertEqual(len(self.client.get('/api/documents/', params).json()['results']), expected, page_size)
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get('/api/documents/', {'cursor': 'nope'}).status_code, 404)
+
+    def test_folder_summary(self):
+        folder = self.client.get('/api/folders/').json()['results'][0]
+        self.assertNotIn('documents', folder)
+        self.assertEqual((folder['document_count'], folder['total_bytes']), (7, 70))
+
+        folder = self.client.get('/api/folders/', {'expand': 'documents'}).json()['results'][0]
+        self.assertEqual(len(folder['documents']), 7)
+        self.assertEqual(folder['document_count'], 7)
+
+    def test_plaintext_length(self):
+        for chunk_size in (16, 64 * 1024):
+            for size in (0, 1, chunk_size - 1, chunk_size, chunk_size + 1, 5 * chunk_size, 5 * chunk_size + 3):
+                length = storage.encrypted_length(size, chunk_size)
+                self.assertEqual(storage.plaintext_length(length, chunk_size), size)
+
+
+class BulkDocumentTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='secret')
+        cls.source = Folder.objects.create(name='Inbox', user=cls.user)
+        cls.target = Folder.objects.create(name='Archive', user=cls.user)
+        cls.tag = Tag.objects.create(name='Tax', user=cls.user)
+        cls.documents = [
+            Document.objects.create(name=f'Scan {i}', file=f'{i}.pdf', user=cls.user, folder=cls.source)
+            for i in range(5)
+        ]
+        other = User.objects.create_user('other', password='secret')
+        cls.foreign = Document.objects.create(
+            name='Foreign', file='foreign.pdf', user=other, folder=Folder.objects.create(name='Other', user=other),
+        )
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.ids = [document.pk for document in self.documents]
+
+    def test_move_reports_each_item(self):
+        response = self.client.post('/api/documents/bulk-move/', {
+            'ids': self.ids + [self.foreign.pk], 'folder': self.target.pk,
+        }, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        statuses = {item['id']: item['status'] for item in response.json()['results']}
+        self.assertEqual(statuses[self.foreign.pk], 'not_found')
+        self.assertEqual(Document.objects.filter(folder=self.target).count(), 5)
+        self.assertEqual(Document.objects.get(pk=self.foreign.pk).folder.name, 'Other')
+
+    def test_duplicate_ids_count_once(self):
+        counters.reconcile()
+        ids = [self.ids[0], self.ids[0], self.foreign.pk, self.ids[1], self.foreign.pk]
+        response = self.client.post('/api/documents/bulk-move/', {'ids': ids, 'folder': self.target.pk}, format='json')
+        self.assertEqual(response.json()['results'], [
+            {'id': self.ids[0], 'status': 'moved'}, {'id': self.ids[1], 'status': 'moved'},
+            {'id': self.foreign.pk, 'status': 'not_found'},
+        ])
+        self.target.refresh_from_db()
+        self.assertEqual(self.target.document_count, 2)
+
+        response = self.client.post('/api/documents/bulk-delete/', {'ids': ids}, format='json')
+        self.assertEqual([item['status'] for item in response.json()['results']], ['deleted', 'deleted', 'not_found'])
+        self.target.refresh_from_db()
+        self.assertEqual(self.target.document_count, 0)
+
+    def test_ownership_is_resolved_in_the_transaction(self):
+        depth = len(connection.savepoint_ids)
+        owned = bulk._owned
+
+        def resolve(*args):
+            self.assertGreater(len(connection.savepoint_ids), depth)
+            return owned(*args)
+
+        with mock.patch.object(bulk, '_owned', side_effect=resolve) as calls:
+            for action, data in (('move', {'folder': self.target.pk}), ('tag', {'add': [self.tag.pk]}), ('delete', {})):
+                self.client.post(f'/api/documents/bulk-{action}/', {'ids': self.ids, **data}, format='json')
+        self.assertEqual(calls.call_count, 3)
+
+    def test_move_to_foreign_folder_is_rejected(self):
+        response = self.client.post('/api/documents/bulk-move/', {
+            'ids': self.ids, 'folder': self.foreign.folder_id,
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_retag_runs_a_fixed_number_of_queries(self):
+        with self.assertNumQueries(11):
+            response = self.client.post('/api/documents/bulk-tag/', {
+                'ids': self.ids, 'add': [self.tag.pk],
+            }, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.tag.documents.count(), 5)
+
+        self.client.post('/api/documents/bulk-tag/', {'ids': self.ids[:2], 'remove': [self.tag.pk]}, format='json')
+        self.assertEqual(self.tag.documents.count(), 3)
+
+    def test_delete_removes_rows_and_index(self):
+        response = self.client.post('/api/documents/bulk-delete/', {'ids': self.ids}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Document.objects.filter(pk__in=self.ids).exists())
+        self.assertFalse(BlindIndexToken.objects.filter(model='document', object_id__in=self.ids).exists())
+
+    def test_upload(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+
+        with self.settings(MEDIA_ROOT=media_root):
+            response = self.client.post('/api/documents/bulk-upload/', {
+                'files': [SimpleUploadedFile('a.txt', b'alpha'), SimpleUploadedFile('b.txt', b'beta')],
+                'folder': self.target.pk,
+                'tags': [self.tag.pk],
+            }, format='multipart')
+
+            self.assertEqual(response.status_code, 201, response.content)
+            results = response.json()['results']
+            self.assertEqual([item['name'] for item in results], ['a', 'b'])
+            document = Document.objects.get(pk=results[1]['id'])
+            self.assertEqual(document.size, 4)
+            self.assertEqual(list(document.tags.all()), [self.tag])
+            with document.file.open() as file_handle:
+                self.assertEqual(file_handle.read(), b'beta')
+
+        search = self.client.get('/api/documents/', {'search': 'b'}).json()['results']
+        self.assertEqual([item['name'] for item in search], ['b'])
+
+
+# background jobs would write from the pool's result thread, racing the test on the shared in-memory database
+@override_settings(BACKGROUND_WORKERS=0)
+class AsyncViewTests(TemporaryMediaRootMixin, TransactionTestCase):
+    # the views run database work in their own threads, which must see committed rows
+
+    def setUp(self):
+        super().setUp()
+        settings_override = self.settings(ENCRYPTED_FILE_CHUNK_SIZE=4, UPLOAD_CHUNK_SIZE=4)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create_user('owner', password='secret')
+        self.folder = Folder.objects.create(name='Inbox', user=self.user)
+        self.auth = {'Authorization': f'Bearer {AccessToken.for_user(self.user)}'}
+
+    async def read(self, response):
+        return b''.join([data async for data in response.streaming_content])
+
+    async def test_download_matches_sync_view(self):
+        document = await Document.objects.acreate(
+            name='Report', file=SimpleUploadedFile('report.txt', b'0123456789'), file_type='text/plain',
+            user=self.user, folder=self.folder,
+        )
+        url = f'/api/async/documents/{document.pk}/download/'
+
+        response = await self.async_client.get(url, headers=self.auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(await self.read(response), b'0123456789')
+        sync = await self.async_client.get(f'/api/documents/{document.pk}/download/', headers=self.auth)
+        for header in ('Content-Length', 'Content-Disposition', 'ETag', 'Last-Modified'):
+            self.assertEqual(response[header], sync[header])
+
+        response = await self.async_client.get(url, headers={**self.auth, 'Range': 'bytes=2-4'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(await self.read(response), b'234')
+        response = await self.async_client.get(url, headers={**self.auth, 'Range': 'bytes=10-'})
+        self.assertEqual(response.status_code, 416)
+
+    def test_download_requires_owner(self):
+        other = User.objects.create_user('other', password='secret')
+        document = Document.objects.create(name='Secret', file='secret.txt', user=other,
+                                           folder=Folder.objects.create(name='Other', user=other))
+        url = f'/api/async/documents/{document.pk}/download/'
+
+        self.assertEqual(self.client.get(url).status_code, 401)
+        self.assertEqual(self.client.get(url, headers={'Authorization': 'Bearer nope'}).status_code, 401)
+        self.assertEqual(self.client.get(url, headers=self.auth).status_code, 404)
+
+    def test_upload_chunks(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        session = client.post('/api/upload-sessions/', {
+            'name': 'Notes', 'filename': 'notes.txt', 'file_type': 'text/plain', 'folder': self.folder.pk, 'size': 10,
+        }, format='json').json()
+        self.assertEqual(session['chunk_size'], 4)
+        url = f'/api/async/upload-sessions/{session["id"]}/chunks/%d/'
+
+        def put(index, data):
+            return self.client.put(url % index, data, content_type='application/octet-stream', headers=self.auth)
+
+        self.assertEqual(put(0, b'0123').json()['next_index'], 1)
+        self.assertEqual(put(0, b'0123').json()['offset'], 4)
+        response = put(2, b'89')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['next_index'], 1)
+        self.assertEqual(put(1, b'45').status_code, 400)
+        put(1, b'4567')
+        self.assertEqual(put(2, b'89').json()['offset'], 10)
+
+        response = client.post(f'/api/upload-sessions/{session["id"]}/finalize/')
+        self.assertEqual(response.status_code, 201, response.content)
+        with Document.objects.get(pk=response.json()['id']).file.open() as file_handle:
+            self.assertEqual(file_handle.read(), b'0123456789')
+
+
+@override_settings(ENCRYPTED_FILE_CHUNK_SIZE=4, UPLOAD_CHUNK_SIZE=8, BACKGROUND_WORKERS=0)
+class UploadSessionTests(TemporaryMediaRootMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='secret')
+        cls.folder = Folder.objects.create(name='Inbox', user=cls.user)
+        cls.tag = Tag.objects.create(name='Notes', user=cls.user)
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        response = self.client.post('/api/upload-sessions/', {
+            'name': 'Notes', 'filename': 'notes.txt', 'file_type': 'text/plain', 'folder': self.folder.pk,
+            'tags': [self.tag.pk], 'size': 20,
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.session = response.json()
+        self.url = f'/api/upload-sessions/{self.session["id"]}/'
+
+    def put(self, index, data):
+        return self.client.put(f'{self.url}chunks/{index}/', data, content_type='application/octet-stream')
+
+    def partial_files(self):
+        return os.listdir(os.path.join(self.media_root, 'partial'))
+
+    def test_create(self):
+        self.assertEqual(self.session['chunk_size'], 8)
+        self.assertEqual((self.session['offset'], self.session['next_index']), (0, 0))
+        self.assertEqual(self.partial_files(), [f'{self.session["id"]}.part'])
+        self.assertEqual(self.client.get(self.url).json()['offset'], 0)
+
+    def test_chunks_resends_and_finalize(self):
+        self.assertEqual(self.put(0, b'01234567').json()['offset'], 8)
+        # a resent chunk whose response was lost is acknowledged as is
+        response = self.put(0, b'01234567')
+        self.assertEqual((response.status_code, response.json()['offset']), (200, 8))
+        self.assertEqual(self.put(1, b'89abcdef').json()['next_index'], 2)
+
+        response = self.client.post(f'{self.url}finalize/')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('incomplete', response.json()['detail'])
+
+        self.assertEqual(self.put(2, b'ghij').json()['offset'], 20)
+        self.assertEqual(self.put(3, b'klmn').json()['detail'], 'Upload is already complete.')
+        response = self.client.post(f'{self.url}finalize/')
+        self.assertEqual(response.status_code, 201, response.content)
+
+        document = Document.objects.get(pk=response.json()['id'])
+        self.assertEqual((document.name, document.size, list(document.tags.all())), ('Notes', 20, [self.tag]))
+        with document.file.open() as file_handle:
+            self.assertEqual(file_handle.read(), b'0123456789abcdefghij')
+        self.assertEqual(self.partial_files(), [])
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_out_of_order_chunk(self):
+        response = self.put(1, b'89abcdef')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['next_index'], 0)
+
+    def test_short_chunks(self):
+        response = self.put(0, b'0123')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['detail'], 'Chunk 0 must be 8 bytes.')
+
+        # the connection dropped before the announced length arrived
+        session = UploadSession.objects.get(pk=self.session['id'])
+        with self.assertRaisesMessage(uploads.UploadError, 'Chunk 0 ended early.'):
+            uploads.store_chunk(session, 0, io.BytesIO(b'0123'), 8)
+        self.assertEqual(self.partial_files(), [f'{self.session["id"]}.part'])
+        self.assertEqual(self.put(0, b'01234567').json()['offset'], 8)
+
+    def test_body_is_read_outside_the_transaction(self):
+        depth = len(connection.savepoint_ids)
+        read_exact = uploads.read_exact
+
+        def read(stream, size):
+            self.assertEqual(len(connection.savepoint_ids), depth)
+            return read_exact(stream, size)
+
+        with mock.patch.object(uploads, 'read_exact', side_effect=read) as reads:
+            self.assertEqual(self.put(0, b'01234567').status_code, 200)
+        self.assertEqual(reads.call_count, 2)
+
+    def test_abort(self):
+        self.put(0, b'01234567')
+        # left by a request that died while it encrypted its chunk
+        open(os.path.join(self.media_root, 'partial', f'{self.session["id"]}.1.x8b2'), 'wb').close()
+        self.assertEqual(self.client.delete(self.url).status_code, 204)
+        self.assertEqual(self.partial_files(), [])
+        self.assertEqual(self.put(1, b'89abcdef').status_code, 404)
+
+
+@override_settings(BACKGROUND_WORKERS=0)
+class BlobTests(TemporaryMediaRootMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='secret')
+        cls.folder = Folder.objects.create(name='Inbox', user=cls.user)
+        cls.other_folder = Folder.objects.create(name='Archive', user=cls.user)
+
+    def setUp(self):
+        super().setUp()
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def upload(self, folder, content=b'same pdf'):
+        response = self.client.post('/api/documents/', {
+            'name': 'Scan', 'file': SimpleUploadedFile('scan.pdf', content), 'folder': folder.pk,
+        }, format='multipart')
+        self.assertEqual(response.status_code, 201, response.content)
+        return Document.objects.get(pk=response.json()['id'])
+
+    def stored_files(self):
+        return [name for name in os.listdir(self.media_root) if name != 'partial']
+
+    def test_equal_uploads_share_a_blob(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = self.upload(self.folder)
+            second = self.upload(self.other_folder)
+            self.upload(self.folder, b'other pdf')
+
+        self.assertEqual(first.blob_id, second.blob_id)
+        self.assertEqual(Blob.objects.get(pk=first.blob_id).ref_count, 2)
+        self.assertEqual(len(self.stored_files()), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f'/api/documents/{first.pk}/')
+        self.assertEqual(Blob.objects.get(pk=first.blob_id).ref_count, 1)
+        with second.file.open() as file_handle:
+            self.assertEqual(file_handle.read(), b'same pdf')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/documents/bulk-delete/', {'ids': [second.pk]}, format='json')
+        self.assertFalse(Blob.objects.filter(pk=first.blob_id).exists())
+        self.assertEqual(len(self.stored_files()), 1)
+
+    def test_users_do_not_share_blobs(self):
+        other = User.objects.create_user('other', password='secret')
+        document = self.upload(self.folder)
+        foreign = Document.objects.create(
+            name='Scan', file=SimpleUploadedFile('scan.pdf', b'same pdf'), user=other,
+            folder=Folder.objects.create(name='Other', user=other),
+        )
+        self.assertNotEqual(document.blob_id, foreign.blob_id)
+        self.assertNotEqual(document.blob.digest, foreign.blob.digest)
+
+    def test_upload_session_of_stored_content_needs_no_chunks(self):
+        document = self.upload(self.folder)
+        session = self.client.post('/api/upload-sessions/', {
+            'name': 'Copy', 'filename': 'copy.pdf', 'folder': self.other_folder.pk, 'size': 8,
+            'sha256': hashlib.sha256(b'same pdf').hexdigest(),
+        }, format='json').json()
+        self.assertTrue(session['content_exists'])
+
+        response = self.client.post(f'/api/upload-sessions/{session["id"]}/finalize/')
+        self.assertEqual(response.status_code, 201, response.content)
+        copy = Document.objects.get(pk=response.json()['id'])
+        self.assertEqual(copy.blob_id, document.blob_id)
+        self.assertEqual(copy.blob.ref_count, 2)
+
+    def test_deduplicate_legacy_documents(self):
+        # as stored before blobs: a file per document; file deletions only run when captured
+        documents = [self.upload(self.folder) for _ in range(2)]
+        Document.objects.update(blob=None)
+        Blob.objects.all().delete()
+        storage = Document._meta.get_field('file').storage
+        copy = storage.save('copy.pdf', SimpleUploadedFile('copy.pdf', b'same pdf'))
+        Document.objects.filter(pk=documents[1].pk).update(file=copy)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('deduplicate_documents', stdout=open(os.devnull, 'w'))
+
+        blob = Blob.objects.get()
+        self.assertEqual(blob.ref_count, 2)
+        self.assertEqual(set(Document.objects.values_list('blob_id', flat=True)), {blob.pk})
+        self.assertEqual(self.stored_files(), [blob.name])
+
+
+@override_settings(BACKGROUND_WORKERS=0)
+class PreviewTests(TemporaryMediaRootMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='secret')
+        cls.folder = Folder.objects.create(name='Scans', user=cls.user)
+
+    def setUp(self):
+        super().setUp()
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def upload(self, filename, content, file_type):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/documents/', {
+                'name': filename, 'file': SimpleUploadedFile(filename, content), 'file_type': file_type,
+                'folder': self.folder.pk,
+            }, format='multipart')
+        self.assertEqual(response.status_code, 201, response.content)
+        return response.json()['id']
+
+    def assertPreview(self, document_id, width, height):
+        from PIL import Image
+
+        response = self.client.get(f'/api/documents/{document_id}/preview/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(Image.open(io.BytesIO(response.content)).size, (width, height))
+        return response
+
+    def test_image_preview(self):
+        from PIL import Image
+
+        image = io.BytesIO()
+        Image.new('RGB', (1024, 512), 'red').save(image, 'PNG')
+        document_id = self.upload('photo.png', image.getvalue(), 'image/png')
+
+        response = self.assertPreview(document_id, 256, 128)
+        cached = self.client.get(f'/api/documents/{document_id}/preview/', headers={'If-None-Match': response['ETag']})
+        self.assertEqual(cached.status_code, 304)
+
+    def test_pdf_preview(self):
+        import pypdfium2
+
+        pdf = pypdfium2.PdfDocument.new()
+        pdf.new_page(300, 600)
+        content = io.BytesIO()
+        pdf.save(content)
+        document_id = self.upload('scan.pdf', content.getvalue(), 'application/pdf')
+
+        self.assertPreview(document_id, 128, 256)
+
+    def test_unsupported_and_stale_previews(self):
+        document_id = self.upload('notes.txt', b'plain text', 'text/plain')
+        response = self.client.get(f'/api/documents/{document_id}/preview/')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()['status'], Preview.UNSUPPORTED)
+
+        Preview.objects.filter(document_id=document_id).update(digest='replaced content')
+        response = self.client.get(f'/api/documents/{document_id}/preview/')
+        self.assertEqual(response.status_code, 202)
+
+
+def make_pdf(text):
+    """A one page PDF showing ``text``."""
+    stream = f'BT /F1 12 Tf 20 100 Td ({text}) Tj ET'.encode()
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 300 200] /Contents 4 0 R '
+        b'/Resources << /Font << /F1 5 0 R >> >> >>',
+        b'<< /Length %d >>\nstream\n%s\nendstream' % (len(stream), stream),
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    ]
+    pdf = b'%PDF-1.4\n'
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b'%d 0 obj\n%s\nendobj\n' % (number, body)
+    xref = len(pdf)
+    pdf += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    pdf += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    pdf += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    return pdf
+
+
+@override_settings(BACKGROUND_WORKERS=0)
+class ContentIndexTests(TemporaryMediaRootMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='secret')
+        cls.folder = Folder.objects.create(name='Letters', user=cls.user)
+
+    def setUp(self):
+        super().setUp()
+        # each test starts over at the same vault version of the same user
+        caches['vault_lists'].clear()
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def upload(self, filename, content, file_type='text/plain'):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/documents/', {
+                'name': filename, 'file': SimpleUploadedFile(filename, content), 'file_type': file_type,
+                'folder': self.folder.pk,
+            }, format='multipart')
+        self.assertEqual(response.status_code, 201, response.content)
+        return response.json()['id']
+
+    def search(self, q):
+        response = self.client.get('/api/documents/', {'q': q})
+        self.assertEqual(response.status_code, 200)
+        return sorted(document['id'] for document in response.json()['results'])
+
+    def test_search_text_and_pdf(self):
+        lease = self.upload('lease.txt', 'Rental agreement for the Flat, signed in Zürich'.encode())
+        invoice = self.upload('invoice.txt', b'Invoice for the rental of a bicycle')
+        scan = self.upload('scan.pdf', make_pdf('Scanned rental receipt'), 'application/pdf')
+
+        self.assertEqual(self.search('rental'), sorted([lease, invoice, scan]))
+        self.assertEqual(self.search('receipt'), [scan])
+        self.assertEqual(self.search('RENTAL flat'), [lease])
+        self.assertEqual(self.search('zurich'), [])
+        self.assertEqual(self.search('zürich'), [lease])
+        self.assertEqual(self.search('missing'), [])
+
+        # terms are keyed per user
+        self.assertFalse(ContentTerm.objects.filter(token=content_index.term_token(self.user.pk + 1, 'rental')))
+
+    def test_index_follows_updates_and_deletes(self):
+        document_id = self.upload('notes.txt', b'first draft')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(f'/api/documents/{document_id}/', {
+                'file': SimpleUploadedFile('notes.txt', b'final version'),
+            }, format='multipart')
+        self.assertEqual(self.search('draft'), [])
+        self.assertEqual(self.search('final'), [document_id])
+
+        self.client.delete(f'/api/documents/{document_id}/')
+        self.assertFalse(ContentTerm.objects.filter(user=self.user).exists())
+
+    def test_updates_leave_other_postings_alone(self):
+        lease = self.upload('lease.txt', b'rental agreement')
+        invoice = self.upload('invoice.txt', b'rental invoice')
+        token = content_index.term_token(self.user.pk, 'rental')
+        posting = ContentTerm.objects.get(token=token, document_id=lease)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(f'/api/documents/{invoice}/', {
+                'file': SimpleUploadedFile('invoice.txt', b'paid invoice'),
+            }, format='multipart')
+        self.assertEqual(list(ContentTerm.objects.filter(token=token).values_list('pk', flat=True)), [posting.pk])
+        self.assertEqual(self.search('rental'), [lease])
+        self.assertEqual(self.search('invoice'), [invoice])
+
+    def test_search_query_budget(self):
+        self.upload('a.txt', b'alpha beta')
+        with self.assertNumQueries(4):
+            self.search('alpha beta')
+
+
+@override_settings(BACKGROUND_WORKERS=0)
+class CounterTests(TemporaryMediaRootMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='secret')
+        cls.inbox = Folder.objects.create(name='Inbox', user=cls.user)
+        cls.archive = Folder.objects.create(name='Archive', user=cls.user)
+        cls.tag = Tag.objects.create(name='Tax', user=cls.user)
+
+    def setUp(self):
+        super().setUp()
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def upload(self, content, folder=None):
+        response = self.client.post('/api/documents/', {
+            'name': 'Scan', 'file': SimpleUploadedFile('scan.bin', content), 'folder': (folder or self.inbox).pk,
+            'tags': [self.tag.pk],
+        }, format='multipart')
+        self.assertEqual(response.status_code, 201, response.content)
+        return response.json()['id']
+
+    def assertCounts(self, obj, count, size):
+        obj.refresh_from_db()
+        self.assertEqual((obj.document_count, obj.total_bytes), (count, size))
+
+    def test_counters_follow_documents(self):
+        first = self.upload(b'12345')
+        second = self.upload(b'123')
+        self.assertCounts(self.inbox, 2, 8)
+        self.assertCounts(self.tag, 2, 8)
+        self.assertCounts(self.user, 2, 8)
+        self.assertIsNotNone(self.inbox.last_modified)
+
+        self.client.patch(f'/api/documents/{first}/', {'folder': self.archive.pk}, format='json')
+        self.assertCounts(self.inbox, 1, 3)
+        self.assertCounts(self.archive, 1, 5)
+
+        self.client.post('/api/documents/bulk-move/', {'ids': [second], 'folder': self.archive.pk}, format='json')
+        self.client.post('/api/documents/bulk-tag/', {'ids': [first, second], 'add': [self.tag.pk]}, format='json')
+        self.assertCounts(self.inbox, 0, 0)
+        self.assertCounts(self.archive, 2, 8)
+        self.assertCounts(self.tag, 2, 8)
+
+        self.client.post('/api/documents/bulk-tag/', {'ids': [first], 'remove': [self.tag.pk]}, format='json')
+        self.assertCounts(self.tag, 1, 3)
+        Document.objects.get(pk=second).tags.clear()
+        self.assertCounts(self.tag, 0, 0)
+
+        self.client.delete(f'/api/documents/{first}/')
+        self.client.post('/api/documents/bulk-delete/', {'ids': [second]}, format='json')
+        self.assertCounts(self.archive, 0, 0)
+        self.assertCounts(self.user, 0, 0)
+
+        response = self.client.post('/api/documents/bulk-upload/', {
+            'files': [SimpleUploadedFile('a.bin', b'ab'), SimpleUploadedFile('b.bin', b'cde')],
+            'folder': self.inbox.pk, 'tags': [self.tag.pk],
+        }, format='multipart')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertCounts(self.inbox, 2, 5)
+        self.assertCounts(self.tag, 2, 5)
+        self.assertCounts(self.user, 2, 5)
+
+    def test_folder_lists_counters(self):
+        self.upload(b'12345')
+        folders = {folder['id']: folder for folder in self.client.get('/api/folders/').json()['results']}
+        self.assertEqual(folders[self.inbox.pk]['document_count'], 1)
+        self.assertEqual(folders[self.inbox.pk]['total_bytes'], 5)
+
+    def test_only_bulk_writes_skip_counters(self):
+        with blind_index.suspended():
+            document = Document.objects.create(name='Scan', file='scan.pdf', size=10, user=self.user,
+                                               folder=self.inbox)
+        self.assertCounts(self.inbox, 1, 10)
+        self.assertFalse(BlindIndexToken.objects.filter(model='document', object_id=document.pk).exists())
+
+        with signals.bulk_write():
+            Document.objects.create(name='Scan', file='scan.pdf', size=5, user=self.user, folder=self.inbox)
+        self.assertCounts(self.inbox, 1, 10)
+
+    def test_reconcile_fixes_drift(self):
+        self.upload(b'12345')
+        Folder.objects.filter(pk=self.inbox.pk).update(document_count=7, total_bytes=0)
+        User.objects.filter(pk=self.user.pk).update(document_count=0)
+
+        call_command('reconcile_counters', stdout=io.StringIO())
+        self.assertCounts(self.inbox, 1, 5)
+        self.assertCounts(self.archive, 0, 0)
+        self.assertCounts(self.user, 1, 5)
+
+    def test_uploads_over_quota_are_rejected(self):
+        User.objects.filter(pk=self.user.pk).update(storage_quota=8)
+        self.user.refresh_from_db()
+        self.upload(b'12345')
+        self.user.refresh_from_db()
+
+        response = self.client.post('/api/documents/', {
+            'name': 'Big', 'file': SimpleUploadedFile('big.bin', b'1234'), 'folder': self.inbox.pk,
+        }, format='multipart')
+        self.assertEqual(response.status_code, 413)
+
+        response = self.client.post('/api/upload-sessions/', {
+            'name': 'Big', 'filename': 'big.bin', 'folder': self.inbox.pk, 'size': 4,
+        }, format='json')
+        self.assertEqual(response.status_code, 413)
+        self.assertCounts(self.user, 1, 5)
+
+        blobs_before = Blob.objects.count()
+        response = self.client.post('/api/documents/bulk-upload/', {
+            'files': [SimpleUploadedFile('a.bin', b'ab'), SimpleUploadedFile('b.bin', b'cd')],
+            'folder': self.inbox.pk,
+        }, format='multipart')
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(Blob.objects.count(), blobs_before)
+        self.assertCounts(self.user, 1, 5)
+
+    def test_stale_instances_count_from_the_row(self):
+        document = Document.objects.get(pk=self.upload(b'12345'))
+        self.client.patch(f'/api/documents/{document.pk}/', {'folder': self.archive.pk}, format='json')
+
+        document.delete()
+        self.assertCounts(self.inbox, 0, 0)
+        self.assertCounts(self.archive, 0, 0)
+        self.assertCounts(self.user, 0, 0)
+
+    def test_counted_rows_are_locked(self):
+        select_for_update = QuerySet.select_for_update
+        with mock.patch.object(QuerySet, 'select_for_update', autospec=True,
+                               side_effect=select_for_update) as locks:
+            document = self.upload(b'12345')
+            self.assertIn(User, [call.args[0].model for call in locks.call_args_list])
+
+            locks.reset_mock()
+            self.client.patch(f'/api/documents/{document}/', {'folder': self.archive.pk}, format='json')
+            self.client.post('/api/documents/bulk-move/', {'ids': [document], 'folder': self.inbox.pk}, format='json')
+            self.client.delete(f'/api/documents/{document}/')
+            self.assertEqual([call.args[0].model for call in locks.call_args_list], [Document] * 3)
+
+
+class VaultVersionTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='secret')
+        cls.folder = Folder.objects.create(name='Inbox', user=cls.user)
+        cls.tag = Tag.objects.create(name='Tax', user=cls.user)
+        cls.document = Document.objects.create(name='Scan', file='scan.pdf', user=cls.user, folder=cls.folder)
+
+    def setUp(self):
+        self.client = APIClient()
+        # a real token, so every request loads the user's current version
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+
+    def test_unchanged_listing_is_not_modified(self):
+        response = self.client.get('/api/folders/')
+        etag = response['ETag']
+        self.assertEqual(response.json()['results'][0]['name'], 'Inbox')
+
+        # only the user is loaded
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/folders/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/folders/')
+        self.assertEqual(response.json()['results'][0]['name'], 'Inbox')
+        self.assertEqual(response['ETag'], etag)
+
+        self.assertNotEqual(self.client.get('/api/folders/?ordering=created_at')['ETag'], etag)
+
+    def test_writes_change_the_version(self):
+        etag = self.client.get('/api/documents/')['ETag']
+        self.client.post('/api/documents/bulk-tag/', {'ids': [self.document.pk], 'add': [self.tag.pk]}, format='json')
+
+        response = self.client.get('/api/documents/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'][0]['tags'], [self.tag.pk])
+
+        etag = response['ETag']
+        self.client.patch(f'/api/folders/{self.folder.pk}/', {'name': 'Archive'}, format='json')
+        self.assertEqual(self.client.get('/api/documents/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_cached_payloads_are_encrypted(self):
+        response = self.client.get('/api/folders/')
+        stored = caches['vault_lists'].get(f'vault_app:list:{response["ETag"]}')
+        self.assertNotIn(b'Inbox', stored)
+
+
+class KeyRotationTests(TemporaryMediaRootMixin, TestCase):
+    old_key = 'Xq1v0mYJ0bKJrB9wY3m8y0Pq8i4v5xQ8hK2yZp1s3nE='
+
+    def setUp(self):
+        super().setUp()
+        for override in (self.settings(BLIND_INDEX_KEY='index-key'), self.settings(SECURED_FIELDS_KEY=self.old_key)):
+            override.enable()
+            self.addCleanup(override.disable)
+
+        self.user = User.objects.create_user('owner', password='secret', first_name='Ada')
+        self.folder = Folder.objects.create(name='Taxes', user=self.user)
+        self.document = Document.objects.create(
+            name='Return', file=SimpleUploadedFile('return.txt', b'refund'), user=self.user, folder=self.folder,
+        )
+        self.new_key = Fernet.generate_key().decode()
+
+    def test_rotation_re_encrypts_columns_and_files(self):
+        checkpoint = os.path.join(self.media_root, 'rotation.json')
+        with self.settings(SECURED_FIELDS_KEY=[self.new_key, self.old_key]):
+            call_command('rotate_keys', processes=0, checkpoint=checkpoint, stdout=io.StringIO())
+            with open(checkpoint) as checkpoint_file:
+                self.assertIn('columns:vault_app.Folder', json.load(checkpoint_file)['done'])
+
+        get_decryption_cache().clear()
+        with self.settings(SECURED_FIELDS_KEY=self.new_key):
+            self.assertEqual(Folder.objects.get(pk=self.folder.pk).name, 'Taxes')
+            self.assertEqual(User.objects.get(pk=self.user.pk).first_name, 'Ada')
+            document = Document.objects.get(pk=self.document.pk)
+            self.assertEqual(document.name, 'Return')
+            with document.file.open() as file_handle:
+                self.assertEqual(file_handle.read(), b'refund')
+            # search tokens do not depend on the encryption key
+            client = APIClient()
+            client.force_authenticate(self.user)
+            results = client.get('/api/folders/', {'search': 'taxes'}).json()['results']
+            self.assertEqual([folder['id'] for folder in results], [self.folder.pk])
+
+    def test_rotation_needs_a_fixed_index_key(self):
+        with self.settings(BLIND_INDEX_KEY=None, SECURED_FIELDS_KEY=[self.new_key, self.old_key]):
+            with self.assertRaises(CommandError):
+                call_command('rotate_keys', processes=0, stdout=io.StringIO())
+
+
+@override_settings(ENCRYPTED_FILE_CHUNK_SIZE=4096)
+class CompressionTests(TemporaryMediaRootMixin, TestCase):
+    text = b''.join(b'%d,invoice,%d.00,paid\n' % (i, i * 7) for i in range(2000))
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='secret')
+        cls.folder = Folder.objects.create(name='Inbox', user=cls.user)
+
+    def setUp(self):
+        super().setUp()
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def upload(self, content, name='ledger.csv', content_type='text/csv'):
+        response = self.client.post('/api/documents/bulk-upload/', {
+            'files': [SimpleUploadedFile(name, content, content_type=content_type)], 'folder': self.folder.pk,
+        }, format='multipart')
+        self.assertEqual(response.status_code, 201, response.content)
+        return Document.objects.get(pk=response.json()['results'][0]['id'])
+
+    def flags(self, document):
+        with open(document.file.path, 'rb') as raw:
+            return SegmentedFile(raw).flags
+
+    def test_text_is_compressed_and_served_by_range(self):
+        document = self.upload(self.text)
+        self.assertTrue(self.flags(document) & FLAG_COMPRESSED)
+        self.assertLess(document.blob.stored_size, len(self.text) / 3)
+
+        response = self.client.get(f'/api/documents/{document.pk}/download/', HTTP_RANGE='bytes=5000-9999')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.text[5000:10000])
+        response = self.client.get(f'/api/documents/{document.pk}/download/')
+        self.assertEqual(response['Content-Length'], str(len(self.text)))
+        self.assertEqual(b''.join(response.streaming_content), self.text)
+
+    def test_compressed_and_random_content_is_stored_as_is(self):
+        jpeg = self.upload(b'\xff\xd8\xff\xe0' + self.text, name='scan.jpg', content_type='image/jpeg')
+        noise = self.upload(os.urandom(20000), name='noise.bin', content_type='application/octet-stream')
+        self.assertFalse(self.flags(jpeg) & FLAG_COMPRESSED)
+        self.assertFalse(self.flags(noise) & FLAG_COMPRESSED)
+        with jpeg.file.open() as file_handle:
+            self.assertEqual(file_handle.read(), b'\xff\xd8\xff\xe0' + self.text)
+
+    def test_existing_files_are_compressed_by_command(self):
+        with self.settings(STORAGE_COMPRESSION={'ENABLED': False}):
+            document = self.upload(self.text)
+        self.assertFalse(self.flags(document) & FLAG_COMPRESSED)
+
+        call_command('compress_blobs', stdout=io.StringIO())
+        self.assertTrue(self.flags(document) & FLAG_COMPRESSED)
+        self.assertLess(Blob.objects.get(pk=document.blob_id).stored_size, len(self.text) / 3)
+        with document.file.open() as file_handle:
+            self.assertEqual(file_handle.read(), self.text)
+
+
+class CachedAuthenticationTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('owner', password='secret-words-1', first_name='Ada')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+
+    def test_user_is_loaded_only_when_needed(self):
+        self.assertEqual(self.client.get('/api/tags/').status_code, 200)
+
+        # the cached state authenticates, the deferred profile fields load together
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/profile/')
+        self.assertEqual(response.json()['first_name'], 'Ada')
+
+        self.assertEqual(self.client.patch('/api/profile/', {'last_name': 'Lovelace'}, format='json').status_code, 200)
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.first_name, self.user.last_name), ('Ada', 'Lovelace'))
+
+    def test_password_change_revokes_tokens(self):
+        response = self.client.put('/api/change-password/', {
+            'old_password': 'secret-words-1', 'new_password': 'secret-words-2',
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get('/api/tags/').status_code, 401)
+
+    def test_deactivation_takes_effect(self):
+        self.assertEqual(self.client.get('/api/tags/').status_code, 200)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/api/tags/').status_code, 401)
+
+    def test_changes_made_elsewhere_accept_new_tokens(self):
+        old_token = AccessToken.for_user(self.user)
+        self.assertEqual(self.client.get('/api/tags/').status_code, 200)
+        # another process changes the password, and this one keeps its cached state
+        User.objects.filter(pk=self.user.pk).update(password=make_password('secret-words-2'))
+        self.user.refresh_from_db()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        self.assertEqual(self.client.get('/api/tags/').status_code, 200)
+        # which reloaded the state, revoking the old token
+        old_client = APIClient()
+        old_client.credentials(HTTP_AUTHORIZATION=f'Bearer {old_token}')
+        self.assertEqual(old_client.get('/api/tags/').status_code, 401)
+
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        authentication.clear()
+        self.assertEqual(self.client.get('/api/tags/').status_code, 401)
+        User.objects.filter(pk=self.user.pk).update(is_active=True)
+        self.assertEqual(self.client.get('/api/tags/').status_code, 200)
+
+    def test_logout_blacklists_refresh_token(self):
+        refresh = str(RefreshToken.for_user(self.user))
+        self.assertEqual(self.client.post('/api/logout/', {'refresh': refresh}, format='json').status_code, 200)
+        response = self.client.post('/api/token/refresh/', {'refresh': refresh}, format='json')
+        self.assertEqual(response.status_code, 401)
+
+
+class MetricsTests(TemporaryMediaRootMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='secret')
+        cls.folder = Folder.objects.create(name='Inbox', user=cls.user)
+
+    def setUp(self):
+        super().setUp()
+
+        self.content = os.urandom(12000)
+        self.document = Document.objects.create(
+            name='Statement', file=SimpleUploadedFile('statement.bin', self.content),
+            user=self.user, folder=self.folder,
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_requests_are_measured_per_endpoint(self):
+        requests = self.sample('vault_request_duration_seconds_count',
+                               method='GET', endpoint='document-download', status='200')
+        decrypted = self.sample('vault_crypto_bytes_total', endpoint='document-download', operation='file_decrypt')
+        sent = self.sample('vault_transfer_bytes_sum', endpoint='document-download', direction='response')
+        queries = self.sample('vault_request_db_queries_sum', endpoint='document-list')
+
+        response = self.client.get(f'/api/documents/{self.document.pk}/download/')
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        response.close()
+        self.client.get('/api/documents/')
+
+        self.assertEqual(self.sample('vault_request_duration_seconds_count',
+                                     method='GET', endpoint='document-download', status='200'), requests + 1)
+        self.assertEqual(self.sample('vault_crypto_bytes_total', endpoint='document-download',
+                                     operation='file_decrypt'), decrypted + 12000)
+        self.assertEqual(self.sample('vault_transfer_bytes_sum', endpoint='document-download',
+                                     direction='response'), sent + 12000)
+        self.assertGreater(self.sample('vault_request_db_queries_sum', endpoint='document-list'), queries)
+
+        exposition = self.client.get('/metrics').content.decode()
+        self.assertIn('vault_crypto_seconds_total{endpoint="document-download",operation="file_decrypt"}',
+                      exposition)
+
+    @override_settings(METRICS_TOKEN='scrape')
+    def test_metrics_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scrape').status_code, 200)
+
+    def test_slow_requests_are_profiled(self):
+        directory = os.path.join(self.media_root, 'profiles')
+        with self.settings(SLOW_REQUEST_PROFILER={'ENABLED': True, 'THRESHOLD': 0, 'INTERVAL': 0.001,
+                                                  'DIRECTORY': directory}):
+            with mock.patch('vault_app.views.DocumentViewSet.list', side_effect=lambda *args, **kwargs: (
+                time.sleep(0.05), HttpResponse(b'[]'))[1]):
+                self.client.get('/api/documents/')
+
+        [name] = os.listdir(directory)
+        self.assertIn('document-list', name)
+        with open(os.path.join(directory, name)) as profile_file:
+            stack, count = profile_file.readline().rsplit(' ', 1)
+        self.assertIn('MetricsMiddleware.__call__', stack)
+        self.assertGreater(int(count), 0)
+
+    def test_queries_are_counted_per_alias(self):
+        before = REGISTRY.get_sample_value('vault_db_queries_total', {'alias': 'default'}) or 0
+        list(Folder.objects.all())
+        self.assertEqual(REGISTRY.get_sample_value('vault_db_queries_total', {'alias': 'default'}), before + 1)
+
+
+class ExportTests(TemporaryMediaRootMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='secret')
+        cls.taxes = Folder.objects.create(name='Taxes', user=cls.user)
+        cls.travel = Folder.objects.create(name='Travel/2024', user=cls.user)
+        cls.receipts = Folder.objects.create(name='Receipts', user=cls.user, parent=cls.taxes)
+
+    def setUp(self):
+        super().setUp()
+
+        self.large = os.urandom(3 * exports.BLOCK_SIZE + 5)
+        for name, filename, content, folder in (
+            ('Return', 'return.pdf', b'first return', self.taxes),
+            ('Return', 'return.pdf', b'second return', self.taxes),
+            ('Passport', 'passport.jpg', self.large, self.travel),
+            ('Return', 'receipt.pdf', b'receipt', self.receipts),
+        ):
+            Document.objects.create(name=name, file=SimpleUploadedFile(filename, content), user=self.user,
+                                    folder=folder)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def archive(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        parts = list(response.streaming_content)
+        # nothing close to a whole file is held at once
+        self.assertLessEqual(max(len(part) for part in parts), exports.BLOCK_SIZE + 1024)
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(parts)))
+        self.assertIsNone(archive.testzip())
+        return {name: archive.read(name) for name in archive.namelist()}
+
+    def test_folder_export(self):
+        files = self.archive(self.client.get(f'/api/folders/{self.taxes.pk}/export/'))
+        self.assertEqual(files, {
+            'Return.pdf': b'first return', 'Return (2).pdf': b'second return', 'Receipts/Return.pdf': b'receipt',
+        })
+
+    def test_vault_export(self):
+        files = self.archive(self.client.get('/api/export/'))
+        self.assertEqual(sorted(files), [
+            'Taxes/Receipts/Return.pdf', 'Taxes/Return (2).pdf', 'Taxes/Return.pdf', 'Travel_2024/Passport.jpg',
+        ])
+        self.assertEqual(files['Travel_2024/Passport.jpg'], self.large)
+
+    def test_export_links(self):
+        url = self.client.post('/api/export-links/', {'folder': self.taxes.pk}, format='json').json()['url']
+        anonymous = APIClient()
+        self.assertEqual(len(self.archive(anonymous.get(url))), 3)
+
+        # a link only opens the export it was made for
+        signature = url.split('?')[1]
+        self.assertEqual(anonymous.get(f'/api/export/?{signature}').status_code, 401)
+        self.assertEqual(anonymous.get('/api/export/?signature=forged').status_code, 401)
+        other = User.objects.create_user('other', password='secret')
+        self.client.force_authenticate(other)
+        self.assertEqual(
+            self.client.post('/api/export-links/', {'folder': self.taxes.pk}, format='json').status_code, 404,
+        )
+
+
+class FolderTreeTests(TemporaryMediaRootMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='secret')
+        cls.work = Folder.objects.create(name='Work', user=cls.user)
+        cls.clients = Folder.objects.create(name='Clients', user=cls.user, parent=cls.work)
+        cls.acme = Folder.objects.create(name='Acme', user=cls.user, parent=cls.clients)
+        cls.hr = Folder.objects.create(name='HR', user=cls.user, parent=cls.work)
+        cls.home = Folder.objects.create(name='Home', user=cls.user)
+
+    def setUp(self):
+        super().setUp()
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def add_document(self, folder, content):
+        return Document.objects.create(name='Scan', file=SimpleUploadedFile('scan.bin', content), user=self.user,
+                                       folder=folder)
+
+    def links(self):
+        return set(FolderLink.objects.values_list('ancestor_id', 'descendant_id', 'depth'))
+
+    def names(self, response):
+        self.assertEqual(response.status_code, 200, response.content)
+        data = response.json()
+        return sorted(folder['name'] for folder in data.get('results', data))
+
+    def test_subtree_queries(self):
+        self.add_document(self.acme, b'12345')
+        self.add_document(self.hr, b'123')
+        self.add_document(self.home, b'1')
+
+        with self.assertNumQueries(1):
+            self.assertEqual({folder.name for folder in folder_tree.descendants(self.work)}, {'Clients', 'Acme', 'HR'})
+        with self.assertNumQueries(1):
+            crumbs = [folder.name for folder in folder_tree.breadcrumbs(self.acme)]
+        self.assertEqual(crumbs, ['Work', 'Clients', 'Acme'])
+        with self.assertNumQueries(1):
+            totals = folder_tree.subtree_totals(self.work)
+        self.assertEqual(totals, {'folder_count': 4, 'document_count': 2, 'total_bytes': 8})
+
+        self.assertEqual(self.names(self.client.get('/api/folders/', {'parent__isnull': 'true'})), ['Home', 'Work'])
+        self.assertEqual(self.names(self.client.get('/api/folders/', {'parent': self.work.pk})), ['Clients', 'HR'])
+        self.assertEqual(self.names(self.client.get(f'/api/folders/{self.work.pk}/descendants/')),
+                         ['Acme', 'Clients', 'HR'])
+        self.assertEqual(self.client.get(f'/api/folders/{self.acme.pk}/breadcrumbs/').json(), [
+            {'id': self.work.pk, 'name': 'Work'}, {'id': self.clients.pk, 'name': 'Clients'},
+            {'id': self.acme.pk, 'name': 'Acme'},
+        ])
+        self.assertEqual(self.client.get(f'/api/folders/{self.clients.pk}/totals/').json(),
+                         {'folder_count': 2, 'document_count': 1, 'total_bytes': 5})
+
+    def test_move_subtree(self):
+        response = self.client.patch(f'/api/folders/{self.clients.pk}/', {'parent': self.home.pk}, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual([folder.name for folder in folder_tree.breadcrumbs(self.acme)], ['Home', 'Clients', 'Acme'])
+        self.assertEqual({folder.name for folder in folder_tree.descendants(self.work)}, {'HR'})
+
+        # the links match the ones rebuilt from the parents
+        links = self.links()
+        call_command('rebuild_folder_tree', stdout=io.StringIO())
+        self.assertEqual(self.links(), links)
+
+        self.client.patch(f'/api/folders/{self.clients.pk}/', {'parent': None}, format='json')
+        self.assertEqual([folder.name for folder in folder_tree.breadcrumbs(self.acme)], ['Clients', 'Acme'])
+
+        # folders cannot go below themselves, nor into another user's folder
+        response = self.client.patch(f'/api/folders/{self.clients.pk}/', {'parent': self.acme.pk}, format='json')
+        self.assertEqual(response.status_code, 400)
+        other = Folder.objects.create(name='Other', user=User.objects.create_user('other', password='secret'))
+        response = self.client.patch(f'/api/folders/{self.home.pk}/', {'parent': other.pk}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_delete_hides_subtree_until_reaped(self):
+        for folder in (self.work, self.clients, self.acme, self.hr, self.home):
+            self.add_document(folder, f'{folder.name} scan'.encode())
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.assertEqual(folder_tree.delete(self.user, self.clients), 2)
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(self.client.delete(f'/api/folders/{self.work.pk}/').status_code, 204)
+
+        self.assertEqual(list(Folder.objects.values_list('name', flat=True)), ['Home'])
+        self.assertEqual(self.names(self.client.get('/api/folders/')), ['Home'])
+        self.assertEqual(Document.objects.count(), 1)
+        self.assertEqual(self.client.get(f'/api/folders/{self.acme.pk}/').status_code, 404)
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.document_count, self.user.total_bytes), (1, len(b'Home scan')))
+        # nothing was removed yet
+        self.assertEqual(Document.all_objects.count(), 5)
+        self.assertEqual(Blob.objects.count(), 5)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(reaper.reap(batch_size=1), (4, 4))
+        self.assertEqual(list(Folder.all_objects.values_list('name', flat=True)), ['Home'])
+        self.assertEqual(self.links(), {(self.home.pk, self.home.pk, 0)})
+        self.assertEqual(Document.all_objects.count(), 1)
+        self.assertEqual(Blob.objects.count(), 1)
+        self.assertEqual(len(os.listdir(self.media_root)), 1)
+        self.assertFalse(BlindIndexToken.objects.filter(model='folder', object_id=self.work.pk).exists())
+        counters.reconcile()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.document_count, 1)
+
+    def test_collect_garbage_sweeps_unreferenced_files(self):
+        kept = self.add_document(self.home, b'kept')
+        orphan = Blob.objects.create(user=self.user, digest='0' * 64, name='orphan.bin', size=1, ref_count=1)
+        Blob.objects.filter(pk=orphan.pk).update(created_at=timezone.now() - timedelta(days=2))
+        old = time.time() - 2 * 86400
+        for name in ('orphan.bin', 'leftover.bin', 'recent.bin'):
+            with open(os.path.join(self.media_root, name), 'wb') as leftover:
+                leftover.write(b'x')
+            if name != 'recent.bin':
+                os.utime(os.path.join(self.media_root, name), (old, old))
+        os.utime(os.path.join(self.media_root, kept.file.name), (old, old))
+
+        out = io.StringIO()
+        call_command('collect_garbage', '--dry-run', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'Would delete 1 blobs and 1 files of 1 bytes.')
+        self.assertTrue(Blob.objects.filter(pk=orphan.pk).exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('collect_garbage', stdout=io.StringIO())
+        self.assertFalse(Blob.objects.filter(pk=orphan.pk).exists())
+        self.assertEqual(sorted(os.listdir(self.media_root)), sorted([kept.file.name, 'recent.bin']))
+
+
+class SyncTests(TemporaryMediaRootMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='secret')
+        cls.inbox = Folder.objects.create(name='Inbox', user=cls.user)
+        cls.archive = Folder.objects.create(name='Archive', user=cls.user)
+        cls.tag = Tag.objects.create(name='Tax', user=cls.user)
+        Folder.objects.create(name='Other', user=User.objects.create_user('other', password='secret'))
+
+    def setUp(self):
+        super().setUp()
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def sync(self, since=None, **params):
+        response = self.client.get('/api/sync/', {'since': since or 0, **params})
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def ids(self, data, name):
+        return sorted(item['id'] for item in data[name])
+
+    def add_document(self, folder):
+        return Document.objects.create(name='Scan', file=SimpleUploadedFile('scan.txt', b'scan'), user=self.user,
+                                       folder=folder)
+
+    def test_changes_since_cursor(self):
+        document = self.add_document(self.inbox)
+        full = self.sync()
+        self.assertTrue(full['reset'])
+        self.assertEqual(self.ids(full, 'folders'), sorted([self.inbox.pk, self.archive.pk]))
+        self.assertEqual(self.ids(full, 'tags'), [self.tag.pk])
+        self.assertEqual(self.ids(full, 'documents'), [document.pk])
+
+        unchanged = self.sync(full['cursor'])
+        self.assertEqual(unchanged['cursor'], full['cursor'])
+        self.assertEqual((unchanged['folders'], unchanged['tags'], unchanged['documents']), ([], [], []))
+
+        # a move changes the document and the counters of both folders
+        self.client.post('/api/documents/bulk-move/', {'ids': [document.pk], 'folder': self.archive.pk}, format='json')
+        self.client.delete(f'/api/tags/{self.tag.pk}/')
+        changes = self.sync(full['cursor'])
+        self.assertFalse(changes['reset'])
+        self.assertEqual(self.ids(changes, 'folders'), sorted([self.inbox.pk, self.archive.pk]))
+        self.assertEqual(changes['documents'][0]['folder'], self.archive.pk)
+        self.assertEqual(changes['deleted'], {'folders': [], 'tags': [self.tag.pk], 'documents': []})
+
+        self.client.post('/api/documents/bulk-delete/', {'ids': [document.pk]}, format='json')
+        changes = self.sync(changes['cursor'])
+        self.assertEqual(self.ids(changes, 'folders'), [self.archive.pk])
+        self.assertEqual(changes['deleted']['documents'], [document.pk])
+
+    def test_pages_end_with_whole_versions(self):
+        self.client.post('/api/documents/bulk-upload/', {
+            'files': [SimpleUploadedFile(f'{name}.txt', b'scan') for name in 'abc'], 'folder': self.inbox.pk,
+        }, format='multipart')
+        last = self.add_document(self.inbox)
+
+        page = self.sync(limit=1, include='documents')
+        self.assertEqual((len(page['documents']), page['more']), (3, True))
+        self.assertNotIn('folders', page)
+        page = self.sync(page['cursor'], limit=1, include='documents')
+        self.assertEqual((self.ids(page, 'documents'), page['more']), ([last.pk], False))
+
+    def test_compaction_resets_old_cursors(self):
+        cursor = self.sync()['cursor']
+        self.client.delete(f'/api/folders/{self.archive.pk}/')
+        self.assertEqual(self.sync(cursor)['deleted']['folders'], [self.archive.pk])
+
+        Change.objects.filter(deleted=True).update(changed_at=timezone.now() - timedelta(days=31))
+        # syncing only reads, compaction is left to the command
+        self.assertFalse(self.sync(cursor)['reset'])
+        out = io.StringIO()
+        call_command('compact_sync_journal', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'Dropped 1 tombstones.')
+        data = self.sync(cursor)
+        self.assertTrue(data['reset'])
+        self.assertEqual(self.ids(data, 'folders'), [self.inbox.pk])
+        self.assertFalse(Change.objects.filter(deleted=True).exists())
+        self.assertFalse(self.sync(data['cursor'])['reset'])
+
+
+    def test_journal_is_read_in_the_transaction_of_the_horizon(self):
+        depth = len(connection.savepoint_ids)
+        read = journal.read
+
+        def read_in_snapshot(*args, **kwargs):
+            self.assertGreater(len(connection.savepoint_ids), depth)
+            return read(*args, **kwargs)
+
+        with mock.patch.object(journal, 'read', side_effect=read_in_snapshot) as reads, \
+                CaptureQueriesContext(connection) as queries:
+            self.client.get('/api/sync/', {'since': '1.0', 'include': 'folders'})
+        self.assertEqual(reads.call_count, 1)
+        # compaction is left to compact_sync_journal, a sync only reads
+        statements = [query['sql'].split()[0] for query in queries.captured_queries]
+        self.assertEqual(set(statements) - {'SAVEPOINT', 'RELEASE'}, {'SELECT'})
+@override_settings(READ_REPLICAS={'ALIASES': ['replica'], 'PIN_SECONDS': 5, 'CHECK_INTERVAL': 60})
+class ReplicaRoutingTests(SimpleTestCase):
+
+    def setUp(self):
+        replicas._health.clear()
+        self.addCleanup(replicas._health.clear)
+        check = mock.patch.object(replicas, 'check', return_value=True)
+        self.check = check.start()
+        self.addCleanup(check.stop)
+
+    def route(self, method, model=Document, cookies=None):
+        """The database ``model`` is read from during a ``method`` request, and its response."""
+        seen = []
+
+        def view(request):
+            seen.append(router.db_for_read(model))
+            return HttpResponse()
+
+        request = RequestFactory().generic(method, '/api/documents/')
+        request.COOKIES.update(cookies or {})
+        response = replicas.ReplicaMiddleware(view)(request)
+        return seen[0], response
+
+    def test_reads_follow_the_client_writes(self):
+        self.assertEqual(self.route('GET')[0], 'replica')
+        self.assertEqual(self.route('GET', model=Permission)[0], 'default')
+
+        alias, response = self.route('POST')
+        self.assertEqual(alias, 'default')
+        cookie = response.cookies[replicas.PIN_COOKIE]
+        # as long as a replica in use can be behind
+        self.assertEqual(cookie['max-age'], 70)
+        self.assertEqual(self.route('GET', cookies={replicas.PIN_COOKIE: cookie.value})[0], 'default')
+        self.assertEqual(self.route('GET', cookies={replicas.PIN_COOKIE: str(time.time() - 1)})[0], 'replica')
+        with self.settings(READ_REPLICAS={'ALIASES': ['replica'], 'PIN_SECONDS': 300}):
+            self.assertEqual(self.route('POST')[1].cookies[replicas.PIN_COOKIE]['max-age'], 300)
+
+    def test_failing_replica_is_left_out(self):
+        self.assertEqual(self.route('GET')[0], 'replica')
+        failing = mock.Mock(side_effect=OperationalError('gone'))
+        with self.assertRaises(OperationalError):
+            replicas.watch_failures(failing, 'SELECT 1', None, False, {'connection': mock.Mock(alias='replica')})
+        self.assertEqual(self.route('GET')[0], 'default')
+        self.assertEqual(REGISTRY.get_sample_value('vault_db_replica_ejections_total', {'alias': 'replica'}), 1)
+
+        # checked again once the interval is over
+        with self.settings(READ_REPLICAS={'ALIASES': ['replica'], 'CHECK_INTERVAL': 0}):
+            self.check.return_value = False
+            self.assertEqual(self.route('GET')[0], 'default')
+            self.check.return_value = True
+            self.assertEqual(self.route('GET')[0], 'replica')
+
+
+class FakeS3Client:
+    """The calls object_storage.py makes of an S3 client, kept in memory."""
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.part_numbers = []
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = bytes(Body)
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = str(len(self.uploads))
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.uploads[UploadId][PartNumber] = bytes(Body)
+        self.part_numbers.append(PartNumber)
+        return {'ETag': f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.objects[Key] = b''.join(parts[part['PartNumber']] for part in MultipartUpload['Parts'])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        return {'ContentLength': len(self.objects[Key]), 'LastModified': timezone.now()}
+
+    def get_object(self, Bucket, Key, Range):
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        start, end = map(int, Range.removeprefix('bytes=').split('-'))
+        return {'Body': io.BytesIO(self.objects[Key][start:end + 1])}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, Bucket, Prefix, Delimiter):
+        names = [key for key in sorted(self.objects) if key.startswith(Prefix)]
+        files = [name for name in names if Delimiter not in name[len(Prefix):]]
+        directories = sorted({name[:name.index(Delimiter, len(Prefix)) + 1] for name in set(names) - set(files)})
+        yield {'Contents': [{'Key': name} for name in files], 'CommonPrefixes': [{'Prefix': d} for d in directories]}
+
+
+@override_settings(ENCRYPTED_FILE_CHUNK_SIZE=16)
+class RangedDownloadTests(TemporaryMediaRootMixin, TestCase):
+    content = bytes(range(100))
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='secret')
+        cls.folder = Folder.objects.create(name='Inbox', user=cls.user)
+
+    def setUp(self):
+        super().setUp()
+        self.document = Document.objects.create(
+            name='Scan', file=SimpleUploadedFile('scan.bin', self.content), user=self.user, folder=self.folder,
+        )
+        self.url = f'/api/documents/{self.document.pk}/download/'
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get(self, **headers):
+        response = self.client.get(self.url, headers=headers)
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, body
+
+    def test_single_ranges(self):
+        for header, start, end in (('bytes=10-40', 10, 40), ('bytes=90-', 90, 99), ('bytes=-5', 95, 99),
+                                   ('bytes=95-500', 95, 99), ('bytes=-500', 0, 99)):
+            response, body = self.get(Range=header)
+            self.assertEqual(response.status_code, 206, header)
+            self.assertEqual(response['Content-Range'], f'bytes {start}-{end}/100')
+            self.assertEqual(response['Content-Length'], str(end - start + 1))
+            self.assertEqual(body, self.content[start:end + 1])
+
+    def test_unsatisfiable_ranges(self):
+        for header in ('bytes=0-1,5-6', 'bytes=40-10', 'bytes=100-', 'bytes=-0', 'bytes=-', 'bytes=a-b'):
+            response, _ = self.get(Range=header)
+            self.assertEqual(response.status_code, 416, header)
+            self.assertEqual(response['Content-Range'], 'bytes */100')
+
+    def test_other_units_get_the_whole_file(self):
+        response, body = self.get(Range='items=0-1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.content)
+
+    def test_if_range(self):
+        etag = self.get()[0]['ETag']
+        response, body = self.get(Range='bytes=0-9', **{'If-Range': etag})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, self.content[:10])
+
+        response, body = self.get(Range='bytes=0-9', **{'If-Range': '"stale"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.content)
+
+    def write_legacy(self, name, content):
+        with open(os.path.join(self.media_root, name), 'wb') as stored:
+            stored.write(get_fernet().encrypt(content))
+        return Document.objects.create(name='Old scan', file=name, size=len(content), user=self.user,
+                                       folder=self.folder)
+
+    def test_legacy_fernet_files_stay_readable(self):
+        document = self.write_legacy('old.bin', self.content)
+        file_storage = Document._meta.get_field('file').storage
+        self.assertFalse(file_storage.is_segmented(document.file.name))
+
+        self.url = f'/api/documents/{document.pk}/download/'
+        response, body = self.get(Range='bytes=20-29')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, self.content[20:30])
+
+    def test_convert_encrypted_files(self):
+        document = self.write_legacy('old.bin', self.content)
+        Document.objects.create(name='Lost', file='lost.bin', user=self.user, folder=self.folder)
+        file_storage = Document._meta.get_field('file').storage
+
+        out = io.StringIO()
+        call_command('convert_encrypted_files', '--dry-run', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'Converted 1 files, 1 already segmented, 1 missing.')
+        self.assertFalse(file_storage.is_segmented(document.file.name))
+
+        call_command('convert_encrypted_files', '--batch-size', '1', stdout=io.StringIO())
+        self.assertTrue(file_storage.is_segmented(document.file.name))
+        with file_storage.open(document.file.name) as stored:
+            self.assertEqual(stored.read(), self.content)
+
+        out = io.StringIO()
+        call_command('convert_encrypted_files', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'Converted 0 files, 2 already segmented, 1 missing.')
+
+
+class StorageBackendTests(TemporaryMediaRootMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='secret')
+        cls.folder = Folder.objects.create(name='Inbox', user=cls.user)
+
+    def setUp(self):
+        super().setUp()
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def download(self, document):
+        response = self.client.get(f'/api/documents/{document.pk}/download/')
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content)
+
+    def test_sharded_storage_spreads_new_files(self):
+        sharded = storage.ShardedSegmentedEncryptedFileSystemStorage()
+        names = {sharded.save('scan.pdf', SimpleUploadedFile('scan.pdf', b'%PDF')) for _ in range(3)}
+
+        self.assertEqual(len(names), 3)
+        self.assertTrue(all(storage.is_sharded(name) and name.endswith('.pdf') for name in names))
+        with sharded.open(names.pop()) as stored:
+            self.assertEqual(stored.read(), b'%PDF')
+
+    def test_shard_files_moves_flat_files(self):
+        documents = [
+            Document.objects.create(name='Scan', file=SimpleUploadedFile('scan.pdf', content), user=self.user,
+                                    folder=self.folder)
+            for content in (b'first', b'second')
+        ]
+        flat = [document.file.name for document in documents]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('shard_files', '--workers', '2', stdout=io.StringIO())
+
+        for document, name, content in zip(documents, flat, (b'first', b'second')):
+            document.refresh_from_db()
+            self.assertEqual(document.file.name, document.blob.name)
+            self.assertEqual(document.file.name, storage.shard_name(name))
+            self.assertFalse(os.path.exists(os.path.join(self.media_root, name)))
+            self.assertEqual(self.download(document), content)
+
+        out = io.StringIO()
+        call_command('shard_files', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'Moved 0 files, 0 missing.')
+
+    def test_set_document_sizes(self):
+        contents = {'scan.bin': os.urandom(5000), 'notes.txt': b'minutes of the meeting\n' * 400, 'empty.txt': b''}
+        documents = [
+            Document.objects.create(name=name, file=SimpleUploadedFile(name, content), user=self.user,
+                                    folder=self.folder)
+            for name, content in contents.items()
+        ]
+        file_storage = Document._meta.get_field('file').storage
+        self.assertTrue(storage.HEADER.unpack(file_storage.header(documents[1].file.name))[2] & FLAG_COMPRESSED)
+        with open(os.path.join(self.media_root, 'old.txt'), 'wb') as stored:
+            stored.write(get_fernet().encrypt(b'legacy'))
+        contents['old.txt'] = b'legacy'
+        documents.append(Document.objects.create(name='old', file='old.txt', user=self.user, folder=self.folder))
+        Document.objects.create(name='lost', file='lost.txt', user=self.user, folder=self.folder)
+        Document.objects.update(size=0)
+
+        out = io.StringIO()
+        call_command('set_document_sizes', '--batch-size', '2', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'Updated 3 documents, 1 missing.')
+        for document, content in zip(documents, contents.values()):
+            document.refresh_from_db()
+            self.assertEqual(document.size, len(content), document.name)
+        self.folder.refresh_from_db()
+        self.assertEqual(self.folder.total_bytes, sum(map(len, contents.values())))
+
+    def test_keys_rotate_in_s3_storage(self):
+        old_key, new_key = Fernet.generate_key().decode(), Fernet.generate_key().decode()
+        fake = FakeS3Client()
+        with mock.patch.object(object_storage, 'get_client', return_value=fake), \
+                self.settings(SECURED_FIELDS_KEY=old_key):
+            s3 = object_storage.SegmentedEncryptedS3Storage(BUCKET='vault')
+            name = s3.save('return.txt', SimpleUploadedFile('return.txt', b'refund'))
+            unnamed = s3.save('stray.txt', SimpleUploadedFile('stray.txt', b'stray'))
+            document = Document.objects.create(name='Return', file=name, user=self.user, folder=self.folder)
+            with self.settings(SECURED_FIELDS_KEY=[new_key, old_key]):
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.assertGreater(key_rotation.rotate_file(s3, name, key_rotation.Throttle(0)), 0)
+                document.refresh_from_db()
+                self.assertNotEqual(document.file.name, name)
+                self.assertEqual(key_rotation.rotate_file(s3, document.file.name, key_rotation.Throttle(0)), 0)
+                self.assertEqual(key_rotation.rotate_file(s3, 'missing.txt', key_rotation.Throttle(0)), 0)
+                # a file no row names is left as it is
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.assertEqual(key_rotation.rotate_file(s3, unnamed, key_rotation.Throttle(0)), 0)
+            # the object is never replaced in place, so ranged reads of the old one stay consistent
+            self.assertEqual(sorted(fake.objects), sorted([document.file.name, unnamed]))
+            with self.settings(SECURED_FIELDS_KEY=new_key), s3.open(document.file.name) as stored:
+                self.assertEqual(stored.read(), b'refund')
+
+            # these rewrite local files
+            with mock.patch.object(blobs, 'file_storage', return_value=s3):
+                for command in ('compress_blobs', 'shard_files'):
+                    with self.assertRaisesMessage(CommandError, 'file system storage only'):
+                        call_command(command, stdout=io.StringIO())
+
+    def test_s3_storage_uploads_in_parallel_parts(self):
+        fake = FakeS3Client()
+        with mock.patch.object(object_storage, 'get_client', return_value=fake):
+            s3 = object_storage.SegmentedEncryptedS3Storage(BUCKET='vault', PREFIX='files/', PART_SIZE=64 * 1024,
+                                                            CONCURRENCY=2, READ_SIZE=4096)
+            content = os.urandom(300 * 1024)
+            name = s3.save_document('scan.bin', SimpleUploadedFile('scan.bin', content), 'image/png')
+            small = s3.save('note.txt', SimpleUploadedFile('note.txt', b'hello'))
+
+            self.assertEqual(sorted(fake.part_numbers), [1, 2, 3, 4, 5])
+            self.assertEqual(s3.listdir(''), ([], ['note.txt', 'scan.bin']))
+            self.assertTrue(s3.is_segmented(name))
+            self.assertEqual(s3.url(name), '/documents/scan.bin')
+            with s3.open(name) as stored:
+                stored.seek(200 * 1024)
+                self.assertEqual(stored.read(1000), content[200 * 1024:200 * 1024 + 1000])
+                stored.seek(0)
+                self.assertEqual(stored.read(), content)
+            with s3.open(small) as stored:
+                self.assertEqual(stored.read(), b'hello')
+
+            s3.delete(name)
+            self.assertFalse(s3.exists(name))
+            self.assertTrue(s3.exists(small))
+
+
+@override_settings(BACKGROUND_WORKERS=0)
+class FastSerializerTests(TestCase):
+    names = ['Ünïcode 😀 ✓', 'line\u2028and\u2029paragraph', 'control \x00\x01\x1f\x7f\t\n', 'quote " back \\ slash /']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='secret')
+        cls.folder = Folder.objects.create(name=cls.names[0], user=cls.user)
+        Folder.objects.create(name=cls.names[1], user=cls.user, parent=cls.folder)
+        cls.tags = [Tag.objects.create(name=name, user=cls.user) for name in cls.names]
+        for i, name in enumerate(cls.names):
+            document = Document.objects.create(name=name, file=f'{i}/scan é.pdf' if i else '', file_type='application/pdf',
+                                               size=i * 1000, user=cls.user, folder=cls.folder)
+            document.tags.set(reversed(cls.tags[:i + 1]))
+        # a tag without documents has no last_modified
+        Tag.objects.create(name='Unused', user=cls.user)
+        counters.reconcile()
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_fast_serializers_match_model_serializers(self):
+        context = {'request': RequestFactory().get('/api/documents/')}
+        for queryset, serializer_class, fast_serializer_class in (
+            (views.document_queryset(), DocumentSerializer, FastDocumentSerializer),
+            (Folder.objects.all(), FolderSerializer, FastFolderSerializer),
+            (Tag.objects.all(), TagSerializer, FastTagSerializer),
+        ):
+            queryset = queryset.filter(user=self.user).order_by('pk')
+            expected = JSONRenderer().render(serializer_class(queryset, many=True, context=context).data)
+            data = fast_serializer_class(fast_serializer_class.rows(queryset), context=context).data
+            self.assertEqual(JSONRenderer().render(data), expected)
+            self.assertEqual(OrjsonRenderer().render(data), expected)
+
+    def test_orjson_renderer_matches_json_renderer(self):
+        now = timezone.now().replace(microsecond=123456)
+        payloads = [
+            {'names': self.names, 'nested': [{'a': None, 'b': True}, (1, -2, 2 ** 63 - 1)], 'empty': {}},
+            {'at': now, 'date': now.date(), 'time': now.time(), 'lazy': gettext_lazy('Not found.'), 'set': {3}},
+            # fall back to JSONRenderer
+            {1: 'integer key', 'big': 2 ** 64},
+            [0.5, -0.0, 123456789.125],
+        ]
+        for data in payloads:
+            self.assertEqual(OrjsonRenderer().render(data), JSONRenderer().render(data))
+        indented = 'application/json; indent=2'
+        self.assertEqual(OrjsonRenderer().render(payloads[0], indented), JSONRenderer().render(payloads[0], indented))
+        self.assertEqual(OrjsonRenderer().render(None), b'')
+
+    def test_list_endpoints_match_model_serializers(self):
+        urls = ['/api/documents/', '/api/folders/', '/api/tags/', f'/api/folders/{self.folder.pk}/descendants/',
+                '/api/documents/?page_size=2', '/api/sync/']
+        fast = {url: self.client.get(url).content for url in urls}
+        caches['vault_lists'].clear()
+        with mock.patch.object(views.FastListMixin, 'get_fast_serializer_class', return_value=None), \
+                mock.patch.object(OrjsonRenderer, 'render', JSONRenderer.render):
+            for url in urls[:-1]:
+                self.assertEqual(self.client.get(url).content, fast[url], url)
+        self.assertEqual(json.loads(fast['/api/documents/'])['results'][-1]['file'], None)
+        self.assertEqual(len(json.loads(fast['/api/sync/'])['documents']), len(self.names))
+
+
+# uploads would start worker processes, with the real settings and MEDIA_ROOT
+@override_settings(BACKGROUND_WORKERS=0)
+class BenchmarkTests(TemporaryMediaRootMixin, LiveServerTestCase):
+
+    def test_seeded_vault_is_reproducible(self):
+        call_command('seed_benchmark_data', users=2, documents=30, distinct_files=3, file_size=2048,
+                     stdout=io.StringIO())
+        names = list(Document.objects.order_by('pk').values_list('name', flat=True))
+        self.assertEqual(Document.objects.count(), 60)
+        self.assertEqual(User.objects.get(username='bench-0').document_count, 30)
+        self.assertEqual(sum(Blob.objects.values_list('ref_count', flat=True)), 60)
+
+        with self.assertRaises(CommandError):
+            call_command('seed_benchmark_data', users=2, stdout=io.StringIO())
+        call_command('seed_benchmark_data', users=2, documents=30, distinct_files=3, file_size=2048, flush=True,
+                     stdout=io.StringIO())
+        self.assertEqual(list(Document.objects.order_by('pk').values_list('name', flat=True)), names)
+
+    def test_benchmark_reports_and_compares_runs(self):
+        benchmarks.seed(users=2, documents=10, distinct_files=2, file_size=2048)
+        output = os.path.join(self.media_root, 'results.json')
+        # one client: the live server shares a single connection to the in-memory database between threads
+        call_command('benchmark', url=self.live_server_url, users=2, clients=1, requests=4, file_size=2048,
+                     iterations=10, micro_file_size=64 * 1024, output=output, stderr=io.StringIO())
+
+        with open(output) as output_file:
+            results = json.load(output_file)
+        self.assertEqual(set(results['http']), set(benchmarks.SCENARIOS))
+        for scenario in results['http'].values():
+            self.assertEqual((scenario['requests'], scenario['errors']), (4, 0))
+            self.assertLessEqual(scenario['latency_ms']['p50'], scenario['latency_ms']['p99'])
+        self.assertLess(results['micro']['file_text_compressed']['stored_bytes'], 64 * 1024)
+        self.assertEqual(results['serialization']['documents']['rows'], 10)
+        for name in ('documents', 'folders', 'tags'):
+            self.assertGreater(results['serialization'][name]['fast_serializer']['cpu_ms_per_1k_rows'], 0)
+        # uploads are removed again
+        self.assertEqual(Document.objects.count(), 20)
+
+        results['http']['documents']['latency_ms']['p95'] = 0.001
+        with open(output, 'w') as output_file:
+            json.dump(results, output_file)
+        with self.assertRaisesMessage(CommandError, 'http.documents.latency_ms.p95'):
+            call_command('benchmark', skip_micro=True, url=self.live_server_url, users=2, clients=1, requests=4,
+                         scenarios='documents', baseline=output, tolerance=0.5, stdout=io.StringIO(),
+                         stderr=io.StringIO())
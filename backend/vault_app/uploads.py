@@ -0,0 +1,213 @@
+import glob
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.db import transaction
+
+from . import blobs
+from .models import Document, UploadSession
+from .storage import HEADER, TAG_SIZE, encrypt_chunk, encrypted_length, get_chunk_size, make_header
+
+DEFAULT_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+class UploadError(Exception):
+    pass
+
+
+class ChunkOutOfOrder(UploadError):
+
+    def __init__(self, next_index):
+        super().__init__(f'Expected chunk {next_index}.')
+        self.next_index = next_index
+
+
+def get_upload_chunk_size():
+    """Client chunk size, a multiple of the storage chunk size so chunks encrypt independently."""
+    storage_chunk_size = get_chunk_size()
+    requested = getattr(settings, 'UPLOAD_CHUNK_SIZE', DEFAULT_UPLOAD_CHUNK_SIZE)
+    return max(1, requested // storage_chunk_size) * storage_chunk_size
+
+
+def partial_path(session):
+    return os.path.join(settings.MEDIA_ROOT, 'partial', f'{session.pk}.part')
+
+
+def read_exact(stream, size):
+    """Read ``size`` bytes from a request stream, which may return short reads."""
+    parts = []
+    while size > 0:
+        data = stream.read(size)
+        if not data:
+            break
+        parts.append(data)
+        size -= len(data)
+    return b''.join(parts), size == 0
+
+
+def start(session):
+    """Create the partial file of a new session, holding only the header."""
+    path = partial_path(session)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as partial:
+        partial.write(make_header())
+
+
+def check_chunk(session, index, length):
+    """Whether chunk ``index`` of ``length`` bytes is the one ``session`` waits for.
+
+    Chunks below ``next_index`` were already stored and are acknowledged as is,
+    so a client may safely resend a chunk whose response it lost.
+    """
+    if index < session.next_index:
+        return False
+    if index > session.next_index:
+        raise ChunkOutOfOrder(session.next_index)
+    if session.received == session.size:
+        raise UploadError('Upload is already complete.')
+
+    expected = min(session.chunk_size, session.size - session.received)
+    if length != expected:
+        raise UploadError(f'Chunk {index} must be {expected} bytes.')
+    return True
+
+
+def encrypt_chunk_file(session, index, stream, length):
+    """Encrypt chunk ``index`` read from ``stream`` into a file of its own next to the partial file.
+
+    Returns its path. Raises UploadSession.DoesNotExist if the session was aborted.
+    """
+    path = partial_path(session)
+    try:
+        with open(path, 'rb') as partial:
+            header = partial.read(HEADER.size)
+    except FileNotFoundError:
+        raise UploadSession.DoesNotExist
+    storage_chunk_size = HEADER.unpack(header)[3]
+
+    fd, chunk_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f'{session.pk}.{index}.')
+    try:
+        with os.fdopen(fd, 'wb') as target:
+            offset = session.received
+            end = offset + length
+            while offset < end:
+                data, complete = read_exact(stream, min(storage_chunk_size, end - offset))
+                if not complete:
+                    raise UploadError(f'Chunk {index} ended early.')
+
+                chunk_index = offset // storage_chunk_size
+                offset += len(data)
+                target.write(encrypt_chunk(header, chunk_index, data, final=offset == session.size))
+    except BaseException:
+        os.unlink(chunk_path)
+        raise
+    return chunk_path
+
+
+def append_chunk_file(session, index, chunk_path, length):
+    """Append the encrypted chunk at ``chunk_path`` to the partial file of the locked ``session``."""
+    with open(partial_path(session), 'r+b') as partial, open(chunk_path, 'rb') as chunk:
+        storage_chunk_size = HEADER.unpack(partial.read(HEADER.size))[3]
+        # drop whatever an interrupted append left past the last acknowledged chunk
+        partial.truncate(HEADER.size + session.received + (session.received // storage_chunk_size) * TAG_SIZE)
+        partial.seek(0, os.SEEK_END)
+        shutil.copyfileobj(chunk, partial)
+
+    session.received += length
+    session.next_index = index + 1
+    session.save(update_fields=['received', 'next_index', 'updated_at'])
+
+
+def store_chunk(session, index, stream, length):
+    """Encrypt chunk ``index`` read from ``stream`` and append it to the partial file of ``session``.
+
+    The body is read and encrypted before the session row is locked, so a slow
+    client holds no transaction; the lock is only taken to check that the
+    chunk is still expected and to append it. Returns the updated session.
+    """
+    if not check_chunk(session, index, length):
+        return session
+
+    chunk_path = encrypt_chunk_file(session, index, stream, length)
+    try:
+        with transaction.atomic():
+            session = UploadSession.objects.select_for_update().get(pk=session.pk)
+            # a concurrent request may have stored it meanwhile
+            if check_chunk(session, index, length):
+                append_chunk_file(session, index, chunk_path, length)
+    finally:
+        os.unlink(chunk_path)
+    return session
+
+
+def finalize(session):
+    """Create the session's Document from its completed partial file.
+
+    A session announcing the sha256 of content the user already stored can
+    be finalized without sending any chunk.
+    """
+    document = Document(
+        name=session.name,
+        file_type=session.file_type,
+        size=session.size,
+        user=session.user,
+        folder=session.folder,
+    )
+    path = partial_path(session)
+
+    blob = None
+    if session.digest and session.received == 0:
+        blob = blobs.acquire(session.user_id, session.digest, session.size)
+    if blob is not None:
+        os.unlink(path)
+    else:
+        check_complete(session)
+        digest = blobs.keyed_digest(session.user_id, blobs.encrypted_sha256(path))
+        if session.digest and digest != session.digest:
+            raise UploadError('Uploaded content does not match its sha256.')
+        blob = blobs.store_encrypted(document, session.filename, path, digest, session.size)
+
+    try:
+        with transaction.atomic():
+            document.blob = blob
+            document.file.name = blob.name
+            document.save()
+            document.tags.set(session.tags.all())
+            session.delete()
+    except Exception:
+        blobs.release([blob.pk])
+        raise
+
+    return document
+
+
+def check_complete(session):
+    """Check that the partial file holds all of the upload, sealing an empty one."""
+    if session.received != session.size:
+        raise UploadError(f'Upload is incomplete, {session.received} of {session.size} bytes received.')
+
+    path = partial_path(session)
+    if session.size == 0:
+        with open(path, 'r+b') as partial:
+            header = partial.read(HEADER.size)
+            partial.truncate(HEADER.size)
+            partial.seek(0, os.SEEK_END)
+            partial.write(encrypt_chunk(header, 0, b'', final=True))
+
+    with open(path, 'rb') as partial:
+        storage_chunk_size = HEADER.unpack(partial.read(HEADER.size))[3]
+    if os.path.getsize(path) != encrypted_length(session.size, storage_chunk_size):
+        raise UploadError('Partial file is corrupt, restart the upload.')
+
+
+def abort(session):
+    path = partial_path(session)
+    # along with the chunks of requests that died before they removed them
+    for name in [path, *glob.glob(os.path.join(os.path.dirname(path), f'{session.pk}.*.*'))]:
+        try:
+            os.unlink(name)
+        except FileNotFoundError:
+            pass
+    session.delete()
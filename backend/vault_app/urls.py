@@ -1,6 +1,8 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import RegisterView, FolderViewSet, DocumentViewSet, TagViewSet, UserProfileView, ChangePasswordView
+from . import async_views
+from .views import RegisterView, FolderViewSet, DocumentViewSet, TagViewSet, UserProfileView, ChangePasswordView, \
+    UploadSessionViewSet, LogoutView, ExportView, ExportLinkView, SyncView
 from rest_framework_simplejwt.views import (
     TokenObtainPairView,
     TokenRefreshView,
@@ -9,13 +11,21 @@ from rest_framework_simplejwt.views import (
 router = DefaultRouter()
 router.register(r'folders', FolderViewSet)
 router.register(r'documents', DocumentViewSet)
+router.register(r'upload-sessions', UploadSessionViewSet)
 router.register(r'tags', TagViewSet)
 
 urlpatterns = [
     path('register/', RegisterView.as_view(), name='auth_register'),
     path('token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    path('logout/', LogoutView.as_view(), name='logout'),
     path('profile/', UserProfileView.as_view(), name='user_profile'),
     path('change-password/', ChangePasswordView.as_view(), name='change_password'),
+    path('export/', ExportView.as_view(), name='vault_export'),
+    path('export-links/', ExportLinkView.as_view(), name='export_link'),
+    path('sync/', SyncView.as_view(), name='sync'),
+    path('async/documents/<int:pk>/download/', async_views.download, name='async_document_download'),
+    path('async/upload-sessions/<uuid:session_id>/chunks/<int:index>/', async_views.upload_chunk,
+         name='async_upload_chunk'),
     path('', include(router.urls)),
 ]
\ No newline at end of file
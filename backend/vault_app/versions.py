@@ -0,0 +1,76 @@
+"""Per-user vault versions, and the ETags and cached listings derived from them.
+
+Every write to a user's folders, tags or documents bumps User.vault_version
+in the writing transaction: the signal handlers do it for single objects,
+bulk.py for the bulk paths. A list request whose ETag still matches is
+answered with 304 after reading just the version, and one whose payload was serialized before is answered from
+the VAULT_LIST_CACHE entry of CACHES without querying or decrypting the
+listing again. Payloads are encrypted before they are written to the cache.
+"""
+import hashlib
+import json
+import os
+from functools import lru_cache
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import F
+from rest_framework.utils.encoders import JSONEncoder
+
+from .models import User
+from .storage import _derive_key
+
+
+def bump(user_ids):
+    """Mark the vaults of ``user_ids`` as changed."""
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    if user_ids:
+        User.objects.filter(pk__in=user_ids).update(vault_version=F('vault_version') + 1)
+
+
+def list_etag(request):
+    """Strong ETag of the listing ``request`` asks for, at the user's current vault version."""
+    user_id = request.user.pk
+    # read fresh: the authenticated user comes from a cache
+    version, date_joined = User.objects.filter(pk=user_id).values_list('vault_version', 'date_joined').get()
+    renderer = getattr(request, 'accepted_media_type', '')
+    # date_joined tells apart users of a reused pk, whose versions start over
+    key = f'{user_id}:{date_joined.timestamp()}:{version}:{renderer}:{request.build_absolute_uri()}'
+    return '"%s"' % hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+def get_cache():
+    name = getattr(settings, 'VAULT_LIST_CACHE', None)
+    return caches[name] if name else None
+
+
+@lru_cache(maxsize=1)
+def get_cipher():
+    fernet_key = settings.SECURED_FIELDS_KEY
+    if isinstance(fernet_key, (list, tuple)):
+        fernet_key = fernet_key[0]
+    return AESGCM(_derive_key(fernet_key, info=b'vault_app.list-cache'))
+
+
+def get_cached(etag):
+    """Payload stored under ``etag``, or None."""
+    cache = get_cache()
+    token = cache.get(f'vault_app:list:{etag}') if cache is not None else None
+    if token is None:
+        return None
+    try:
+        data = get_cipher().decrypt(token[:12], token[12:], etag.encode())
+    except InvalidTag:
+        return None
+    return json.loads(data)
+
+
+def set_cached(etag, payload):
+    cache = get_cache()
+    if cache is None:
+        return
+    nonce = os.urandom(12)
+    token = nonce + get_cipher().encrypt(nonce, json.dumps(payload, cls=JSONEncoder).encode(), etag.encode())
+    cache.set(f'vault_app:list:{etag}', token)
@@ -1,14 +1,29 @@
-from rest_framework import viewsets, generics, status
+from rest_framework import filters, viewsets, generics, mixins, status
 from rest_framework.response import Response
 from rest_framework.decorators import action  
-from django.http import FileResponse          
-import os
-from .models import User, Folder, Document, Tag
-from .serializers import RegisterSerializer, FolderSerializer, DocumentSerializer, TagSerializer, UserSerializer, \
-    ChangePasswordSerializer
+from rest_framework.exceptions import ValidationError
+from django.db import router, transaction
+from django.http import Http404, HttpResponse
+from django.db.models import Prefetch
+from django.shortcuts import get_object_or_404
+from django.utils.http import parse_etags
+from . import authentication, blobs, bulk, counters, exports, folder_tree, journal, previews, uploads, versions
+from .models import User, Change, Folder, Document, Tag, UploadSession, Preview
+from .serializers import RegisterSerializer, FolderSerializer, FolderDetailSerializer, DocumentSerializer, \
+    TagSerializer, UserSerializer, ChangePasswordSerializer, UploadSessionSerializer, BulkDocumentsSerializer, \
+    BulkMoveSerializer, BulkTagSerializer, BulkUploadSerializer
 from rest_framework.permissions import AllowAny, IsAuthenticated
-from rest_framework import filters
+from rest_framework.settings import api_settings
+from rest_framework.views import APIView
+from django.urls import reverse
 from django_filters.rest_framework import DjangoFilterBackend
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+from rest_framework_simplejwt.views import TokenBlacklistView
+from .fast_serializers import FastDocumentSerializer, FastFolderSerializer, FastTagSerializer
+from .filters import BlindIndexSearchFilter, ContentSearchFilter
+from .responses import document_etag, document_filename, ranged_file_response
 
 
 class RegisterView(generics.CreateAPIView):
@@ -45,57 +60,378 @@ class ChangePasswordView(generics.UpdateAPIView):
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+class LogoutView(TokenBlacklistView):
+    """Blacklists the refresh token and drops the user's cached authentication state."""
 
-class FolderViewSet(viewsets.ModelViewSet):
+    def post(self, request, *args, **kwargs):
+        try:
+            user_id = RefreshToken(request.data.get('refresh'))[jwt_settings.USER_ID_CLAIM]
+        except (TokenError, KeyError):
+            user_id = None
+
+        response = super().post(request, *args, **kwargs)
+        if user_id is not None:
+            authentication.invalidate(user_id)
+        return response
+
+
+class ExportView(APIView):
+    """The whole vault as a ZIP archive, a directory per folder."""
+    authentication_classes = [*api_settings.DEFAULT_AUTHENTICATION_CLASSES, exports.ExportLinkAuthentication]
+
+    def get(self, request):
+        folders = Folder.objects.filter(user=request.user).values_list('pk', 'name', 'parent_id')
+        return exports.export_response(
+            exports.export_documents(request.user), 'vault.zip',
+            {pk: (name, parent_id) for pk, name, parent_id in folders},
+        )
+
+
+class ExportLinkView(APIView):
+    """Short-lived link to the export of a folder, or of the whole vault, a browser can navigate to."""
+
+    def post(self, request):
+        folder_id = request.data.get('folder')
+        if folder_id is None:
+            path = reverse('vault_export')
+        else:
+            folder = get_object_or_404(Folder.objects.filter(user=request.user), pk=folder_id)
+            path = reverse('folder-export', args=[folder.pk])
+        return Response({'url': exports.sign_link(request.user, path)})
+
+
+def document_queryset():
+    """Documents with what DocumentSerializer reads, in a fixed number of queries.
+
+    Tags are only serialized as ids, so their encrypted names are not loaded.
+    They are in id order, as FastDocumentSerializer puts them.
+    """
+    return Document.objects.prefetch_related(Prefetch('tags', queryset=Tag.objects.only('id').order_by('pk')))
+
+
+class VersionedListMixin:
+    """Lists answered with 304 or from the cache while the user's vault version is unchanged."""
+
+    def list(self, request, *args, **kwargs):
+        etag = versions.list_etag(request)
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            payload = versions.get_cached(etag)
+            if payload is None:
+                response = super().list(request, *args, **kwargs)
+                versions.set_cached(etag, response.data)
+            else:
+                response = Response(payload)
+
+        response['ETag'] = etag
+        # the browser keeps the listing but revalidates it on every use
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+
+class FastListMixin:
+    """Lists serialized from rows by ``fast_serializer_class`` (see fast_serializers.py)."""
+    fast_serializer_class = None
+
+    def get_fast_serializer_class(self):
+        return self.fast_serializer_class
+
+    def list(self, request, *args, **kwargs):
+        return self.paginated_response(self.filter_queryset(self.get_queryset()))
+
+    def paginated_response(self, queryset, serializer_class=None):
+        serializer_class = serializer_class or self.get_serializer_class()
+        fast_serializer_class = self.get_fast_serializer_class()
+        context = self.get_serializer_context()
+        if fast_serializer_class is None:
+            page = self.paginate_queryset(queryset)
+            data = serializer_class(queryset if page is None else page, many=True, context=context).data
+        else:
+            rows = fast_serializer_class.rows(queryset)
+            page = self.paginate_queryset(rows)
+            data = fast_serializer_class(rows if page is None else page, context=context).data
+        return Response(data) if page is None else self.get_paginated_response(data)
+
+
+class FolderViewSet(VersionedListMixin, FastListMixin, viewsets.ModelViewSet):
     queryset = Folder.objects.all()
     serializer_class = FolderSerializer
+    fast_serializer_class = FastFolderSerializer
+
+    filter_backends = [DjangoFilterBackend, BlindIndexSearchFilter, filters.OrderingFilter]
+    filterset_fields = {'parent': ['exact', 'isnull']}
+    search_fields = ['name']
+    # names are encrypted, an order on them would mean decrypting the whole vault
+    ordering_fields = ['created_at']
+    ordering = ['-created_at', '-id']
+
+    def expand_documents(self):
+        # nested documents are opt-in, the summary is enough to list folders
+        return self.request.query_params.get('expand') == 'documents'
 
     def get_queryset(self):
-        return self.queryset.filter(user=self.request.user)
+        queryset = self.queryset.filter(user=self.request.user)
+        if self.expand_documents():
+            queryset = queryset.prefetch_related(Prefetch('documents', queryset=document_queryset()))
+        return queryset
+
+    def get_serializer_class(self):
+        if self.expand_documents():
+            return FolderDetailSerializer
+        return FolderSerializer
+
+    def get_fast_serializer_class(self):
+        return None if self.expand_documents() else super().get_fast_serializer_class()
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
 
-class DocumentViewSet(viewsets.ModelViewSet):
+    def perform_destroy(self, instance):
+        folder_tree.delete(self.request.user, instance)
+
+    @action(detail=True, methods=['get'])
+    def descendants(self, request, pk=None):
+        queryset = self.filter_queryset(folder_tree.descendants(self.get_object()))
+        return self.paginated_response(queryset, FolderSerializer)
+
+    @action(detail=True, methods=['get'])
+    def breadcrumbs(self, request, pk=None):
+        folders = folder_tree.breadcrumbs(self.get_object()).only('id', 'name')
+        return Response([{'id': folder.pk, 'name': folder.name} for folder in folders])
+
+    @action(detail=True, methods=['get'])
+    def totals(self, request, pk=None):
+        return Response(folder_tree.subtree_totals(self.get_object()))
+
+    @action(detail=True, methods=['get'],
+            authentication_classes=[*api_settings.DEFAULT_AUTHENTICATION_CLASSES, exports.ExportLinkAuthentication])
+    def export(self, request, pk=None):
+        folder = self.get_object()
+        folders = folder_tree.descendants(folder).values_list('pk', 'name', 'parent_id')
+        return exports.export_response(
+            exports.export_documents(request.user, folder), f'{exports.safe_name(folder.name)}.zip',
+            {pk: (name, parent_id) for pk, name, parent_id in folders}, root=folder.pk,
+        )
+
+class DocumentViewSet(VersionedListMixin, FastListMixin, viewsets.ModelViewSet):
     queryset = Document.objects.all()
     serializer_class = DocumentSerializer
+    fast_serializer_class = FastDocumentSerializer
 
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
+    filter_backends = [DjangoFilterBackend, BlindIndexSearchFilter, ContentSearchFilter, filters.OrderingFilter]
     filterset_fields = ['folder', 'tags']
     search_fields = ['name', 'file']
-    ordering_fields = ['name', 'created_at']
+    ordering_fields = ['created_at']
+    ordering = ['-created_at', '-id']
 
     def get_queryset(self):
-        return self.queryset.filter(user=self.request.user)
+        return document_queryset().filter(user=self.request.user)
 
     def perform_create(self, serializer):
-        serializer.save(user=self.request.user)
+        file = serializer.validated_data.get('file')
+        with transaction.atomic():
+            counters.check_quota(self.request.user, file.size if file else 0)
+            serializer.save(user=self.request.user)
+
+    def perform_update(self, serializer):
+        file = serializer.validated_data.get('file')
+        with transaction.atomic():
+            if file is not None:
+                # the document first, as its save locks it before the counters
+                documents = Document.objects.select_for_update().filter(pk=serializer.instance.pk)
+                counters.check_quota(self.request.user, file.size - documents.values_list('size', flat=True).get())
+            serializer.save()
     
     @action(detail=True, methods=['get'])
     def download(self, request,pk=None):
         instance = self.get_object()
         
-        # Open the file using the field's mechanism, which handles decryption
-        file_handle = instance.file.open()
-
-        # Attempt to determine the correct filename with extension
-        filename = instance.name
-        # extract extension from the stored file path if the name doesn't have it
-        _, ext = os.path.splitext(instance.file.name)
-        if ext and not filename.endswith(ext):
-            filename += ext
-
-        response = FileResponse(file_handle, content_type=instance.file_type or 'application/octet-stream')
-        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        # Open through the storage, which decrypts lazily and exposes the plaintext size
+        file_handle = instance.file.storage.open(instance.file.name)
+
+        return ranged_file_response(
+            request,
+            file_handle,
+            content_type=instance.file_type or 'application/octet-stream',
+            filename=document_filename(instance),
+            etag=document_etag(instance),
+            last_modified=instance.updated_at,
+        )
+
+    @action(detail=True, methods=['get'])
+    def preview(self, request, pk=None):
+        instance = get_object_or_404(
+            Document.objects.filter(user=request.user).select_related('blob', 'preview'), pk=pk,
+        )
+        try:
+            preview = instance.preview
+        except Preview.DoesNotExist:
+            preview = None
+
+        if preview is None or preview.digest != blobs.content_digest(instance) or previews.is_lost(preview):
+            previews.enqueue([instance])
+            return Response({"status": Preview.PENDING}, status=status.HTTP_202_ACCEPTED)
+        if preview.status == Preview.PENDING:
+            return Response({"status": Preview.PENDING}, status=status.HTTP_202_ACCEPTED)
+        if preview.status != Preview.READY:
+            return Response({"detail": "No preview available.", "status": preview.status},
+                            status=status.HTTP_404_NOT_FOUND)
+
+        etag = f'"{preview.digest[:32]}"'
+        if request.headers.get('If-None-Match') == etag:
+            response = HttpResponse(status=304)
+        else:
+            with preview.file.open() as file_handle:
+                response = HttpResponse(file_handle.read(), content_type=preview.content_type)
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, max-age=86400'
         return response
 
-class TagViewSet(viewsets.ModelViewSet):
+    def bulk_serializer(self, serializer_class):
+        serializer = serializer_class(data=self.request.data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        return serializer.validated_data
+
+    @action(detail=False, methods=['post'], url_path='bulk-move')
+    def bulk_move(self, request):
+        data = self.bulk_serializer(BulkMoveSerializer)
+        return Response({"results": bulk.move(request.user, data['ids'], data['folder'])})
+
+    @action(detail=False, methods=['post'], url_path='bulk-tag')
+    def bulk_tag(self, request):
+        data = self.bulk_serializer(BulkTagSerializer)
+        return Response({"results": bulk.retag(request.user, data['ids'], add=data['add'], remove=data['remove'])})
+
+    @action(detail=False, methods=['post'], url_path='bulk-delete')
+    def bulk_delete(self, request):
+        data = self.bulk_serializer(BulkDocumentsSerializer)
+        return Response({"results": bulk.delete(request.user, data['ids'])})
+
+    @action(detail=False, methods=['post'], url_path='bulk-upload')
+    def bulk_upload(self, request):
+        data = self.bulk_serializer(BulkUploadSerializer)
+        results = bulk.upload(request.user, data['files'], data['folder'], tags=data['tags'])
+        return Response({"results": results}, status=status.HTTP_201_CREATED)
+
+class UploadSessionViewSet(mixins.CreateModelMixin, mixins.RetrieveModelMixin, mixins.DestroyModelMixin,
+                           viewsets.GenericViewSet):
+    """Resumable upload: create a session, PUT its chunks in order, then finalize it into a Document."""
+    queryset = UploadSession.objects.all()
+    serializer_class = UploadSessionSerializer
+
+    def get_queryset(self):
+        return self.queryset.filter(user=self.request.user)
+
+    def perform_create(self, serializer):
+        with transaction.atomic():
+            # checked again on finalize, when the bytes are added
+            counters.check_quota(self.request.user, serializer.validated_data['size'])
+            sha256 = serializer.validated_data.pop('sha256', None)
+            session = serializer.save(
+                user=self.request.user,
+                chunk_size=uploads.get_upload_chunk_size(),
+                digest=blobs.keyed_digest(self.request.user.pk, sha256) if sha256 else '',
+            )
+        uploads.start(session)
+
+    def perform_destroy(self, instance):
+        uploads.abort(instance)
+
+    @action(detail=True, methods=['put'], url_path=r'chunks/(?P<index>\d+)')
+    def chunk(self, request, pk=None, index=None):
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+
+        try:
+            session = uploads.store_chunk(self.get_object(), int(index), request.stream, length)
+        except UploadSession.DoesNotExist:
+            raise Http404
+        except uploads.ChunkOutOfOrder as e:
+            return Response({"detail": str(e), "next_index": e.next_index}, status=status.HTTP_409_CONFLICT)
+        except uploads.UploadError as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(self.get_serializer(session).data)
+
+    @action(detail=True, methods=['post'])
+    def finalize(self, request, pk=None):
+        with transaction.atomic():
+            session = get_object_or_404(self.get_queryset().select_for_update(), pk=pk)
+            # other sessions may have been finalized since this one started
+            counters.check_quota(request.user, session.size)
+            try:
+                document = uploads.finalize(session)
+            except uploads.UploadError as e:
+                return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        serializer = DocumentSerializer(document, context=self.get_serializer_context())
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+class TagViewSet(VersionedListMixin, FastListMixin, viewsets.ModelViewSet):
 
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
+    fast_serializer_class = FastTagSerializer
+
+    filter_backends = [BlindIndexSearchFilter, filters.OrderingFilter]
+    search_fields = ['name']
+    ordering_fields = ['created_at']
+    ordering = ['-created_at', '-id']
 
     def get_queryset(self):
         return self.queryset.filter(user=self.request.user)
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
+
+
+class SyncView(APIView):
+    """Folders, tags and documents changed since a cursor, and the ids of those deleted (see journal.py).
+
+    Cursors are ``<vault version>.<sync horizon>``: the horizon a client
+    synced under tells whether tombstones it never got were compacted since.
+    """
+    max_limit = 5000
+
+    def get(self, request):
+        user = request.user
+        include = request.query_params.get('include')
+        names = include.split(',') if include else list(journal.MODELS)
+        sequence, _, known_horizon = request.query_params.get('since', '').partition('.')
+        try:
+            since, known_horizon = int(sequence or 0), int(known_horizon or 0)
+            limit = min(int(request.query_params.get('limit') or 500), self.max_limit)
+        except ValueError:
+            raise ValidationError('since has to be a cursor and limit an integer.')
+        if limit < 1 or not set(names) <= set(journal.MODELS):
+            raise ValidationError(f'limit has to be positive and include a subset of {", ".join(journal.MODELS)}.')
+
+        # the replica or the primary, but the same one for every read
+        using = router.db_for_read(Change)
+        with journal.snapshot(using):
+            horizon = User.objects.using(using).filter(pk=user.pk).values_list('sync_horizon', flat=True).get()
+            # clients without a cursor, or that may have missed compacted tombstones, get everything instead
+            reset = since == 0 or horizon > max(since, known_horizon)
+            changed, deleted, cursor, more = journal.read(
+                user.pk, 0 if reset else since, names, limit=limit, tombstones=not reset, using=using,
+            )
+
+            querysets = {
+                'folders': (Folder.objects.using(using).filter(user=user), FastFolderSerializer),
+                'tags': (Tag.objects.using(using).filter(user=user), FastTagSerializer),
+                'documents': (Document.objects.using(using).filter(user=user), FastDocumentSerializer),
+            }
+            payload = {'cursor': f'{cursor}.{horizon}', 'reset': reset, 'more': more}
+            for name in names:
+                queryset, serializer_class = querysets[name]
+                data = serializer_class(
+                    serializer_class.rows(queryset.filter(pk__in=changed[name])), context={'request': request},
+                ).data if changed[name] else []
+                # deleted since the journal was read
+                found = {item['id'] for item in data}
+                payload[name] = data
+                deleted[name] += [pk for pk in changed[name] if pk not in found]
+        payload['deleted'] = deleted
+        response = Response(payload)
+        response['Cache-Control'] = 'private, no-store'
+        return response
@@ -0,0 +1,65 @@
+"""Local process pool for background work on documents.
+
+Jobs run in spawned processes with Django set up, and their results are
+handed to a callback back in this process. BACKGROUND_WORKERS = 0 runs the
+jobs inline instead.
+"""
+import functools
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 2
+
+_pool = None
+
+
+def get_workers():
+    return getattr(settings, 'BACKGROUND_WORKERS', DEFAULT_WORKERS)
+
+
+def get_pool():
+    global _pool
+
+    if _pool is None:
+        # spawned rather than forked: the parent may hold threads and database connections
+        _pool = ProcessPoolExecutor(
+            max_workers=get_workers(), mp_context=multiprocessing.get_context('spawn'), initializer=django.setup,
+        )
+    return _pool
+
+
+def shutdown():
+    """Wait for the queued jobs and their callbacks, for commands that queue and exit."""
+    global _pool
+
+    if _pool is not None:
+        _pool.shutdown(wait=True)
+        _pool = None
+
+
+def _run_callback(callback, future):
+    # runs on the pool's result thread, which outlives requests
+    close_old_connections()
+    try:
+        callback(future.result())
+    except Exception:
+        logger.exception('Handling the result of a background job failed.')
+    finally:
+        close_old_connections()
+
+
+def submit(job, args, callback):
+    """Run ``job(*args)`` on the pool and ``callback`` with its result."""
+    if not get_workers():
+        callback(job(*args))
+        return
+
+    future = get_pool().submit(job, *args)
+    future.add_done_callback(functools.partial(_run_callback, callback))
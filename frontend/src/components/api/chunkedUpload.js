@@ -0,0 +1,53 @@
+import api from './axiosConfig';
+
+const MAX_RETRIES = 5;
+
+// Files up to this size are hashed first, so content already in the vault is not sent again.
+const MAX_HASHED_SIZE = 64 * 1024 * 1024;
+
+const sleep = (ms) => new Promise(resolve => setTimeout(resolve, ms));
+
+const sha256 = async (file) => {
+    if (file.size > MAX_HASHED_SIZE || !window.crypto?.subtle) return undefined;
+    const digest = await window.crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+    return Array.from(new Uint8Array(digest), byte => byte.toString(16).padStart(2, '0')).join('');
+};
+
+// Uploads `file` through an upload session, one chunk at a time. A failed chunk
+// is retried from the offset the server reports, so a dropped connection only
+// costs the chunk in flight.
+const chunkedUpload = async (file, { name, folder, tags = [] }) => {
+    const { data: session } = await api.post('/upload-sessions/', {
+        name,
+        folder,
+        tags,
+        filename: file.name,
+        file_type: file.type,
+        size: file.size,
+        sha256: await sha256(file),
+    });
+
+    let index = session.next_index;
+    let retries = 0;
+    while (!session.content_exists && index * session.chunk_size < file.size) {
+        const chunk = file.slice(index * session.chunk_size, (index + 1) * session.chunk_size);
+        try {
+            const { data } = await api.put(`/upload-sessions/${session.id}/chunks/${index}/`, chunk, {
+                headers: { 'Content-Type': 'application/octet-stream' },
+            });
+            index = data.next_index;
+            retries = 0;
+        } catch (err) {
+            if (retries >= MAX_RETRIES) throw err;
+            retries += 1;
+            await sleep(1000 * retries);
+            const { data } = await api.get(`/upload-sessions/${session.id}/`);
+            index = data.next_index;
+        }
+    }
+
+    const { data: document } = await api.post(`/upload-sessions/${session.id}/finalize/`);
+    return document;
+};
+
+export default chunkedUpload;
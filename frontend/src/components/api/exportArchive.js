@@ -0,0 +1,10 @@
+import api from './axiosConfig';
+
+// Opens a signed export link, so the browser streams the ZIP to disk instead of holding it in memory.
+// Without a folder id the whole vault is exported.
+const exportArchive = async (folderId = null) => {
+    const response = await api.post('/export-links/', { folder: folderId });
+    window.location.assign(response.data.url);
+};
+
+export default exportArchive;
@@ -0,0 +1,17 @@
+import api from './axiosConfig';
+
+// Follows the cursor links of a paginated list endpoint and returns every row.
+const fetchAll = async (url, params = {}) => {
+    let response = await api.get(url, { params });
+    const rows = [...response.data.results];
+
+    while (response.data.next) {
+        // the cursor link is absolute, only its query string is needed
+        const { search } = new URL(response.data.next);
+        response = await api.get(`${url}${search}`);
+        rows.push(...response.data.results);
+    }
+    return rows;
+};
+
+export default fetchAll;
@@ -0,0 +1,43 @@
+import api from './axiosConfig';
+
+// In-memory copies of the vault, one per set of included lists, brought up to date through /sync/:
+// after the first call each refresh only fetches what changed since the one before.
+const caches = {};
+
+export const resetVaultSync = () => {
+    Object.keys(caches).forEach(key => delete caches[key]);
+};
+
+const syncVault = async (include = ['folders', 'tags']) => {
+    const key = include.join(',');
+    if (!caches[key]) {
+        caches[key] = { cursor: '', items: Object.fromEntries(include.map(name => [name, new Map()])) };
+    }
+    const cache = caches[key];
+
+    let more = true;
+    while (more) {
+        const { data } = await api.get('/sync/', { params: { since: cache.cursor, include: key } });
+        if (data.reset) {
+            include.forEach(name => cache.items[name].clear());
+        }
+        include.forEach(name => {
+            data[name].forEach(item => cache.items[name].set(item.id, item));
+            data.deleted[name].forEach(id => cache.items[name].delete(id));
+        });
+        // deleting a tag unlinks it from its documents without them showing up as changed
+        if (cache.items.documents && data.deleted.tags?.length) {
+            const deletedTags = new Set(data.deleted.tags);
+            cache.items.documents.forEach(doc => {
+                doc.tags = doc.tags.filter(id => !deletedTags.has(id));
+            });
+        }
+        cache.cursor = data.cursor;
+        more = data.more;
+    }
+
+    const newestFirst = (a, b) => b.created_at.localeCompare(a.created_at) || b.id - a.id;
+    return Object.fromEntries(include.map(name => [name, [...cache.items[name].values()].sort(newestFirst)]));
+};
+
+export default syncVault;
@@ -1,7 +1,8 @@
 import React from 'react';
-import { FaFileAlt, FaEdit, FaTrash, FaDownload, FaSpinner } from 'react-icons/fa'; 
+import { FaEdit, FaTrash, FaDownload, FaSpinner } from 'react-icons/fa'; 
 import api from '../api/axiosConfig'; 
 import toast from 'react-hot-toast'; 
+import DocumentPreview from './DocumentPreview';
 
 const DocumentList = ({ documents, allTags, onEdit, onDelete }) => {
     
@@ -41,7 +42,7 @@ const DocumentList = ({ documents, allTags, onEdit, onDelete }) => {
             {documents.map(doc => (
                 <div key={doc.id} className="bg-gray-800 rounded-lg p-4 flex flex-col md:flex-row items-start md:items-center justify-between gap-4 transition-transform transform hover:scale-[1.02]">
                     <div className="flex items-center gap-4">
-                        <span className="text-3xl"><FaFileAlt className="text-gray-500" /></span>
+                        <DocumentPreview documentId={doc.id} />
                         <span className="font-semibold">{doc.name}</span>
                     </div>
                     <div className="flex items-center gap-4 w-full md:w-auto">
@@ -0,0 +1,48 @@
+import React, { useEffect, useState } from 'react';
+import { FaFileAlt } from 'react-icons/fa';
+import api from '../api/axiosConfig';
+
+const RETRY_DELAYS = [1000, 2000, 4000, 8000];
+
+// Thumbnail of a document, rendered by the server in the background. Until it
+// is ready (202) it is polled a few times; documents without one keep the icon.
+const DocumentPreview = ({ documentId }) => {
+    const [url, setUrl] = useState(null);
+
+    useEffect(() => {
+        let objectUrl = null;
+        let timer = null;
+        let cancelled = false;
+
+        const load = async (attempt) => {
+            try {
+                const response = await api.get(`/documents/${documentId}/preview/`, { responseType: 'blob' });
+                if (cancelled) return;
+                if (response.status === 202) {
+                    if (attempt < RETRY_DELAYS.length) {
+                        timer = setTimeout(() => load(attempt + 1), RETRY_DELAYS[attempt]);
+                    }
+                    return;
+                }
+                objectUrl = window.URL.createObjectURL(response.data);
+                setUrl(objectUrl);
+            } catch {
+                // no preview for this type of file
+            }
+        };
+        load(0);
+
+        return () => {
+            cancelled = true;
+            clearTimeout(timer);
+            if (objectUrl) window.URL.revokeObjectURL(objectUrl);
+        };
+    }, [documentId]);
+
+    if (!url) {
+        return <span className="text-3xl"><FaFileAlt className="text-gray-500" /></span>;
+    }
+    return <img src={url} alt="" className="w-12 h-12 object-cover rounded" loading="lazy" />;
+};
+
+export default DocumentPreview;
@@ -1,13 +1,21 @@
 import React from 'react';
 import {FaUserCircle , FaSignOutAlt} from 'react-icons/fa';
 import {Link, useNavigate} from 'react-router-dom';
+import api from '../api/axiosConfig';
+import { resetVaultSync } from '../api/vaultSync';
 
 const Navbar = ()=> {
     const navigate= useNavigate();
 
     const handleLogout = ()=> {
+        const refresh = localStorage.getItem("refreshToken");
+        if (refresh) {
+            // blacklists the refresh token; logging out locally does not wait for it
+            api.post('/logout/', {refresh}).catch(() => {});
+        }
         localStorage.removeItem("accessToken");
         localStorage.removeItem("refreshToken");
+        resetVaultSync();
         navigate('/');
         };
 
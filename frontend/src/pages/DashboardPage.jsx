@@ -1,7 +1,9 @@
 import React, { useEffect, useState } from 'react';
 import { Link, useNavigate } from 'react-router-dom';
 import api from '../components/api/axiosConfig';
-import { FaFolderPlus, FaSignOutAlt, FaSearch, FaEdit, FaTrash, FaUserCircle } from 'react-icons/fa';
+import syncVault from '../components/api/vaultSync';
+import exportArchive from '../components/api/exportArchive';
+import { FaFolderPlus, FaSignOutAlt, FaSearch, FaEdit, FaTrash, FaUserCircle, FaFileArchive } from 'react-icons/fa';
 import toast from 'react-hot-toast';
 import Select from 'react-select';
 
@@ -85,6 +87,7 @@ const DashboardPage = () => {
     const [searchQuery, setSearchQuery] = useState('');
     const [selectedTags, setSelectedTags] = useState([]);
     const [searchResults, setSearchResults] = useState([]);
+    const [searchContents, setSearchContents] = useState(false);
     const [isSearching, setIsSearching] = useState(false);
 
     const [modalState, setModalState] = useState({ type: null, data: null }); // type: 'create', 'edit', 'delete'
@@ -93,12 +96,9 @@ const DashboardPage = () => {
     const fetchFoldersAndTags = async () => {
         try {
             setLoading(true);
-            const [foldersRes, tagsRes] = await Promise.all([
-                api.get("/folders/"),
-                api.get("/tags/")
-            ]);
-            setFolders(foldersRes.data);
-            setTags(tagsRes.data.map(tag => ({ value: tag.id, label: tag.name })));
+            const { folders: allFolders, tags: allTags } = await syncVault(['folders', 'tags']);
+            setFolders(allFolders.filter(folder => folder.parent === null));
+            setTags(allTags.map(tag => ({ value: tag.id, label: tag.name })));
         } catch (err) {
             toast.error('Failed to fetch data.');
         } finally {
@@ -116,10 +116,10 @@ const DashboardPage = () => {
         try {
             const tagIds = selectedTags.map(t => t.value).join(',');
             const response = await api.get(`/documents/`, {
-                params: { search: searchQuery, tags: tagIds }
+                params: searchContents ? { q: searchQuery, tags: tagIds } : { search: searchQuery, tags: tagIds }
             });
-            setSearchResults(response.data);
-            if (response.data.length === 0) {
+            setSearchResults(response.data.results);
+            if (response.data.results.length === 0) {
                 toast.success('No documents found matching your query.');
             }
         } catch (error) {
@@ -175,6 +175,9 @@ const DashboardPage = () => {
                     </div>
                     <div className="flex items-center gap-4">
 
+                        <button onClick={() => exportArchive().catch(() => toast.error('Failed to export the vault.'))} className="action-button bg-green-600 hover:bg-green-700">
+                            <FaFileArchive /> Export Vault
+                        </button>
                         <button onClick={() => setModalState({ type: 'create' })} className="action-button bg-blue-600 hover:bg-blue-700">
                             <FaFolderPlus /> New Folder
                         </button>
@@ -193,6 +196,14 @@ const DashboardPage = () => {
                             className="w-full p-2 pl-10 border border-gray-600 rounded-lg bg-gray-700 focus:outline-none focus:ring-2 focus:ring-blue-500"
                         />
                     </div>
+                    <label className="flex items-center gap-2 text-gray-300 whitespace-nowrap">
+                        <input
+                            type="checkbox"
+                            checked={searchContents}
+                            onChange={(e) => setSearchContents(e.target.checked)}
+                        />
+                        Search contents
+                    </label>
                     <Select
                         isMulti
                         options={tags}
@@ -221,7 +232,7 @@ const DashboardPage = () => {
                             <div key={folder.id} className="folder-card group">
                                 <Link to={`/folder/${folder.id}`} className="block flex-grow">
                                     <h3 className="text-xl font-semibold text-white mb-2 truncate">{folder.name}</h3>
-                                    <p className="text-gray-400">{folder.documents.length} documents</p>
+                                    <p className="text-gray-400">{folder.document_count} documents</p>
                                 </Link>
                                 <div className="absolute top-2 right-2 flex gap-2 opacity-0 group-hover:opacity-100 transition-opacity">
                                     <button onClick={() => setModalState({ type: 'edit', data: folder })} className="icon-button"><FaEdit /></button>
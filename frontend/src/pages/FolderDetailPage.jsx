@@ -1,7 +1,10 @@
 import React, { useEffect, useState, useCallback } from 'react';
 import { useParams, Link } from 'react-router-dom';
 import api from '../components/api/axiosConfig';
-import { FaArrowLeft, FaFileUpload, FaFileAlt, FaEdit, FaTrash, FaSpinner } from 'react-icons/fa';
+import chunkedUpload from '../components/api/chunkedUpload';
+import fetchAll from '../components/api/fetchAll';
+import exportArchive from '../components/api/exportArchive';
+import { FaArrowLeft, FaFileUpload, FaFileAlt, FaEdit, FaTrash, FaSpinner, FaFileArchive, FaFolder, FaFolderPlus, FaChevronRight } from 'react-icons/fa';
 import toast from 'react-hot-toast';
 import CreatableSelect from 'react-select/creatable';
 import DocumentList from '../components/document/DocumentList';
@@ -22,6 +25,9 @@ const FolderDetailPage = () => {
     const { folderId } = useParams();
     const [documents, setDocuments] = useState([]);
     const [folderName, setFolderName] = useState('');
+    const [breadcrumbs, setBreadcrumbs] = useState([]);
+    const [subfolders, setSubfolders] = useState([]);
+    const [subfolderName, setSubfolderName] = useState('');
     const [allTags, setAllTags] = useState([]);
     const [loading, setLoading] = useState(true);
     const [isUploading, setIsUploading] = useState(false);
@@ -33,16 +39,19 @@ const FolderDetailPage = () => {
     const fetchFolderData = useCallback(async () => {
         try {
             setLoading(true);
-            // We only need two API calls now
-            const [folderRes, tagsRes] = await Promise.all([
+            const [folderRes, breadcrumbsRes, folderChildren, folderDocuments, tags] = await Promise.all([
                 api.get(`/folders/${folderId}/`),
-                api.get('/tags/')
+                api.get(`/folders/${folderId}/breadcrumbs/`),
+                fetchAll('/folders/', { parent: folderId }),
+                fetchAll('/documents/', { folder: folderId }),
+                fetchAll('/tags/')
             ]);
     
-            // Use the documents directly from the folder response
-            setDocuments(folderRes.data.documents || []);
+            setDocuments(folderDocuments);
             setFolderName(folderRes.data.name);
-            setAllTags(tagsRes.data.map(t => ({ value: t.id, label: t.name })));
+            setBreadcrumbs(breadcrumbsRes.data);
+            setSubfolders(folderChildren);
+            setAllTags(tags.map(t => ({ value: t.id, label: t.name })));
         } catch (err) {
             toast.error('Failed to fetch folder data.');
         } finally {
@@ -75,16 +84,12 @@ const FolderDetailPage = () => {
         }
 
         setIsUploading(true);
-        const formData = new FormData();
-        formData.append('file', uploadFile);
-        formData.append('name', documentName);
-        formData.append('folder', folderId);
-        formData.append('file_type', uploadFile.type);
-        selectedUploadTags.forEach(tag => formData.append('tags', tag.value));
 
         try {
-            await api.post('/documents/', formData, {
-                headers: { 'Content-Type': 'multipart/form-data' },
+            await chunkedUpload(uploadFile, {
+                name: documentName,
+                folder: folderId,
+                tags: selectedUploadTags.map(tag => tag.value),
             });
             toast.success('Document uploaded successfully!');
             setUploadFile(null);
@@ -110,6 +115,30 @@ const FolderDetailPage = () => {
         fetchFolderData();
     };
 
+    const handleCreateSubfolder = async (e) => {
+        e.preventDefault();
+        if (!subfolderName.trim()) {
+            toast.error('Folder name cannot be empty.');
+            return;
+        }
+        try {
+            await api.post('/folders/', { name: subfolderName, parent: folderId });
+            toast.success('Folder created successfully!');
+            setSubfolderName('');
+            fetchFolderData();
+        } catch (err) {
+            toast.error('Failed to create folder.');
+        }
+    };
+
+    const handleExport = async () => {
+        try {
+            await exportArchive(folderId);
+        } catch (err) {
+            toast.error('Failed to export folder.');
+        }
+    };
+
     if (loading) return <p className="text-center mt-8 text-lg">Loading Folder...</p>;
 
     return (
@@ -130,12 +159,63 @@ const FolderDetailPage = () => {
             />
 
             <div className="container mx-auto px-4 py-8">
-                <Link to="/dashboard" className="inline-flex items-center gap-2 text-blue-400 hover:underline mb-6">
+                <Link
+                    to={breadcrumbs.length > 1 ? `/folder/${breadcrumbs[breadcrumbs.length - 2].id}` : '/dashboard'}
+                    className="inline-flex items-center gap-2 text-blue-400 hover:underline mb-6"
+                >
                     <FaArrowLeft />
-                    Back to Dashboard
+                    {breadcrumbs.length > 1 ? 'Back to Parent Folder' : 'Back to Dashboard'}
                 </Link>
 
-                <h1 className="text-3xl font-bold text-white mb-4">Folder: {folderName}</h1>
+                {breadcrumbs.length > 1 && (
+                    <nav className="flex flex-wrap items-center gap-2 text-sm text-gray-400 mb-2">
+                        {breadcrumbs.slice(0, -1).map(crumb => (
+                            <React.Fragment key={crumb.id}>
+                                <Link to={`/folder/${crumb.id}`} className="hover:underline">{crumb.name}</Link>
+                                <FaChevronRight className="text-xs" />
+                            </React.Fragment>
+                        ))}
+                    </nav>
+                )}
+
+                <div className="flex flex-wrap justify-between items-center gap-4 mb-4">
+                    <h1 className="text-3xl font-bold text-white">Folder: {folderName}</h1>
+                    {documents.length > 0 && (
+                        <button onClick={handleExport} className="action-button bg-green-600 hover:bg-green-700">
+                            <FaFileArchive /> Export as ZIP
+                        </button>
+                    )}
+                </div>
+
+                <div className="bg-gray-800 p-4 rounded-lg mb-6">
+                    <form onSubmit={handleCreateSubfolder} className="flex gap-2 mb-4">
+                        <input
+                            type="text"
+                            value={subfolderName}
+                            onChange={(e) => setSubfolderName(e.target.value)}
+                            placeholder="New subfolder name"
+                            className="flex-grow p-2 border border-gray-600 rounded-lg bg-gray-700 focus:outline-none focus:ring-2 focus:ring-blue-500"
+                        />
+                        <button type="submit" className="action-button bg-blue-600 hover:bg-blue-700">
+                            <FaFolderPlus /> New Subfolder
+                        </button>
+                    </form>
+                    {subfolders.length > 0 && (
+                        <div className="grid grid-cols-1 sm:grid-cols-2 lg:grid-cols-3 gap-3">
+                            {subfolders.map(subfolder => (
+                                <Link
+                                    key={subfolder.id}
+                                    to={`/folder/${subfolder.id}`}
+                                    className="flex items-center gap-3 p-3 rounded-lg bg-gray-700 hover:bg-gray-600"
+                                >
+                                    <FaFolder className="text-yellow-400" />
+                                    <span className="truncate">{subfolder.name}</span>
+                                    <span className="ml-auto text-xs text-gray-400">{subfolder.document_count} files</span>
+                                </Link>
+                            ))}
+                        </div>
+                    )}
+                </div>
 
                 <DocumentUploadForm
                     onUpload={handleUpload}